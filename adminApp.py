@@ -1,11 +1,10 @@
 import streamlit as st
 import pandas as pd
-import psycopg2
 import plotly.express as px
 import plotly.graph_objects as go
 from datetime import datetime, timedelta
-import os
 from dotenv import load_dotenv
+from practica import archive, ascent_times, catalog, consensus, cube, db, facets, grades, hll, integrity, journeys, leaderboards, levels, pickers, purge, ratings, routing, search, trending
 
 # Load environment variables
 load_dotenv()
@@ -18,33 +17,158 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-# Database connection function
+# Database connection function (primary, used for every write)
 @st.cache_resource
 def init_connection():
-    return psycopg2.connect(
-        dbname=os.getenv("DB_NAME", "postgres"),
-        user=os.getenv("DB_USER", "postgres"),
-        password=os.getenv("DB_PASSWORD", ""),
-        host=os.getenv("DB_HOST", "localhost"),
-        port=os.getenv("DB_PORT", "5432")
-    )
+    return db.connect()
+
+# Connections to the read replicas listed in DB_REPLICA_HOSTS, if any
+@st.cache_resource
+def init_replica_connections():
+    return routing.connect_replicas()
+
+# Connection for a read that has to see writes up to min_lsn
+def read_connection(min_lsn=None):
+    replica = routing.choose(init_replica_connections(), min_lsn, routing.connection_caught_up)
+    return replica.conn if replica else init_connection()
 
-# Execute query with caching for read operations
+# Remember the primary's WAL position so this session's next reads wait for it
+def remember_write(conn):
+    with conn.cursor() as cur:
+        st.session_state.write_lsn = routing.current_lsn(cur)
+
+# Execute query with caching for read operations.
+# min_lsn is part of the cache key, so a session never gets a cached result
+# that is older than its own last write.
 @st.cache_data(ttl=600)
-def run_query(query, params=None, fetch=True):
-    conn = init_connection()
+def cached_query(query, params=None, fetch=True, min_lsn=None):
+    conn = read_connection(min_lsn) if fetch else init_connection()
     with conn.cursor() as cur:
         cur.execute(query, params)
         if fetch:
             return cur.fetchall()
         conn.commit()
 
+def run_query(query, params=None, fetch=True):
+    return cached_query(query, params, fetch, st.session_state.get("write_lsn"))
+
+run_query.clear = cached_query.clear
+
 # Execute query without caching for write operations
-def run_query_no_cache(query, params=None):
+def run_query_no_cache(query, params=None, fetch=False):
     conn = init_connection()
     with conn.cursor() as cur:
         cur.execute(query, params)
+        rows = cur.fetchall() if fetch else None
         conn.commit()
+    remember_write(conn)
+    return rows
+
+# Dry-run count of the rows a cascading delete would remove
+@st.cache_data(ttl=60)
+def purge_preview(kind, key):
+    return purge.count_dependents(init_connection(), kind, key)
+
+# Warn about the dependents of the selected record before it is deleted
+def show_purge_preview(kind, key, label):
+    counts = {name: n for name, n in purge_preview(kind, key).items() if n}
+    if counts:
+        details = ", ".join(f"{n} {name.lower()}" for name, n in counts.items())
+        st.warning(f"Deleting this {label} will also delete: {details}")
+    return counts
+
+# Cascading delete in throttled batches, with a progress bar
+def run_purge(kind, key):
+    progress_bar = st.progress(0.0)
+    def report(name, done, total):
+        progress_bar.progress(min(done / total, 1.0) if total else 1.0, text=f"Deleting {name.lower()}... {done}/{total}")
+    purge.purge(init_connection(), kind, key, progress=report)
+    remember_write(init_connection())
+    run_query.clear()
+    purge_preview.clear()
+
+# The crag -> sector -> route catalog of practica/catalog.py, shared by every
+# session and loaded again only when practica.catalog_version moves
+@st.cache_resource(max_entries=1)
+def load_catalog(version, _min_lsn=None):
+    with read_connection(_min_lsn).cursor() as cur:
+        return catalog.load(cur)
+
+def catalog_tree():
+    min_lsn = st.session_state.get("write_lsn")
+    with read_connection(min_lsn).cursor() as cur:
+        version = catalog.current_version(cur)
+    return load_catalog(version, min_lsn)
+
+# Whether the archive tables and their *_all views exist
+@st.cache_data(ttl=600)
+def archive_installed():
+    return archive.is_installed(init_connection())
+
+# Whether python -m practica has set up the integrity scanner's tables
+@st.cache_data(ttl=600)
+def integrity_installed():
+    return integrity.is_installed(init_connection())
+
+# Picker over one page of a climber's records of practica/pickers.py, with
+# route, date range and text filters and newer/older buttons. Only the page
+# shown is read. Returns the selected record id, or None if nothing matches.
+def record_picker(dataset, climber, label):
+    key = f"pick_{dataset}"
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        route = st.text_input("Route contains", key=f"{key}_route")
+    with col2:
+        dates = st.date_input("Date range", value=(), key=f"{key}_dates")
+    with col3:
+        text = st.text_input("Text", key=f"{key}_text") if pickers.DATASETS[dataset]["text"] else ""
+    date_from = dates[0] if len(dates) > 0 else None
+    date_to = dates[1] if len(dates) > 1 else None
+
+    # Back to the newest page whenever the climber or a filter changes
+    filters = (climber, route, date_from, date_to, text)
+    if st.session_state.get(f"{key}_filters") != filters:
+        st.session_state[f"{key}_filters"] = filters
+        st.session_state[f"{key}_pages"] = [None]
+    pages = st.session_state[f"{key}_pages"]
+
+    rows = run_query(*pickers.page_query(dataset, climber, route, date_from, date_to, text, after=pages[-1]))
+    has_next = len(rows) > pickers.PAGE_SIZE
+    rows = rows[:pickers.PAGE_SIZE]
+    if not rows:
+        return None
+    labels = {row[0]: pickers.label(row) for row in rows}
+    selected = st.selectbox(label, list(labels), format_func=labels.get)
+
+    col_prev, col_page, col_next = st.columns([1, 2, 1])
+    with col_prev:
+        if st.button("← Newer", key=f"{key}_prev", disabled=len(pages) == 1):
+            pages.pop()
+            st.experimental_rerun()
+    with col_page:
+        st.caption(f"Page {len(pages)}")
+    with col_next:
+        if st.button("Older →", key=f"{key}_next", disabled=not has_next):
+            pages.append(pickers.cursor(rows[-1]))
+            st.experimental_rerun()
+    return selected
+
+# Multi-select filters for a dataset of practica/facets.py, one column each,
+# listing every value with its count under the other filters' selection.
+# Returns the selection as {column: [values]}.
+def facet_filters(dataset, labels, include_archived):
+    selection = {column: st.session_state.get(f"{dataset}_{column}", []) for column in labels}
+    for col, (column, label) in zip(st.columns(len(labels)), labels.items()):
+        counts = dict(run_query(*facets.counts_query(dataset, column, selection, include_archived)))
+        options = sorted(set(counts) | set(selection[column]))
+        with col:
+            selection[column] = st.multiselect(
+                label, options, key=f"{dataset}_{column}", placeholder="All",
+                format_func=lambda value, counts=counts: f"{value or '(none)'} ({counts.get(value, 0)})"
+            )
+    total = run_query(*facets.total_query(dataset, selection, include_archived))[0][0]
+    st.caption(f"{total} matching")
+    return selection
 
 # Main app title
 st.title("🧗‍♂️ Climbing Database Management System")
@@ -53,31 +177,34 @@ st.title("🧗‍♂️ Climbing Database Management System")
 st.sidebar.title("Navigation")
 page = st.sidebar.radio(
     "Select a page",
-    ["Dashboard", "Crags", "Sectors", "Routes", "Climbers", "Attempts", "Completions", "Comments", "Recommendations"]
+    ["Dashboard", "Crags", "Sectors", "Routes", "Climbers", "Attempts", "Completions", "Comments", "Recommendations", "Leaderboards", "Analytics", "Integrity"]
 )
 
+# Archived rows are only read when explicitly asked for
+include_archived = archive_installed() and st.sidebar.checkbox("Include archived data")
+
+# Crag, sector and route lists for every page's pickers
+tree = catalog_tree()
+
 # Dashboard page
 if page == "Dashboard":
     st.header("Dashboard")
     
-    # Get some basic statistics
+    # Get some basic statistics (kept up to date from the change log, see practica/counters.py)
     col1, col2, col3, col4 = st.columns(4)
+    totals = dict(run_query("SELECT nom, valor FROM practica.stats_counter"))
     
     # Count of crags
-    crags_count = run_query("SELECT COUNT(*) FROM practica.crag")[0][0]
-    col1.metric("Total Crags", crags_count)
+    col1.metric("Total Crags", totals.get("crag", 0))
     
     # Count of routes
-    routes_count = run_query("SELECT COUNT(*) FROM practica.via")[0][0]
-    col2.metric("Total Routes", routes_count)
+    col2.metric("Total Routes", totals.get("via", 0))
     
     # Count of climbers
-    climbers_count = run_query("SELECT COUNT(*) FROM practica.escalador")[0][0]
-    col3.metric("Registered Climbers", climbers_count)
+    col3.metric("Registered Climbers", totals.get("escalador", 0))
     
     # Count of attempts
-    attempts_count = run_query("SELECT COUNT(*) FROM practica.intent")[0][0]
-    col4.metric("Total Attempts", attempts_count)
+    col4.metric("Total Attempts", totals.get("intent", 0))
     
     # Charts section
     st.subheader("Statistics")
@@ -88,17 +215,19 @@ if page == "Dashboard":
         # Routes by difficulty
         st.subheader("Routes by Difficulty")
         difficulty_data = run_query("""
-            SELECT grau_dificultat, COUNT(*) as count 
+            SELECT grau_ordinal, COUNT(*) as count 
             FROM practica.via 
-            WHERE grau_dificultat IS NOT NULL 
-            GROUP BY grau_dificultat 
-            ORDER BY count DESC
+            WHERE grau_ordinal IS NOT NULL 
+            GROUP BY grau_ordinal 
+            ORDER BY grau_ordinal
         """)
         
         if difficulty_data:
-            df_difficulty = pd.DataFrame(difficulty_data, columns=["Difficulty", "Count"])
+            df_difficulty = pd.DataFrame(difficulty_data, columns=["Grade", "Count"])
+            df_difficulty["Difficulty"] = grades.to_labels(df_difficulty["Grade"])
             fig = px.bar(df_difficulty, x="Difficulty", y="Count", color="Count",
                         title="Routes by Difficulty Grade")
+            fig.update_xaxes(type="category")
             st.plotly_chart(fig, use_container_width=True)
         else:
             st.info("No difficulty data available")
@@ -106,24 +235,29 @@ if page == "Dashboard":
     with col2:
         # Top rated routes
         st.subheader("Top Rated Routes")
-        top_routes = run_query("""
-            SELECT v.nom, v.nom_sector, v.nom_crag_sector, AVG(r.puntuacio) as avg_rating, COUNT(r.id_recomanacio) as num_ratings
-            FROM practica.via v
-            JOIN practica.recomanacio r ON v.nom = r.nom_via AND v.nom_sector = r.nom_sector_via AND v.nom_crag_sector = r.nom_crag_via
-            GROUP BY v.nom, v.nom_sector, v.nom_crag_sector
-            HAVING COUNT(r.id_recomanacio) > 0
-            ORDER BY avg_rating DESC
-            LIMIT 10
-        """)
+        # Ranked by Bayesian average, so routes with a handful of votes don't dominate
+        top_routes = run_query(ratings.top_routes_query(), (10,))
         
         if top_routes:
-            df_top_routes = pd.DataFrame(top_routes, columns=["Route", "Sector", "Crag", "Average Rating", "Number of Ratings"])
-            fig = px.bar(df_top_routes, x="Route", y="Average Rating", color="Number of Ratings",
-                        hover_data=["Sector", "Crag"], title="Top Rated Routes")
+            df_top_routes = pd.DataFrame(top_routes, columns=["Route", "Sector", "Crag", "Bayesian Rating", "Average Rating", "Number of Ratings"])
+            fig = px.bar(df_top_routes, x="Route", y="Bayesian Rating", color="Number of Ratings",
+                        hover_data=["Sector", "Crag", "Average Rating"], title="Top Rated Routes")
             st.plotly_chart(fig, use_container_width=True)
         else:
             st.info("No rating data available")
     
+    # Trending routes, by activity decayed by half every week (see practica/trending.py)
+    st.subheader("Trending This Week")
+    trending_routes = run_query(trending.TOP_ROUTES, (10,))
+    
+    if trending_routes:
+        df_trending = pd.DataFrame(trending_routes, columns=["Route", "Sector", "Crag", "Trend Score"])
+        fig = px.bar(df_trending, x="Route", y="Trend Score", hover_data=["Sector", "Crag"],
+                    title="Trending Routes")
+        st.plotly_chart(fig, use_container_width=True)
+    else:
+        st.info("No recent activity")
+    
     # Recent activity
     st.subheader("Recent Activity")
     recent_activity = run_query("""
@@ -187,14 +321,15 @@ elif page == "Crags":
     
     with tab3:
         st.subheader("Edit/Delete Crag")
-        crag_list = run_query("SELECT nom FROM practica.crag ORDER BY nom")
-        if crag_list:
-            crag_names = [crag[0] for crag in crag_list]
+        crag_names = tree.crags()
+        if crag_names:
             selected_crag = st.selectbox("Select Crag", crag_names)
             
             crag_data = run_query("SELECT nom, localitzacio, descripcio FROM practica.crag WHERE nom = %s", (selected_crag,))
             
             if crag_data:
+                show_purge_preview("crag", (selected_crag,), "crag")
+                
                 with st.form("edit_crag_form"):
                     crag_location = st.text_area("Location", value=crag_data[0][1] if crag_data[0][1] else "")
                     crag_description = st.text_area("Description", value=crag_data[0][2] if crag_data[0][2] else "")
@@ -218,7 +353,7 @@ elif page == "Crags":
                     
                     if delete_button:
                         try:
-                            run_query_no_cache("DELETE FROM practica.crag WHERE nom = %s", (selected_crag,))
+                            run_purge("crag", (selected_crag,))
                             st.success(f"Crag '{selected_crag}' deleted successfully!")
                             st.experimental_rerun()
                         except Exception as e:
@@ -250,9 +385,8 @@ elif page == "Sectors":
     with tab2:
         st.subheader("Add New Sector")
         with st.form("add_sector_form"):
-            crag_list = run_query("SELECT nom FROM practica.crag ORDER BY nom")
-            if crag_list:
-                crag_names = [crag[0] for crag in crag_list]
+            crag_names = tree.crags()
+            if crag_names:
                 selected_crag = st.selectbox("Crag*", crag_names)
                 
                 sector_name = st.text_input("Sector Name*")
@@ -280,16 +414,14 @@ elif page == "Sectors":
         st.subheader("Edit/Delete Sector")
         
         # First select crag
-        crag_list = run_query("SELECT nom FROM practica.crag ORDER BY nom")
-        if crag_list:
-            crag_names = [crag[0] for crag in crag_list]
+        crag_names = tree.crags()
+        if crag_names:
             selected_crag = st.selectbox("Select Crag", crag_names, key="edit_crag")
             
             # Then select sector within that crag
-            sector_list = run_query("SELECT nom FROM practica.sector WHERE nom_crag = %s ORDER BY nom", (selected_crag,))
+            sector_names = tree.sectors(selected_crag)
             
-            if sector_list:
-                sector_names = [sector[0] for sector in sector_list]
+            if sector_names:
                 selected_sector = st.selectbox("Select Sector", sector_names)
                 
                 sector_data = run_query(
@@ -298,6 +430,8 @@ elif page == "Sectors":
                 )
                 
                 if sector_data:
+                    show_purge_preview("sector", (selected_crag, selected_sector), "sector")
+                    
                     with st.form("edit_sector_form"):
                         sector_description = st.text_area("Description", value=sector_data[0][1] if sector_data[0][1] else "")
                         
@@ -320,10 +454,7 @@ elif page == "Sectors":
                         
                         if delete_button:
                             try:
-                                run_query_no_cache(
-                                    "DELETE FROM practica.sector WHERE nom = %s AND nom_crag = %s", 
-                                    (selected_sector, selected_crag)
-                                )
+                                run_purge("sector", (selected_crag, selected_sector))
                                 st.success(f"Sector '{selected_sector}' deleted successfully!")
                                 st.experimental_rerun()
                             except Exception as e:
@@ -343,42 +474,60 @@ elif page == "Routes":
         st.subheader("All Routes")
         
         # Filters
-        col1, col2, col3 = st.columns(3)
+        col1, col2, col3, col4 = st.columns(4)
         with col1:
             crag_filter = st.selectbox(
                 "Filter by Crag", 
-                ["All"] + [crag[0] for crag in run_query("SELECT nom FROM practica.crag ORDER BY nom")]
+                ["All"] + tree.crags()
             )
         
         with col2:
             if crag_filter != "All":
                 sector_filter = st.selectbox(
                     "Filter by Sector",
-                    ["All"] + [sector[0] for sector in run_query(
-                        "SELECT nom FROM practica.sector WHERE nom_crag = %s ORDER BY nom", 
-                        (crag_filter,)
-                    )]
+                    ["All"] + tree.sectors(crag_filter)
                 )
             else:
                 sector_filter = "All"
         
         with col3:
-            difficulty_filter = st.selectbox(
-                "Filter by Difficulty",
-                ["All"] + [diff[0] for diff in run_query(
-                    "SELECT DISTINCT grau_dificultat FROM practica.via WHERE grau_dificultat IS NOT NULL ORDER BY grau_dificultat"
-                ) if diff[0]]
+            # Grade range over the grades present, both ends read from the grau_ordinal index
+            grade_bounds = run_query("SELECT MIN(grau_ordinal), MAX(grau_ordinal) FROM practica.via")[0]
+            if grade_bounds[0] is not None:
+                grade_options = list(range(grade_bounds[0], grade_bounds[1] + 1))
+                grade_range = st.select_slider(
+                    "Filter by Difficulty",
+                    options=grade_options,
+                    value=(grade_options[0], grade_options[-1]),
+                    format_func=grades.label
+                )
+                grade_filtered = grade_range != (grade_options[0], grade_options[-1])
+            else:
+                grade_filtered = False
+        
+        with col4:
+            grade_system = st.selectbox(
+                "Show Grades As",
+                ["As entered", "French", "UIAA", "YDS"]
             )
+            disputed_only = st.checkbox("Only soft/hard grades")
         
         # Build query based on filters
         query = """
             SELECT v.nom, v.nom_sector, v.nom_crag_sector, v.grau_dificultat, v.estil, 
-                   v.alcada_aproximada_metres, v.equipador, v.data_equipament, v.descripcio
+                   v.alcada_aproximada_metres, v.equipador, v.data_equipament, v.descripcio,
+                   c.grau_ordinal, c.ajust, c.confianca, c.escaladors
             FROM practica.via v
+            LEFT JOIN practica.route_consensus c
+              ON (c.nom_via, c.nom_sector_via, c.nom_crag_via) = (v.nom, v.nom_sector, v.nom_crag_sector)
             WHERE 1=1
         """
         params = []
         
+        if disputed_only:
+            query += " AND c.ajust <> 0 AND c.confianca >= %s AND c.escaladors >= %s"
+            params.extend([consensus.MIN_CONFIDENCE, consensus.MIN_CLIMBERS])
+        
         if crag_filter != "All":
             query += " AND v.nom_crag_sector = %s"
             params.append(crag_filter)
@@ -387,19 +536,30 @@ elif page == "Routes":
                 query += " AND v.nom_sector = %s"
                 params.append(sector_filter)
         
-        if difficulty_filter != "All":
-            query += " AND v.grau_dificultat = %s"
-            params.append(difficulty_filter)
+        if grade_filtered:
+            query += " AND v.grau_ordinal BETWEEN %s AND %s"
+            params.extend(grade_range)
             
         query += " ORDER BY v.nom_crag_sector, v.nom_sector, v.nom"
         
         routes = run_query(query, tuple(params) if params else None)
         
         if routes:
-            df_routes = pd.DataFrame(routes, columns=[
-                "Route Name", "Sector", "Crag", "Difficulty", "Style", 
-                "Height (m)", "Equipper", "Equipment Date", "Description"
-            ])
+            df_routes = pd.DataFrame(
+                [
+                    row[:9] + (consensus.verdict(*row[9:]) if row[12] is not None else None, row[11])
+                    for row in routes
+                ],
+                columns=[
+                    "Route Name", "Sector", "Crag", "Difficulty", "Style", 
+                    "Height (m)", "Equipper", "Equipment Date", "Description",
+                    "Grade Consensus", "Confidence"
+                ]
+            )
+            if grade_system != "As entered":
+                df_routes["Difficulty"] = grades.to_labels(
+                    grades.to_ordinals(df_routes["Difficulty"]), grade_system.lower()
+                )
             st.dataframe(df_routes, use_container_width=True)
         else:
             st.info("No routes available with the selected filters")
@@ -408,16 +568,14 @@ elif page == "Routes":
         st.subheader("Add New Route")
         
         # First select crag
-        crag_list = run_query("SELECT nom FROM practica.crag ORDER BY nom")
-        if crag_list:
-            crag_names = [crag[0] for crag in crag_list]
+        crag_names = tree.crags()
+        if crag_names:
             selected_crag = st.selectbox("Crag*", crag_names, key="add_route_crag")
             
             # Then select sector within that crag
-            sector_list = run_query("SELECT nom FROM practica.sector WHERE nom_crag = %s ORDER BY nom", (selected_crag,))
+            sector_names = tree.sectors(selected_crag)
             
-            if sector_list:
-                sector_names = [sector[0] for sector in sector_list]
+            if sector_names:
                 selected_sector = st.selectbox("Sector*", sector_names, key="add_route_sector")
                 
                 with st.form("add_route_form"):
@@ -472,26 +630,20 @@ elif page == "Routes":
         st.subheader("Edit/Delete Route")
         
         # First select crag
-        crag_list = run_query("SELECT nom FROM practica.crag ORDER BY nom")
-        if crag_list:
-            crag_names = [crag[0] for crag in crag_list]
+        crag_names = tree.crags()
+        if crag_names:
             selected_crag = st.selectbox("Select Crag", crag_names, key="edit_route_crag")
             
             # Then select sector within that crag
-            sector_list = run_query("SELECT nom FROM practica.sector WHERE nom_crag = %s ORDER BY nom", (selected_crag,))
+            sector_names = tree.sectors(selected_crag)
             
-            if sector_list:
-                sector_names = [sector[0] for sector in sector_list]
+            if sector_names:
                 selected_sector = st.selectbox("Select Sector", sector_names, key="edit_route_sector")
                 
                 # Then select route within that sector
-                route_list = run_query(
-                    "SELECT nom FROM practica.via WHERE nom_sector = %s AND nom_crag_sector = %s ORDER BY nom", 
-                    (selected_sector, selected_crag)
-                )
+                route_names = tree.routes(selected_crag, selected_sector)
                 
-                if route_list:
-                    route_names = [route[0] for route in route_list]
+                if route_names:
                     selected_route = st.selectbox("Select Route", route_names)
                     
                     route_data = run_query(
@@ -505,6 +657,8 @@ elif page == "Routes":
                     )
                     
                     if route_data:
+                        show_purge_preview("route", (selected_crag, selected_sector, selected_route), "route")
+                        
                         with st.form("edit_route_form"):
                             col1, col2 = st.columns(2)
                             with col1:
@@ -570,10 +724,7 @@ elif page == "Routes":
                             
                             if delete_button:
                                 try:
-                                    run_query_no_cache(
-                                        "DELETE FROM practica.via WHERE nom = %s AND nom_sector = %s AND nom_crag_sector = %s", 
-                                        (selected_route, selected_sector, selected_crag)
-                                    )
+                                    run_purge("route", (selected_crag, selected_sector, selected_route))
                                     st.success(f"Route '{selected_route}' deleted successfully!")
                                     st.experimental_rerun()
                                 except Exception as e:
@@ -593,19 +744,33 @@ elif page == "Climbers":
     
     with tab1:
         st.subheader("All Climbers")
-        climbers = run_query("""
-            SELECT nom_usuari, data_naixement, nivell,
-                   (SELECT COUNT(*) FROM practica.intent WHERE nom_usuari_escalador = e.nom_usuari) as attempts,
-                   (SELECT COUNT(*) FROM practica.encadenament en JOIN practica.intent i ON en.id_intent = i.id_intent 
-                    WHERE i.nom_usuari_escalador = e.nom_usuari) as completions
+        
+        # Levels estimated from the completions (practica/levels.py), next to the declared one
+        level_names = list(dict.fromkeys(name for _, _, name in levels.LEVELS))
+        level_filter = st.multiselect("Estimated Level", level_names, placeholder="All")
+        level_grades = [
+            ordinal for ordinal in range(grades.MIN_ORDINAL, grades.MAX_ORDINAL + 1)
+            if levels.label(ordinal, english=True) in level_filter
+        ]
+        climbers = run_query(f"""
+            SELECT e.nom_usuari, e.data_naixement, e.nivell, l.grau_ordinal,
+                   COALESCE(s.intents, 0) as attempts,
+                   COALESCE(s.encadenaments, 0) as completions
             FROM practica.escalador e
-            ORDER BY nom_usuari
-        """)
+            LEFT JOIN practica.climber_stats s ON s.nom_usuari = e.nom_usuari
+            LEFT JOIN practica.climber_level l ON l.nom_usuari = e.nom_usuari
+            {"WHERE l.grau_ordinal = ANY(%s)" if level_filter else ""}
+            ORDER BY e.nom_usuari
+        """, (level_grades,) if level_filter else None)
         
         if climbers:
             df_climbers = pd.DataFrame(climbers, columns=[
-                "Username", "Birth Date", "Level", "Total Attempts", "Total Completions"
+                "Username", "Birth Date", "Level", "Estimated Level", "Total Attempts", "Total Completions"
             ])
+            df_climbers.insert(4, "Working Grade", grades.to_labels(df_climbers["Estimated Level"]))
+            df_climbers["Estimated Level"] = df_climbers["Estimated Level"].map(
+                lambda ordinal: levels.label(ordinal, english=True) if pd.notna(ordinal) else None
+            )
             st.dataframe(df_climbers, use_container_width=True)
         else:
             st.info("No climbers available")
@@ -648,6 +813,8 @@ elif page == "Climbers":
             )
             
             if climber_data:
+                show_purge_preview("climber", (selected_climber,), "climber")
+                
                 with st.form("edit_climber_form"):
                     password = st.text_input("Password*", value=climber_data[0][1], type="password")
                     birth_date = st.date_input(
@@ -682,7 +849,7 @@ elif page == "Climbers":
                     
                     if delete_button:
                         try:
-                            run_query_no_cache("DELETE FROM practica.escalador WHERE nom_usuari = %s", (selected_climber,))
+                            run_purge("climber", (selected_climber,))
                             st.success(f"Climber '{selected_climber}' deleted successfully!")
                             st.experimental_rerun()
                         except Exception as e:
@@ -699,51 +866,28 @@ elif page == "Attempts":
     with tab1:
         st.subheader("All Attempts")
         
-        # Filters
-        col1, col2, col3 = st.columns(3)
-        with col1:
-            climber_filter = st.selectbox(
-                "Filter by Climber", 
-                ["All"] + [climber[0] for climber in run_query("SELECT nom_usuari FROM practica.escalador ORDER BY nom_usuari")]
-            )
-        
-        with col2:
-            crag_filter = st.selectbox(
-                "Filter by Crag", 
-                ["All"] + [crag[0] for crag in run_query("SELECT nom FROM practica.crag ORDER BY nom")]
-            )
+        intent_table = archive.source("intent", include_archived)
+        encadenament_table = archive.source("encadenament", include_archived)
         
-        with col3:
-            ascent_type_filter = st.selectbox(
-                "Filter by Ascent Type",
-                ["All"] + [atype[0] for atype in run_query(
-                    "SELECT DISTINCT tipus_ascensio FROM practica.intent WHERE tipus_ascensio IS NOT NULL ORDER BY tipus_ascensio"
-                ) if atype[0]]
-            )
+        # Filters, with counts from the facet table
+        selection = facet_filters(
+            "attempts",
+            {"nom_usuari_escalador": "Filter by Climber", "nom_crag_via": "Filter by Crag", "tipus_ascensio": "Filter by Ascent Type"},
+            include_archived
+        )
         
         # Build query based on filters
-        query = """
+        query = f"""
             SELECT i.id_intent, i.nom_usuari_escalador, i.nom_via, i.nom_sector_via, i.nom_crag_via, 
                    i.tipus_ascensio, i.data_intent,
                    CASE WHEN e.id_intent IS NOT NULL THEN 'Yes' ELSE 'No' END as completed,
                    e.temps_ascensio
-            FROM practica.intent i
-            LEFT JOIN practica.encadenament e ON i.id_intent = e.id_intent
+            FROM {intent_table} i
+            LEFT JOIN {encadenament_table} e ON i.id_intent = e.id_intent
             WHERE 1=1
         """
-        params = []
-        
-        if climber_filter != "All":
-            query += " AND i.nom_usuari_escalador = %s"
-            params.append(climber_filter)
-        
-        if crag_filter != "All":
-            query += " AND i.nom_crag_via = %s"
-            params.append(crag_filter)
-        
-        if ascent_type_filter != "All":
-            query += " AND i.tipus_ascensio = %s"
-            params.append(ascent_type_filter)
+        conditions, params = facets.filter_clause(selection, "i")
+        query += conditions
             
         query += " ORDER BY i.data_intent DESC"
         
@@ -768,25 +912,19 @@ elif page == "Attempts":
             selected_climber = st.selectbox("Climber*", climber_names, key="add_attempt_climber")
             
             # Select crag
-            crag_list = run_query("SELECT nom FROM practica.crag ORDER BY nom")
-            if crag_list:
-                crag_names = [crag[0] for crag in crag_list]
+            crag_names = tree.crags()
+            if crag_names:
                 selected_crag = st.selectbox("Crag*", crag_names, key="add_attempt_crag")
                 
                 # Select sector
-                sector_list = run_query("SELECT nom FROM practica.sector WHERE nom_crag = %s ORDER BY nom", (selected_crag,))
-                if sector_list:
-                    sector_names = [sector[0] for sector in sector_list]
+                sector_names = tree.sectors(selected_crag)
+                if sector_names:
                     selected_sector = st.selectbox("Sector*", sector_names, key="add_attempt_sector")
                     
                     # Select route
-                    route_list = run_query(
-                        "SELECT nom FROM practica.via WHERE nom_sector = %s AND nom_crag_sector = %s ORDER BY nom", 
-                        (selected_sector, selected_crag)
-                    )
+                    route_names = tree.routes(selected_crag, selected_sector)
                     
-                    if route_list:
-                        route_names = [route[0] for route in route_list]
+                    if route_names:
                         selected_route = st.selectbox("Route*", route_names, key="add_attempt_route")
                         
                         with st.form("add_attempt_form"):
@@ -811,8 +949,8 @@ elif page == "Attempts":
                             
                             if submit_button:
                                 try:
-                                    # Insert attempt
-                                    run_query_no_cache(
+                                    # Insert attempt and get its ID
+                                    attempt_id = run_query_no_cache(
                                         """
                                         INSERT INTO practica.intent (
                                             tipus_ascensio, data_intent, nom_usuari_escalador, 
@@ -827,13 +965,8 @@ elif page == "Attempts":
                                             selected_route,
                                             selected_sector,
                                             selected_crag
-                                        )
-                                    )
-                                    
-                                    # Get the inserted attempt ID
-                                    attempt_id = run_query(
-                                        "SELECT id_intent FROM practica.intent WHERE nom_usuari_escalador = %s AND nom_via = %s AND nom_sector_via = %s AND nom_crag_via = %s AND data_intent = %s ORDER BY id_intent DESC LIMIT 1",
-                                        (selected_climber, selected_route, selected_sector, selected_crag, attempt_date)
+                                        ),
+                                        fetch=True
                                     )[0][0]
                                     
                                     # If completed, insert completion record
@@ -866,24 +999,10 @@ elif page == "Attempts":
             climber_names = [climber[0] for climber in climber_list]
             selected_climber = st.selectbox("Select Climber", climber_names, key="edit_attempt_climber")
             
-            # Get attempts for this climber
-            attempt_list = run_query(
-                """
-                SELECT i.id_intent, i.nom_via, i.nom_sector_via, i.nom_crag_via, i.data_intent, i.tipus_ascensio
-                FROM practica.intent i
-                WHERE i.nom_usuari_escalador = %s
-                ORDER BY i.data_intent DESC
-                """,
-                (selected_climber,)
-            )
+            # One page of this climber's attempts
+            selected_attempt_id = record_picker("attempts", selected_climber, "Select Attempt")
             
-            if attempt_list:
-                attempt_options = [f"ID: {a[0]} - {a[1]} ({a[2]}, {a[3]}) - {a[4]} - {a[5] if a[5] else 'No type'}" for a in attempt_list]
-                selected_attempt_option = st.selectbox("Select Attempt", attempt_options)
-                
-                # Extract attempt ID from the selected option
-                selected_attempt_id = int(selected_attempt_option.split(" - ")[0].replace("ID: ", ""))
-                
+            if selected_attempt_id is not None:
                 # Get attempt details
                 attempt_data = run_query(
                     """
@@ -992,7 +1111,7 @@ elif page == "Attempts":
                             except Exception as e:
                                 st.error(f"Error deleting attempt: {e}")
             else:
-                st.info(f"No attempts available for climber '{selected_climber}'")
+                st.info(f"No matching attempts for climber '{selected_climber}'")
         else:
             st.info("No climbers available")
 
@@ -1003,39 +1122,28 @@ elif page == "Completions":
     # View completions
     st.subheader("All Completions")
     
-    # Filters
-    col1, col2 = st.columns(2)
-    with col1:
-        climber_filter = st.selectbox(
-            "Filter by Climber", 
-            ["All"] + [climber[0] for climber in run_query("SELECT nom_usuari FROM practica.escalador ORDER BY nom_usuari")]
-        )
+    intent_table = archive.source("intent", include_archived)
+    encadenament_table = archive.source("encadenament", include_archived)
     
-    with col2:
-        crag_filter = st.selectbox(
-            "Filter by Crag", 
-            ["All"] + [crag[0] for crag in run_query("SELECT nom FROM practica.crag ORDER BY nom")]
-        )
+    # Filters, with counts from the facet table
+    selection = facet_filters(
+        "completions",
+        {"nom_usuari_escalador": "Filter by Climber", "nom_crag_via": "Filter by Crag", "tipus_ascensio": "Filter by Ascent Type"},
+        include_archived
+    )
+    conditions, params = facets.filter_clause(selection, "i")
     
     # Build query based on filters
-    query = """
+    query = f"""
         SELECT i.id_intent, i.nom_usuari_escalador, i.nom_via, i.nom_sector_via, i.nom_crag_via, 
                i.tipus_ascensio, i.data_intent, e.temps_ascensio,
                v.grau_dificultat
-        FROM practica.encadenament e
-        JOIN practica.intent i ON e.id_intent = i.id_intent
+        FROM {encadenament_table} e
+        JOIN {intent_table} i ON e.id_intent = i.id_intent
         JOIN practica.via v ON i.nom_via = v.nom AND i.nom_sector_via = v.nom_sector AND i.nom_crag_via = v.nom_crag_sector
         WHERE 1=1
     """
-    params = []
-    
-    if climber_filter != "All":
-        query += " AND i.nom_usuari_escalador = %s"
-        params.append(climber_filter)
-    
-    if crag_filter != "All":
-        query += " AND i.nom_crag_via = %s"
-        params.append(crag_filter)
+    query += conditions
         
     query += " ORDER BY i.data_intent DESC"
     
@@ -1056,39 +1164,39 @@ elif page == "Completions":
         with col1:
             # Completions by difficulty
             difficulty_data = run_query(
-                """
-                SELECT v.grau_dificultat, COUNT(*) as count
-                FROM practica.encadenament e
-                JOIN practica.intent i ON e.id_intent = i.id_intent
+                f"""
+                SELECT v.grau_ordinal, COUNT(*) as count
+                FROM {encadenament_table} e
+                JOIN {intent_table} i ON e.id_intent = i.id_intent
                 JOIN practica.via v ON i.nom_via = v.nom AND i.nom_sector_via = v.nom_sector AND i.nom_crag_via = v.nom_crag_sector
-                WHERE v.grau_dificultat IS NOT NULL
+                WHERE v.grau_ordinal IS NOT NULL
                 """ + 
-                (" AND i.nom_usuari_escalador = %s" if climber_filter != "All" else "") +
-                (" AND i.nom_crag_via = %s" if crag_filter != "All" else "") +
+                conditions +
                 """
-                GROUP BY v.grau_dificultat
-                ORDER BY v.grau_dificultat
+                GROUP BY v.grau_ordinal
+                ORDER BY v.grau_ordinal
                 """,
                 tuple(params) if params else None
             )
             
             if difficulty_data:
-                df_difficulty = pd.DataFrame(difficulty_data, columns=["Difficulty", "Count"])
+                df_difficulty = pd.DataFrame(difficulty_data, columns=["Grade", "Count"])
+                df_difficulty["Difficulty"] = grades.to_labels(df_difficulty["Grade"])
                 fig = px.bar(df_difficulty, x="Difficulty", y="Count", color="Count",
                             title="Completions by Difficulty Grade")
+                fig.update_xaxes(type="category")
                 st.plotly_chart(fig, use_container_width=True)
         
         with col2:
             # Completions by ascent type
             ascent_type_data = run_query(
-                """
+                f"""
                 SELECT i.tipus_ascensio, COUNT(*) as count
-                FROM practica.encadenament e
-                JOIN practica.intent i ON e.id_intent = i.id_intent
+                FROM {encadenament_table} e
+                JOIN {intent_table} i ON e.id_intent = i.id_intent
                 WHERE i.tipus_ascensio IS NOT NULL
                 """ + 
-                (" AND i.nom_usuari_escalador = %s" if climber_filter != "All" else "") +
-                (" AND i.nom_crag_via = %s" if crag_filter != "All" else "") +
+                conditions +
                 """
                 GROUP BY i.tipus_ascensio
                 ORDER BY count DESC
@@ -1101,6 +1209,63 @@ elif page == "Completions":
                 fig = px.pie(df_ascent_type, values="Count", names="Ascent Type",
                             title="Completions by Ascent Type")
                 st.plotly_chart(fig, use_container_width=True)
+
+        # Send times from the ascent-time digests, which cover every climber
+        st.subheader("Ascent Times")
+        grade_times = run_query(
+            "SELECT grau_ordinal, n, encode(digest, 'hex') FROM practica.grade_ascent_time ORDER BY grau_ordinal"
+        )
+        if grade_times:
+            df_times = pd.DataFrame(
+                [(ordinal, n) + ascent_times.summary(digest) for ordinal, n, digest in grade_times],
+                columns=["Grade", "Timed Completions", "Median", "P90"]
+            )
+            df_times["Difficulty"] = grades.to_labels(df_times["Grade"])
+            df_times[["Median", "P90"]] = df_times[["Median", "P90"]] / 60
+            fig = px.bar(df_times, x="Difficulty", y=["Median", "P90"], barmode="group",
+                        labels={"value": "Minutes", "variable": ""},
+                        hover_data=["Timed Completions"],
+                        title="Ascent Times by Grade")
+            fig.update_xaxes(type="category")
+            st.plotly_chart(fig, use_container_width=True)
+
+        if selection["nom_crag_via"]:
+            route_times = run_query(
+                """
+                SELECT nom_crag_via, nom_via, nom_sector_via, n, encode(digest, 'hex')
+                FROM practica.route_ascent_time
+                WHERE nom_crag_via = ANY(%s)
+                ORDER BY nom_crag_via, nom_sector_via, nom_via
+                """,
+                (selection["nom_crag_via"],)
+            )
+            if route_times:
+                st.dataframe(pd.DataFrame(
+                    [
+                        (crag, route, sector, n) + tuple(map(ascent_times.format_duration, ascent_times.summary(digest)))
+                        for crag, route, sector, n, digest in route_times
+                    ],
+                    columns=["Crag", "Route", "Sector", "Timed Completions", "Median", "P90"]
+                ), use_container_width=True)
+
+        # Effort to send per grade, from the redpoint journeys under the same filters
+        st.subheader("Effort per Grade")
+        if not include_archived:
+            st.caption("Journeys count every attempt, archived ones included.")
+        effort = run_query(*journeys.journey_effort_query(
+            climbers=selection["nom_usuari_escalador"],
+            crags=selection["nom_crag_via"],
+            ascent_types=selection["tipus_ascensio"]
+        ))
+        if effort:
+            df_effort = pd.DataFrame(effort, columns=["Grade", "Sends", "Avg Attempts", "Avg Days", "First Try"])
+            df_effort["Difficulty"] = grades.to_labels(df_effort["Grade"])
+            fig = px.bar(df_effort, x="Difficulty", y=["Avg Attempts", "Avg Days"], barmode="group",
+                        labels={"value": "Average to Send", "variable": ""},
+                        hover_data=["Sends", "First Try"],
+                        title="Attempts and Days to Send by Grade")
+            fig.update_xaxes(type="category")
+            st.plotly_chart(fig, use_container_width=True)
     else:
         st.info("No completions available with the selected filters")
 
@@ -1113,48 +1278,46 @@ elif page == "Comments":
     with tab1:
         st.subheader("All Comments")
         
-        # Filters
-        col1, col2 = st.columns(2)
-        with col1:
-            climber_filter = st.selectbox(
-                "Filter by Climber", 
-                ["All"] + [climber[0] for climber in run_query("SELECT nom_usuari FROM practica.escalador ORDER BY nom_usuari")]
-            )
-        
-        with col2:
-            crag_filter = st.selectbox(
-                "Filter by Crag", 
-                ["All"] + [crag[0] for crag in run_query("SELECT nom FROM practica.crag ORDER BY nom")]
-            )
-        
-        # Build query based on filters
-        query = """
-            SELECT c.id_comentari, c.nom_usuari_escalador, c.nom_via, c.nom_sector_via, c.nom_crag_via, 
-                   c.text_comentari, c.data_comentari
-            FROM practica.comentari c
-            WHERE 1=1
-        """
-        params = []
-        
-        if climber_filter != "All":
-            query += " AND c.nom_usuari_escalador = %s"
-            params.append(climber_filter)
-        
-        if crag_filter != "All":
-            query += " AND c.nom_crag_via = %s"
-            params.append(crag_filter)
-            
-        query += " ORDER BY c.data_comentari DESC"
+        # Filters, with counts from the facet table
+        selection = facet_filters(
+            "comments",
+            {"nom_usuari_escalador": "Filter by Climber", "nom_crag_via": "Filter by Crag"},
+            include_archived
+        )
+        conditions, params = facets.filter_clause(selection, "c")
         
-        comments = run_query(query, tuple(params) if params else None)
+        # Full-text search within the filtered comments (see practica/search.py)
+        search_text = st.text_input("Search comments", placeholder="e.g. polished crux, presa petita, roca mala")
         
-        if comments:
-            df_comments = pd.DataFrame(comments, columns=[
-                "ID", "Climber", "Route", "Sector", "Crag", "Comment", "Date"
-            ])
-            st.dataframe(df_comments, use_container_width=True)
+        if search_text.strip():
+            results = run_query(*search.comment_search_query(search_text, include_archived, conditions, params))
+            if results:
+                st.caption(f"{len(results)} best matches")
+                for _, climber, route, sector, crag, date, snippet, rank in results:
+                    st.markdown(f"**{climber}** on *{route}* ({sector}, {crag}) · {date:%Y-%m-%d}  \n{snippet}")
+            else:
+                st.info("No comments match your search")
         else:
-            st.info("No comments available with the selected filters")
+            # Build query based on filters
+            query = f"""
+                SELECT c.id_comentari, c.nom_usuari_escalador, c.nom_via, c.nom_sector_via, c.nom_crag_via, 
+                       c.text_comentari, c.data_comentari
+                FROM {archive.source("comentari", include_archived)} c
+                WHERE 1=1
+            """
+            query += conditions
+                
+            query += " ORDER BY c.data_comentari DESC"
+            
+            comments = run_query(query, tuple(params) if params else None)
+            
+            if comments:
+                df_comments = pd.DataFrame(comments, columns=[
+                    "ID", "Climber", "Route", "Sector", "Crag", "Comment", "Date"
+                ])
+                st.dataframe(df_comments, use_container_width=True)
+            else:
+                st.info("No comments available with the selected filters")
     
     with tab2:
         st.subheader("Add New Comment")
@@ -1166,25 +1329,19 @@ elif page == "Comments":
             selected_climber = st.selectbox("Climber*", climber_names, key="add_comment_climber")
             
             # Select crag
-            crag_list = run_query("SELECT nom FROM practica.crag ORDER BY nom")
-            if crag_list:
-                crag_names = [crag[0] for crag in crag_list]
+            crag_names = tree.crags()
+            if crag_names:
                 selected_crag = st.selectbox("Crag*", crag_names, key="add_comment_crag")
                 
                 # Select sector
-                sector_list = run_query("SELECT nom FROM practica.sector WHERE nom_crag = %s ORDER BY nom", (selected_crag,))
-                if sector_list:
-                    sector_names = [sector[0] for sector in sector_list]
+                sector_names = tree.sectors(selected_crag)
+                if sector_names:
                     selected_sector = st.selectbox("Sector*", sector_names, key="add_comment_sector")
                     
                     # Select route
-                    route_list = run_query(
-                        "SELECT nom FROM practica.via WHERE nom_sector = %s AND nom_crag_sector = %s ORDER BY nom", 
-                        (selected_sector, selected_crag)
-                    )
+                    route_names = tree.routes(selected_crag, selected_sector)
                     
-                    if route_list:
-                        route_names = [route[0] for route in route_list]
+                    if route_names:
                         selected_route = st.selectbox("Route*", route_names, key="add_comment_route")
                         
                         with st.form("add_comment_form"):
@@ -1234,28 +1391,10 @@ elif page == "Comments":
             climber_names = [climber[0] for climber in climber_list]
             selected_climber = st.selectbox("Select Climber", climber_names, key="edit_comment_climber")
             
-            # Get comments for this climber
-            comment_list = run_query(
-                """
-                SELECT c.id_comentari, c.nom_via, c.nom_sector_via, c.nom_crag_via, 
-                       c.data_comentari, LEFT(c.text_comentari, 50) as preview
-                FROM practica.comentari c
-                WHERE c.nom_usuari_escalador = %s
-                ORDER BY c.data_comentari DESC
-                """,
-                (selected_climber,)
-            )
+            # One page of this climber's comments
+            selected_comment_id = record_picker("comments", selected_climber, "Select Comment")
             
-            if comment_list:
-                comment_options = [
-                    f"ID: {c[0]} - {c[1]} ({c[2]}, {c[3]}) - {c[4]} - {c[5]}{'...' if len(c[5]) >= 50 else ''}" 
-                    for c in comment_list
-                ]
-                selected_comment_option = st.selectbox("Select Comment", comment_options)
-                
-                # Extract comment ID from the selected option
-                selected_comment_id = int(selected_comment_option.split(" - ")[0].replace("ID: ", ""))
-                
+            if selected_comment_id is not None:
                 # Get comment details
                 comment_data = run_query(
                     "SELECT text_comentari FROM practica.comentari WHERE id_comentari = %s",
@@ -1297,7 +1436,7 @@ elif page == "Comments":
                             except Exception as e:
                                 st.error(f"Error deleting comment: {e}")
             else:
-                st.info(f"No comments available for climber '{selected_climber}'")
+                st.info(f"No matching comments for climber '{selected_climber}'")
         else:
             st.info("No climbers available")
 
@@ -1310,36 +1449,24 @@ elif page == "Recommendations":
     with tab1:
         st.subheader("All Recommendations")
         
-        # Filters
-        col1, col2 = st.columns(2)
-        with col1:
-            climber_filter = st.selectbox(
-                "Filter by Climber", 
-                ["All"] + [climber[0] for climber in run_query("SELECT nom_usuari FROM practica.escalador ORDER BY nom_usuari")]
-            )
+        recomanacio_table = archive.source("recomanacio", include_archived)
         
-        with col2:
-            crag_filter = st.selectbox(
-                "Filter by Crag", 
-                ["All"] + [crag[0] for crag in run_query("SELECT nom FROM practica.crag ORDER BY nom")]
-            )
+        # Filters, with counts from the facet table
+        selection = facet_filters(
+            "recommendations",
+            {"nom_usuari_escalador": "Filter by Climber", "nom_crag_via": "Filter by Crag"},
+            include_archived
+        )
         
         # Build query based on filters
-        query = """
+        query = f"""
             SELECT r.id_recomanacio, r.nom_usuari_escalador, r.nom_via, r.nom_sector_via, r.nom_crag_via, 
                    r.puntuacio, r.descripcio_recomanacio, r.data_recomanacio
-            FROM practica.recomanacio r
+            FROM {recomanacio_table} r
             WHERE 1=1
         """
-        params = []
-        
-        if climber_filter != "All":
-            query += " AND r.nom_usuari_escalador = %s"
-            params.append(climber_filter)
-        
-        if crag_filter != "All":
-            query += " AND r.nom_crag_via = %s"
-            params.append(crag_filter)
+        conditions, params = facets.filter_clause(selection, "r")
+        query += conditions
             
         query += " ORDER BY r.data_recomanacio DESC"
         
@@ -1357,22 +1484,31 @@ elif page == "Recommendations":
             col1, col2 = st.columns(2)
             
             with col1:
-                # Average rating by route
-                avg_ratings = run_query(
-                    """
-                                        SELECT r.nom_via, r.nom_sector_via, r.nom_crag_via, AVG(r.puntuacio) as avg_rating, COUNT(*) as count
-                    FROM practica.recomanacio r
-                    WHERE 1=1
-                    """ + 
-                    (" AND r.nom_usuari_escalador = %s" if climber_filter != "All" else "") +
-                    (" AND r.nom_crag_via = %s" if crag_filter != "All" else "") +
-                    """
-                    GROUP BY r.nom_via, r.nom_sector_via, r.nom_crag_via
-                    ORDER BY avg_rating DESC
-                    LIMIT 10
-                    """,
-                    tuple(params) if params else None
-                )
+                # Average rating by route: the aggregate store when no climber is selected
+                if not selection["nom_usuari_escalador"]:
+                    crags = selection["nom_crag_via"]
+                    avg_ratings = [
+                        (route, sector, crag, average, count)
+                        for route, sector, crag, _, average, count in run_query(
+                            ratings.top_routes_query(by_crag=bool(crags)),
+                            (crags, 10) if crags else (10,)
+                        )
+                    ]
+                else:
+                    avg_ratings = run_query(
+                        f"""
+                                            SELECT r.nom_via, r.nom_sector_via, r.nom_crag_via, AVG(r.puntuacio) as avg_rating, COUNT(*) as count
+                        FROM {recomanacio_table} r
+                        WHERE 1=1
+                        """ + 
+                        conditions +
+                        """
+                        GROUP BY r.nom_via, r.nom_sector_via, r.nom_crag_via
+                        ORDER BY avg_rating DESC
+                        LIMIT 10
+                        """,
+                        tuple(params) if params else None
+                    )
                 
                 if avg_ratings:
                     df_avg_ratings = pd.DataFrame(avg_ratings, columns=["Route", "Sector", "Crag", "Average Rating", "Count"])
@@ -1383,13 +1519,12 @@ elif page == "Recommendations":
             with col2:
                 # Rating distribution
                 rating_dist = run_query(
-                    """
+                    f"""
                     SELECT r.puntuacio, COUNT(*) as count
-                    FROM practica.recomanacio r
+                    FROM {recomanacio_table} r
                     WHERE 1=1
                     """ + 
-                    (" AND r.nom_usuari_escalador = %s" if climber_filter != "All" else "") +
-                    (" AND r.nom_crag_via = %s" if crag_filter != "All" else "") +
+                    conditions +
                     """
                     GROUP BY r.puntuacio
                     ORDER BY r.puntuacio
@@ -1415,25 +1550,19 @@ elif page == "Recommendations":
             selected_climber = st.selectbox("Climber*", climber_names, key="add_rec_climber")
             
             # Select crag
-            crag_list = run_query("SELECT nom FROM practica.crag ORDER BY nom")
-            if crag_list:
-                crag_names = [crag[0] for crag in crag_list]
+            crag_names = tree.crags()
+            if crag_names:
                 selected_crag = st.selectbox("Crag*", crag_names, key="add_rec_crag")
                 
                 # Select sector
-                sector_list = run_query("SELECT nom FROM practica.sector WHERE nom_crag = %s ORDER BY nom", (selected_crag,))
-                if sector_list:
-                    sector_names = [sector[0] for sector in sector_list]
+                sector_names = tree.sectors(selected_crag)
+                if sector_names:
                     selected_sector = st.selectbox("Sector*", sector_names, key="add_rec_sector")
                     
                     # Select route
-                    route_list = run_query(
-                        "SELECT nom FROM practica.via WHERE nom_sector = %s AND nom_crag_sector = %s ORDER BY nom", 
-                        (selected_sector, selected_crag)
-                    )
+                    route_names = tree.routes(selected_crag, selected_sector)
                     
-                    if route_list:
-                        route_names = [route[0] for route in route_list]
+                    if route_names:
                         selected_route = st.selectbox("Route*", route_names, key="add_rec_route")
                         
                         # Check if recommendation already exists
@@ -1494,28 +1623,10 @@ elif page == "Recommendations":
             climber_names = [climber[0] for climber in climber_list]
             selected_climber = st.selectbox("Select Climber", climber_names, key="edit_rec_climber")
             
-            # Get recommendations for this climber
-            rec_list = run_query(
-                """
-                SELECT r.id_recomanacio, r.nom_via, r.nom_sector_via, r.nom_crag_via, 
-                       r.puntuacio, r.data_recomanacio
-                FROM practica.recomanacio r
-                WHERE r.nom_usuari_escalador = %s
-                ORDER BY r.data_recomanacio DESC
-                """,
-                (selected_climber,)
-            )
+            # One page of this climber's recommendations
+            selected_rec_id = record_picker("recommendations", selected_climber, "Select Recommendation")
             
-            if rec_list:
-                rec_options = [
-                    f"ID: {r[0]} - {r[1]} ({r[2]}, {r[3]}) - Rating: {r[4]} - {r[5]}" 
-                    for r in rec_list
-                ]
-                selected_rec_option = st.selectbox("Select Recommendation", rec_options)
-                
-                # Extract recommendation ID from the selected option
-                selected_rec_id = int(selected_rec_option.split(" - ")[0].replace("ID: ", ""))
-                
+            if selected_rec_id is not None:
                 # Get recommendation details
                 rec_data = run_query(
                     "SELECT puntuacio, descripcio_recomanacio FROM practica.recomanacio WHERE id_recomanacio = %s",
@@ -1555,10 +1666,172 @@ elif page == "Recommendations":
                             except Exception as e:
                                 st.error(f"Error deleting recommendation: {e}")
             else:
-                st.info(f"No recommendations available for climber '{selected_climber}'")
+                st.info(f"No matching recommendations for climber '{selected_climber}'")
         else:
             st.info("No climbers available")
 
+# Leaderboards page
+elif page == "Leaderboards":
+    st.header("Climber Leaderboards")
+    st.caption("Kept up to date from the change log, see practica/leaderboards.py.")
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        crag = st.selectbox(
+            "Crag", 
+            ["All crags"] + tree.crags()
+        )
+    crag_scope = leaderboards.ALL if crag == "All crags" else crag
+    
+    with col2:
+        month = st.selectbox(
+            "Month", 
+            ["All time"] + [month[0] for month in run_query(leaderboards.MONTHS, (crag_scope,))]
+        )
+    month_scope = leaderboards.ALL if month == "All time" else month
+    
+    limit = st.slider("Climbers per board", 5, 50, 10)
+    
+    for col, (board, title) in zip(st.columns(len(leaderboards.BOARDS)), leaderboards.BOARDS.items()):
+        with col:
+            st.subheader(title)
+            entries = run_query(leaderboards.board_query(board), (crag_scope, month_scope, limit))
+            if entries:
+                df_board = pd.DataFrame(entries, columns=["Climber", "Completions", "Routes", "Hardest"])
+                df_board["Hardest"] = grades.to_labels(df_board["Hardest"])
+                df_board.index = range(1, len(df_board) + 1)
+                st.dataframe(df_board, use_container_width=True)
+            else:
+                st.info("No completions for the selected filters")
+
+# Analytics page
+elif page == "Analytics":
+    st.header("Activity Analytics")
+    st.caption("Read from the pre-aggregated activity cube; drill down by place and by time.")
+    
+    # Each level's options are the groups of the level above
+    def cube_breakdown(place, period, by):
+        query, params = cube.breakdown_query(place, period, by)
+        rows = run_query(query, params)
+        return pd.DataFrame(rows, columns=["Group", "Attempts", "Completions", "Comments", "Recommendations", "Average Rating"])
+    
+    # Approximate unique climbers per group, merged from the per route and day sketches
+    def cube_climbers(place, period, by=None):
+        return hll.estimate_groups(run_query(*cube.climber_sketches_query(place, period, by)))
+    
+    place = ()
+    period = ()
+    
+    col1, col2, col3 = st.columns(3)
+    for col, label in zip([col1, col2, col3], ["Crag", "Sector", "Route"]):
+        with col:
+            options = cube_breakdown(place, (), "place")["Group"].tolist()
+            choice = st.selectbox(label, ["All"] + options)
+        if choice == "All":
+            break
+        place += (choice,)
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        years = [group.year for group in cube_breakdown(place, (), "time")["Group"]]
+        year = st.selectbox("Year", ["All"] + years)
+    if year != "All":
+        period = (year,)
+        with col2:
+            months = [group.month for group in cube_breakdown(place, period, "time")["Group"]]
+            month = st.selectbox("Month", ["All"] + months)
+        if month != "All":
+            period = (year, month)
+    
+    by_place = cube_breakdown(place, period, "place")
+    
+    if not by_place.empty:
+        by_place["Active Climbers"] = by_place["Group"].map(cube_climbers(place, period, "place")).fillna(0).astype(int)
+        climbers = cube_climbers(place, period).get("all", 0)
+        col1, col2, col3, col4, col5 = st.columns(5)
+        col1.metric("Attempts", int(by_place["Attempts"].sum()))
+        col2.metric("Completions", int(by_place["Completions"].sum()))
+        col3.metric("Comments", int(by_place["Comments"].sum()))
+        col4.metric("Recommendations", int(by_place["Recommendations"].sum()))
+        col5.metric(
+            "Active Climbers", f"≈ {climbers}",
+            help=f"Climbers who attempted, rated or commented. HyperLogLog estimate, standard error {hll.STANDARD_ERROR:.1%}"
+        )
+        
+        col1, col2 = st.columns(2)
+        with col1:
+            level = ["Crag", "Sector", "Route"][min(len(place), 2)]
+            fig = px.bar(by_place, x="Group", y=["Attempts", "Completions"], barmode="group",
+                        labels={"Group": level, "value": "Count"}, title=f"Activity by {level}")
+            st.plotly_chart(fig, use_container_width=True)
+        with col2:
+            by_time = cube_breakdown(place, period, "time")
+            grain = ["Year", "Month", "Day"][len(period)]
+            fig = px.line(by_time, x="Group", y=["Attempts", "Completions", "Comments", "Recommendations"], markers=True,
+                         labels={"Group": grain, "value": "Count"}, title=f"Activity by {grain}")
+            st.plotly_chart(fig, use_container_width=True)
+        
+        by_place = by_place.rename(columns={"Group": level})
+        st.dataframe(by_place, use_container_width=True)
+    else:
+        st.info("No activity for the selected filters")
+
+# Integrity page
+elif page == "Integrity":
+    st.header("Referential Integrity")
+    
+    if not integrity_installed():
+        st.warning("The integrity scanner isn't installed: run python -m practica first")
+        st.stop()
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        if st.button("Scan Changes"):
+            with st.spinner("Scanning rows added or changed since the last scan..."):
+                resolved = integrity.resolve(init_connection())
+                found = integrity.scan(init_connection())
+            remember_write(init_connection())
+            run_query.clear()
+            st.success(f"Scan finished: {sum(found.values())} new orphans, {resolved} resolved")
+    with col2:
+        if st.button("Full Rescan", type="primary"):
+            with st.spinner("Rescanning all rows..."):
+                resolved = integrity.resolve(init_connection())
+                found = integrity.scan(init_connection(), full=True)
+            remember_write(init_connection())
+            run_query.clear()
+            st.success(f"Rescan finished: {sum(found.values())} new orphans, {resolved} resolved")
+    
+    st.subheader("Scan Status")
+    scan_status = integrity.summary(init_connection())
+    if scan_status:
+        df_status = pd.DataFrame(scan_status, columns=["Table", "Scanned Up To ID", "Last Scan", "Orphans"])
+        st.dataframe(df_status, use_container_width=True)
+    
+    st.subheader("Orphaned Rows")
+    table_filter = st.selectbox("Filter by Table", ["All"] + list(integrity.CHECKS))
+    
+    query = """
+        SELECT table_name, row_id, reason, detected_at
+        FROM practica.integrity_orphan
+        WHERE 1=1
+    """
+    params = []
+    
+    if table_filter != "All":
+        query += " AND table_name = %s"
+        params.append(table_filter)
+    
+    query += " ORDER BY detected_at DESC, table_name, row_id LIMIT 1000"
+    
+    orphans = run_query(query, tuple(params) if params else None)
+    
+    if orphans:
+        df_orphans = pd.DataFrame(orphans, columns=["Table", "Row ID", "Reason", "Detected At"])
+        st.dataframe(df_orphans, use_container_width=True)
+    else:
+        st.info("No orphaned rows found")
+
 # Add footer
 st.markdown("---")
 st.markdown("### 🧗‍♂️ Climbing Database Management System")
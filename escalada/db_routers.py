@@ -0,0 +1,71 @@
+"""
+Primary/replica database routing for the escalada project.
+
+Writes go to 'default' (the primary). Reads go to the 'replica*' aliases
+configured in settings from DB_REPLICA_HOSTS, with the same read-your-writes
+policy as adminApp and userApp (see practica/routing.py): ReadYourWritesMiddleware
+keeps the primary's WAL position after a request that wrote in the user's
+session, and later requests only read from a replica that has replayed it.
+"""
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+
+from practica import routing
+
+# Alias reads should use during the current request, and whether it wrote
+_read_alias = ContextVar('read_alias', default='default')
+_wrote = ContextVar('wrote', default=False)
+
+
+def replica_aliases():
+    return [alias for alias in settings.DATABASES if alias.startswith('replica')]
+
+
+def alias_caught_up(alias, min_lsn):
+    # A broken connection is closed, so Django reconnects on the next try
+    try:
+        with connections[alias].cursor() as cursor:
+            return routing.caught_up(cursor, min_lsn)
+    except Exception:
+        connections[alias].close()
+        raise
+
+
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        return _read_alias.get()
+
+    def db_for_write(self, model, **hints):
+        # Once a request has written, the rest of it reads from the primary too
+        _wrote.set(True)
+        _read_alias.set('default')
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Every alias holds the same data
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == 'default'
+
+
+class ReadYourWritesMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        min_lsn = request.session.get('write_lsn')
+        replica = routing.choose(replica_aliases(), min_lsn, alias_caught_up)
+        read_token = _read_alias.set(replica or 'default')
+        wrote_token = _wrote.set(False)
+        try:
+            response = self.get_response(request)
+            if _wrote.get():
+                with connections['default'].cursor() as cursor:
+                    request.session['write_lsn'] = routing.current_lsn(cursor)
+        finally:
+            _read_alias.reset(read_token)
+            _wrote.reset(wrote_token)
+        return response
@@ -0,0 +1,14 @@
+# Creates everything adminApp and userApp expect in the practica schema on top
+# of the base tables. Every installer is idempotent, so this can be re-run
+# after pulling new changes:
+#
+#     python -m practica
+from practica import activity, archive, ascent_times, catalog, cdc, consensus, counters, cube, db, facets, grades, integrity, journeys, leaderboards, levels, partners, pickers, ratings, search, similar, suggestions, trending, typeahead
+
+INSTALLERS = [grades, archive, search, cdc, integrity, counters, ratings, activity, cube, ascent_times, facets, trending, leaderboards, typeahead, pickers, catalog, suggestions, similar, levels, partners, journeys, consensus]
+
+if __name__ == "__main__":
+    conn = db.connect()
+    for module in INSTALLERS:
+        module.install(conn)
+        print(f"Installed {module.__name__}")
@@ -0,0 +1,173 @@
+# Route x month activity rollup.
+#
+# practica.route_activity_month holds, for every route and calendar month, the
+# number of attempts, completions, recommendations, comments and the sum and
+# count of the ratings given that month. The cdc engine applies the deltas of
+# every change to intent, encadenament, recomanacio and comentari, so the
+# userApp dashboard reads last month's slice straight from the rollup
+# instead of joining the activity tables on date_trunc('month', ...).
+#
+# Completions count in the month of their attempt. Archived rows stay counted.
+import argparse
+import sys
+
+from practica import archive, cdc, db
+
+NAME = "activity"
+
+TABLES = ["intent", "encadenament", "recomanacio", "comentari"]
+
+KEY = "nom_via, nom_sector_via, nom_crag_via"
+
+DDL = f"""
+CREATE TABLE IF NOT EXISTS practica.route_activity_month (
+    nom_via         varchar(255) NOT NULL,
+    nom_sector_via  varchar(255) NOT NULL,
+    nom_crag_via    varchar(255) NOT NULL,
+    mes             date NOT NULL,
+    intents         bigint NOT NULL DEFAULT 0,
+    encadenaments   bigint NOT NULL DEFAULT 0,
+    recomanacions   bigint NOT NULL DEFAULT 0,
+    rating_sum      bigint NOT NULL DEFAULT 0,
+    rating_count    bigint NOT NULL DEFAULT 0,
+    comentaris      bigint NOT NULL DEFAULT 0,
+    PRIMARY KEY ({KEY}, mes)
+);
+CREATE INDEX IF NOT EXISTS route_activity_month_mes_idx
+    ON practica.route_activity_month (mes, intents DESC);
+"""
+
+
+# A rollup keyed by route and period: (name, table, period column, date_trunc unit)
+MONTH = ("route_activity", "practica.route_activity_month", "mes", "month")
+
+
+# Adds sign * the measures of the rows in source (aliased r for the route key
+# and date) to the rollup
+def delta(rollup, source, date, measures, sign=1):
+    _, table, period, unit = rollup
+    columns = ", ".join(measures)
+    values = ", ".join(f"{sign} * {expr}" for expr in measures.values())
+    updates = ", ".join(f"{col} = m.{col} + EXCLUDED.{col}" for col in measures)
+    return f"""
+        INSERT INTO {table} AS m ({KEY}, {period}, {columns})
+        SELECT r.nom_via, r.nom_sector_via, r.nom_crag_via, date_trunc('{unit}', {date})::date, {values}
+        FROM {source}
+        GROUP BY 1, 2, 3, 4
+        ON CONFLICT ({KEY}, {period}) DO UPDATE SET {updates};
+    """
+
+
+# Sources of a rollup's measures: (rows, date column, measures) for the rows
+# changed with the given sign. Completions count in their attempt's period.
+def _sources(sign):
+    return [
+        (f"{cdc.rows('intent', sign)} r", "r.data_intent", {"intents": "COUNT(*)"}),
+        (f"{cdc.completions(sign)} r", "r.data_intent", {"encadenaments": "COUNT(*)"}),
+        _recomanacio(cdc.rows("recomanacio", sign)),
+        _comentari(cdc.rows("comentari", sign)),
+    ]
+
+
+def _recomanacio(rows):
+    return (
+        f"{rows} r",
+        "r.data_recomanacio",
+        {"recomanacions": "COUNT(*)", "rating_sum": "COALESCE(SUM(r.puntuacio), 0)", "rating_count": "COUNT(r.puntuacio)"},
+    )
+
+
+def _comentari(rows):
+    return f"{rows} r", "r.data_comentari", {"comentaris": "COUNT(*)"}
+
+
+# Apply the current cdc batch to a rollup.
+# extra(table, rows, sign), if given, returns more statements to run for the
+# changed rows of each table.
+def apply_rollup(cur, rollup, extra=None):
+    for sign in (1, -1):
+        for source, date, measures in _sources(sign):
+            cur.execute(delta(rollup, source, date, measures, sign))
+        if extra:
+            for table in TABLES:
+                statements = extra(table, cdc.rows(table, sign), sign)
+                if statements:
+                    cur.execute(statements)
+
+
+# Triggers that maintained a rollup before the change log
+LEGACY = """
+DROP TRIGGER IF EXISTS {name}_insert ON practica.{table};
+DROP TRIGGER IF EXISTS {name}_update ON practica.{table};
+DROP TRIGGER IF EXISTS {name}_delete ON practica.{table};
+DROP FUNCTION IF EXISTS practica.{name}_{table}();
+"""
+
+LEGACY_INTENT_DELETED = """
+DROP TRIGGER IF EXISTS {name}_intent_deleted ON practica.intent;
+DROP FUNCTION IF EXISTS practica.{name}_intent_deleted();
+"""
+
+
+def drop_legacy_triggers(cur, rollup):
+    for table in TABLES:
+        cur.execute(LEGACY.format(name=rollup[0], table=table))
+    cur.execute(LEGACY_INTENT_DELETED.format(name=rollup[0]))
+
+
+# Activity of every route in one month, busiest first
+MONTH_SLICE = """
+    SELECT nom_via, nom_sector_via, nom_crag_via, TO_CHAR(mes, 'YYYY-MM'),
+           intents, recomanacions, ROUND(rating_sum::numeric / NULLIF(rating_count, 0), 2), comentaris
+    FROM practica.route_activity_month
+    WHERE mes = %s AND intents > 0
+    ORDER BY intents DESC
+"""
+
+
+# Refill a rollup from the activity tables, archived rows included
+def refill_rollup(cur, rollup, archived):
+    cur.execute(f"TRUNCATE {rollup[1]}")
+    intent_table = archive.source("intent", archived)
+    encadenament_table = archive.source("encadenament", archived)
+    cur.execute(delta(
+        rollup,
+        f"{intent_table} r LEFT JOIN {encadenament_table} e ON e.id_intent = r.id_intent",
+        "r.data_intent",
+        {"intents": "COUNT(*)", "encadenaments": "COUNT(e.id_intent)"},
+    ))
+    cur.execute(delta(rollup, *_recomanacio(archive.source("recomanacio", archived))))
+    cur.execute(delta(rollup, *_comentari(archive.source("comentari", archived))))
+
+
+def refill(cur, archived):
+    refill_rollup(cur, MONTH, archived)
+
+
+def apply_changes(cur):
+    apply_rollup(cur, MONTH)
+
+
+def install(conn):
+    cdc.install(conn)
+    with conn.cursor() as cur:
+        cur.execute(DDL)
+        drop_legacy_triggers(cur, MONTH)
+    conn.commit()
+    cdc.subscribe(conn, sys.modules[__name__])
+
+
+# Recompute the whole rollup from the activity tables, archived rows included
+def rebuild(conn):
+    cdc.subscribe(conn, sys.modules[__name__], rebuild=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the route x month activity rollup")
+    parser.add_argument("--rebuild", action="store_true", help="recompute everything from the activity tables")
+    args = parser.parse_args()
+
+    conn = db.connect()
+    install(conn)
+    if args.rebuild:
+        rebuild(conn)
@@ -0,0 +1,175 @@
+# Cold-data archival for attempts, completions, comments and recommendations.
+#
+# Rows older than the horizon are moved in batches into <table>_archive, which
+# carry the same columns but only a unique id index, a BRIN index on the date
+# and a climber index, so the hot tables and their indexes stay small.
+# <table>_all views put both halves back together for the pages that offer
+# an "include archived" switch.
+import argparse
+import os
+from datetime import date, timedelta
+
+from practica import db
+
+DEFAULT_HORIZON_DAYS = int(os.getenv("ARCHIVE_HORIZON_DAYS", "730"))
+DEFAULT_BATCH_SIZE = 5000
+
+# Tables archived on their own: table -> (id column, date column).
+# Attempts and completions are handled together by MOVE_ATTEMPTS.
+TABLES = {
+    "comentari": ("id_comentari", "data_comentari"),
+    "recomanacio": ("id_recomanacio", "data_recomanacio"),
+}
+
+DDL = """
+CREATE TABLE IF NOT EXISTS practica.intent_archive (LIKE practica.intent);
+CREATE UNIQUE INDEX IF NOT EXISTS intent_archive_id_idx ON practica.intent_archive (id_intent);
+CREATE INDEX IF NOT EXISTS intent_archive_data_idx ON practica.intent_archive USING brin (data_intent);
+CREATE INDEX IF NOT EXISTS intent_archive_escalador_idx ON practica.intent_archive (nom_usuari_escalador);
+
+CREATE TABLE IF NOT EXISTS practica.encadenament_archive (LIKE practica.encadenament);
+CREATE UNIQUE INDEX IF NOT EXISTS encadenament_archive_id_idx ON practica.encadenament_archive (id_intent);
+
+CREATE TABLE IF NOT EXISTS practica.comentari_archive (LIKE practica.comentari);
+CREATE UNIQUE INDEX IF NOT EXISTS comentari_archive_id_idx ON practica.comentari_archive (id_comentari);
+CREATE INDEX IF NOT EXISTS comentari_archive_data_idx ON practica.comentari_archive USING brin (data_comentari);
+CREATE INDEX IF NOT EXISTS comentari_archive_escalador_idx ON practica.comentari_archive (nom_usuari_escalador);
+
+CREATE TABLE IF NOT EXISTS practica.recomanacio_archive (LIKE practica.recomanacio);
+CREATE UNIQUE INDEX IF NOT EXISTS recomanacio_archive_id_idx ON practica.recomanacio_archive (id_recomanacio);
+CREATE INDEX IF NOT EXISTS recomanacio_archive_data_idx ON practica.recomanacio_archive USING brin (data_recomanacio);
+CREATE INDEX IF NOT EXISTS recomanacio_archive_escalador_idx ON practica.recomanacio_archive (nom_usuari_escalador);
+
+-- A climber rates a route once (unique_recomanacio_escalador_via), archived
+-- ratings included
+CREATE OR REPLACE FUNCTION practica.recomanacio_unique_archived() RETURNS trigger AS $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM practica.recomanacio_archive a
+        WHERE (a.nom_usuari_escalador, a.nom_via, a.nom_sector_via, a.nom_crag_via)
+            = (NEW.nom_usuari_escalador, NEW.nom_via, NEW.nom_sector_via, NEW.nom_crag_via)
+    ) THEN
+        RAISE unique_violation USING
+            MESSAGE = 'duplicate key value violates unique constraint "unique_recomanacio_escalador_via"',
+            DETAIL = 'The climber has already rated this route (archived rating).',
+            CONSTRAINT = 'unique_recomanacio_escalador_via';
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS recomanacio_unique_archived ON practica.recomanacio;
+CREATE TRIGGER recomanacio_unique_archived
+    BEFORE INSERT OR UPDATE OF nom_usuari_escalador, nom_via, nom_sector_via, nom_crag_via ON practica.recomanacio
+    FOR EACH ROW EXECUTE FUNCTION practica.recomanacio_unique_archived();
+CREATE INDEX IF NOT EXISTS recomanacio_archive_key_idx
+    ON practica.recomanacio_archive (nom_usuari_escalador, nom_crag_via, nom_sector_via, nom_via);
+
+CREATE OR REPLACE VIEW practica.intent_all AS
+    SELECT * FROM practica.intent UNION ALL SELECT * FROM practica.intent_archive;
+CREATE OR REPLACE VIEW practica.encadenament_all AS
+    SELECT * FROM practica.encadenament UNION ALL SELECT * FROM practica.encadenament_archive;
+CREATE OR REPLACE VIEW practica.comentari_all AS
+    SELECT * FROM practica.comentari UNION ALL SELECT * FROM practica.comentari_archive;
+CREATE OR REPLACE VIEW practica.recomanacio_all AS
+    SELECT * FROM practica.recomanacio UNION ALL SELECT * FROM practica.recomanacio_archive;
+"""
+
+# Attempts move together with their completion, in the same statement
+MOVE_ATTEMPTS = """
+    WITH batch AS (
+        SELECT id_intent FROM practica.intent
+        WHERE data_intent < %s
+        ORDER BY data_intent
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    ), moved_completions AS (
+        DELETE FROM practica.encadenament e USING batch b
+        WHERE e.id_intent = b.id_intent
+        RETURNING e.*
+    ), archived_completions AS (
+        INSERT INTO practica.encadenament_archive SELECT * FROM moved_completions
+    ), moved AS (
+        DELETE FROM practica.intent i USING batch b
+        WHERE i.id_intent = b.id_intent
+        RETURNING i.*
+    )
+    INSERT INTO practica.intent_archive SELECT * FROM moved
+"""
+
+MOVE_ROWS = """
+    WITH batch AS (
+        SELECT {id_col} FROM practica.{table}
+        WHERE {date_col} < %s
+        ORDER BY {date_col}
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    ), moved AS (
+        DELETE FROM practica.{table} t USING batch b
+        WHERE t.{id_col} = b.{id_col}
+        RETURNING t.*
+    )
+    INSERT INTO practica.{table}_archive SELECT * FROM moved
+"""
+
+
+def install(conn):
+    with conn.cursor() as cur:
+        cur.execute(DDL)
+    conn.commit()
+
+
+def is_installed(conn):
+    with conn.cursor() as cur:
+        installed = installed_in(cur)
+    conn.commit()
+    return installed
+
+
+# Same check inside an open transaction, without committing it
+def installed_in(cur):
+    cur.execute("SELECT to_regclass('practica.intent_archive') IS NOT NULL")
+    return cur.fetchone()[0]
+
+
+# FROM expression for a table, with or without its archived rows
+def source(table, include_archived=False):
+    if include_archived:
+        return f"practica.{table}_all"
+    return f"practica.{table}"
+
+
+def _move(conn, sql, params, batch_size):
+    moved = 0
+    while True:
+        with conn.cursor() as cur:
+            # Marks these deletes as archival rather than removal
+            cur.execute("SET LOCAL practica.archiving = 'on'")
+            cur.execute(sql, params + (batch_size,))
+            count = cur.rowcount
+        conn.commit()
+        moved += count
+        if count < batch_size:
+            return moved
+
+
+# Move everything older than the horizon into the archive tables
+def run(conn, horizon_days=DEFAULT_HORIZON_DAYS, batch_size=DEFAULT_BATCH_SIZE):
+    cutoff = date.today() - timedelta(days=horizon_days)
+    moved = {"intent": _move(conn, MOVE_ATTEMPTS, (cutoff,), batch_size)}
+    for table, (id_col, date_col) in TABLES.items():
+        sql = MOVE_ROWS.format(table=table, id_col=id_col, date_col=date_col)
+        moved[table] = _move(conn, sql, (cutoff,), batch_size)
+    return moved
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move old activity rows into the archive tables")
+    parser.add_argument("--days", type=int, default=DEFAULT_HORIZON_DAYS, help="archive rows older than this many days")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    conn = db.connect()
+    install(conn)
+    for table, count in run(conn, args.days, args.batch_size).items():
+        print(f"{table}: {count} rows archived")
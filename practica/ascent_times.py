@@ -0,0 +1,275 @@
+# Ascent-time quantiles per route and per grade.
+#
+# practica.route_ascent_time keeps a t-digest (see tdigest.py) of the
+# temps_ascensio of every route's completions, in seconds, and
+# practica.grade_ascent_time the merge of the digests of all routes of a
+# grade (via.grau_ordinal). The tables may already be ahead of the change
+# log being consumed, and unlike the HyperLogLog sketches in cube.py a digest
+# can't absorb the same value twice, so the cdc engine recomputes the digest
+# of every route that gained or lost a completion from its rows (a route has
+# at most a few hundred) rather than merging into it. A grade whose routes
+# only gained times in the batch merges the batch's times into its digest, as
+# long as each of those routes' count grew by exactly that many (the route
+# digests weren't ahead); after removals, regrades or a mismatch it is
+# re-merged from its routes' digests.
+import argparse
+import sys
+from datetime import timedelta
+
+import psycopg2
+from psycopg2 import extras
+
+from practica import archive, cdc, db, tdigest
+
+NAME = "ascent_times"
+
+TABLES = ["intent", "encadenament", "via"]
+
+KEY = "nom_via, nom_sector_via, nom_crag_via"
+
+DDL = f"""
+CREATE TABLE IF NOT EXISTS practica.route_ascent_time (
+    nom_via         varchar(255) NOT NULL,
+    nom_sector_via  varchar(255) NOT NULL,
+    nom_crag_via    varchar(255) NOT NULL,
+    n               bigint NOT NULL,
+    digest          bytea NOT NULL,
+    PRIMARY KEY ({KEY})
+);
+
+CREATE TABLE IF NOT EXISTS practica.grade_ascent_time (
+    grau_ordinal  smallint PRIMARY KEY,
+    n             bigint NOT NULL,
+    digest        bytea NOT NULL
+);
+"""
+
+# Ascent times in seconds per route, optionally only for the routes in the
+# arrays passed as parameters
+ROUTE_TIMES = """
+    SELECT i.nom_via, i.nom_sector_via, i.nom_crag_via, EXTRACT(EPOCH FROM e.temps_ascensio)
+    FROM {encadenament_table} e
+    JOIN {intent_table} i ON i.id_intent = e.id_intent
+    {keys}
+    WHERE e.temps_ascensio IS NOT NULL
+"""
+
+KEYS_JOIN = """
+    JOIN unnest(%s::text[], %s::text[], %s::text[]) AS k (nom_via, nom_sector_via, nom_crag_via)
+      ON i.nom_via = k.nom_via AND i.nom_sector_via = k.nom_sector_via AND i.nom_crag_via = k.nom_crag_via
+"""
+
+# Routes that gained or lost completions in the batch
+CHANGED_ROUTES = f"""
+    SELECT {KEY} FROM {cdc.completions(1)} r
+    UNION
+    SELECT {KEY} FROM {cdc.completions(-1)} r
+"""
+
+# Times of the completions added in the batch, from the log
+ADDED_TIMES = """
+    SELECT b.fila->>'nom_via', b.fila->>'nom_sector_via', b.fila->>'nom_crag_via',
+           EXTRACT(EPOCH FROM (b.fila->>'temps_ascensio')::interval)
+    FROM cdc_batch b
+    WHERE b.tabla = 'encadenament' AND b.sign = 1
+      AND b.fila ? 'nom_via' AND b.fila->>'temps_ascensio' IS NOT NULL
+"""
+
+# Routes that lost completions, or gained them by an attempt moving over
+REMOVED_ROUTES = f"""
+    SELECT {KEY} FROM {cdc.completions(-1)} r
+    UNION
+    SELECT r.nom_via, r.nom_sector_via, r.nom_crag_via
+    FROM cdc_batch b, jsonb_populate_record(NULL::practica.intent, b.fila) r
+    WHERE b.tabla = 'intent' AND b.sign = 1 AND (b.fila->>'encadenat')::boolean
+"""
+
+ROUTE_COUNTS = """
+    SELECT t.nom_via, t.nom_sector_via, t.nom_crag_via, t.n
+    FROM practica.route_ascent_time t
+    JOIN unnest(%s::text[], %s::text[], %s::text[]) AS k (nom_via, nom_sector_via, nom_crag_via)
+      ON (t.nom_via, t.nom_sector_via, t.nom_crag_via) = (k.nom_via, k.nom_sector_via, k.nom_crag_via)
+"""
+
+UPSERT_ROUTES = f"""
+    INSERT INTO practica.route_ascent_time ({KEY}, n, digest) VALUES %s
+    ON CONFLICT ({KEY}) DO UPDATE SET n = EXCLUDED.n, digest = EXCLUDED.digest
+"""
+
+# Grade of each of the routes in the arrays
+ROUTE_GRADES = """
+    SELECT v.nom, v.nom_sector, v.nom_crag_sector, v.grau_ordinal FROM practica.via v
+    JOIN unnest(%s::text[], %s::text[], %s::text[]) AS k (nom_via, nom_sector_via, nom_crag_via)
+      ON v.nom = k.nom_via AND v.nom_sector = k.nom_sector_via AND v.nom_crag_sector = k.nom_crag_via
+"""
+
+# Grades that routes moved from or to
+REGRADED = f"""
+    SELECT r.grau_ordinal FROM {cdc.rows("via", 1)} r
+    UNION
+    SELECT r.grau_ordinal FROM {cdc.rows("via", -1)} r
+"""
+
+GRADE_DIGESTS = """
+    SELECT v.grau_ordinal, t.digest
+    FROM practica.route_ascent_time t
+    JOIN practica.via v ON v.nom = t.nom_via AND v.nom_sector = t.nom_sector_via AND v.nom_crag_sector = t.nom_crag_via
+    WHERE v.grau_ordinal = ANY(%s)
+"""
+
+
+def _key_arrays(keys):
+    return [list(column) for column in zip(*keys)] if keys else [[], [], []]
+
+
+def _times(cur, query, params=None):
+    times = {}
+    cur.execute(query, params)
+    for route, sector, crag, seconds in cur.fetchall():
+        times.setdefault((route, sector, crag), []).append(float(seconds))
+    return times
+
+
+def _route_times(cur, archived, keys=None):
+    query = ROUTE_TIMES.format(
+        encadenament_table=archive.source("encadenament", archived),
+        intent_table=archive.source("intent", archived),
+        keys=KEYS_JOIN if keys is not None else "",
+    )
+    return _times(cur, query, _key_arrays(keys) if keys is not None else None)
+
+
+def _store_routes(cur, digests):
+    if digests:
+        extras.execute_values(
+            cur, UPSERT_ROUTES,
+            [key + (tdigest.count(digest), psycopg2.Binary(tdigest.encode(digest))) for key, digest in digests.items()]
+        )
+
+
+# Re-merge the digests of the given grades from their routes'
+def _refresh_grades(cur, ordinals):
+    ordinals = [ordinal for ordinal in ordinals if ordinal is not None]
+    if not ordinals:
+        return
+    cur.execute(GRADE_DIGESTS, (ordinals,))
+    by_grade = {}
+    for ordinal, digest in cur.fetchall():
+        by_grade.setdefault(ordinal, []).append(tdigest.decode(digest))
+    merged = {ordinal: tdigest.merge(digests) for ordinal, digests in by_grade.items()}
+    cur.execute("DELETE FROM practica.grade_ascent_time WHERE grau_ordinal = ANY(%s)", (ordinals,))
+    if merged:
+        extras.execute_values(
+            cur,
+            "INSERT INTO practica.grade_ascent_time (grau_ordinal, n, digest) VALUES %s",
+            [(ordinal, tdigest.count(digest), psycopg2.Binary(tdigest.encode(digest))) for ordinal, digest in merged.items()]
+        )
+
+
+# Merge new times into the stored digests of their grades ({ordinal: times})
+def _add_to_grades(cur, added):
+    if not added:
+        return
+    cur.execute("SELECT grau_ordinal, digest FROM practica.grade_ascent_time WHERE grau_ordinal = ANY(%s)", (list(added),))
+    stored = {ordinal: tdigest.decode(digest) for ordinal, digest in cur.fetchall()}
+    merged = {ordinal: tdigest.add(stored.get(ordinal), times) for ordinal, times in added.items()}
+    extras.execute_values(
+        cur,
+        """
+        INSERT INTO practica.grade_ascent_time (grau_ordinal, n, digest) VALUES %s
+        ON CONFLICT (grau_ordinal) DO UPDATE SET n = EXCLUDED.n, digest = EXCLUDED.digest
+        """,
+        [(ordinal, tdigest.count(digest), psycopg2.Binary(tdigest.encode(digest))) for ordinal, digest in merged.items()]
+    )
+
+
+def apply_changes(cur):
+    cur.execute(CHANGED_ROUTES)
+    keys = [tuple(row) for row in cur.fetchall()]
+    added = _times(cur, ADDED_TIMES)
+    cur.execute(REMOVED_ROUTES)
+    removed = {tuple(row) for row in cur.fetchall()}
+    cur.execute(ROUTE_COUNTS, _key_arrays(keys))
+    before = {tuple(key): n for *key, n in cur.fetchall()}
+    current = {}
+
+    if keys:
+        current = _route_times(cur, archive.installed_in(cur), keys)
+        _store_routes(cur, {key: tdigest.of(times) for key, times in current.items()})
+        gone = [key for key in keys if key not in current]
+        if gone:
+            cur.execute(
+                """
+                DELETE FROM practica.route_ascent_time t
+                USING unnest(%s::text[], %s::text[], %s::text[]) AS k (nom_via, nom_sector_via, nom_crag_via)
+                WHERE (t.nom_via, t.nom_sector_via, t.nom_crag_via) = (k.nom_via, k.nom_sector_via, k.nom_crag_via)
+                """,
+                _key_arrays(gone)
+            )
+
+    cur.execute(REGRADED)
+    remerge = {row[0] for row in cur.fetchall()}
+    cur.execute(ROUTE_GRADES, _key_arrays(keys))
+    by_grade = {}
+    for *key, ordinal in cur.fetchall():
+        key = tuple(key)
+        times = added.get(key, [])
+        if key in removed or before.get(key, 0) + len(times) != len(current.get(key, [])):
+            remerge.add(ordinal)
+        elif times:
+            by_grade.setdefault(ordinal, []).extend(times)
+    _refresh_grades(cur, remerge)
+    _add_to_grades(cur, {ordinal: times for ordinal, times in by_grade.items() if ordinal not in remerge and ordinal is not None})
+
+
+def refill(cur, archived):
+    cur.execute("TRUNCATE practica.route_ascent_time, practica.grade_ascent_time")
+    _store_routes(cur, {key: tdigest.of(times) for key, times in _route_times(cur, archived).items()})
+    cur.execute("SELECT DISTINCT grau_ordinal FROM practica.via WHERE grau_ordinal IS NOT NULL")
+    _refresh_grades(cur, [row[0] for row in cur.fetchall()])
+
+
+def install(conn):
+    cdc.install(conn)
+    with conn.cursor() as cur:
+        cur.execute(DDL)
+    conn.commit()
+    cdc.subscribe(conn, sys.modules[__name__])
+
+
+def rebuild(conn):
+    cdc.subscribe(conn, sys.modules[__name__], rebuild=True)
+
+
+# Median and 90th percentile in seconds (None if no times), from a digest as
+# stored or as hex text
+def summary(digest):
+    digest = tdigest.decode(digest)
+    return tdigest.quantile(digest, 0.5), tdigest.quantile(digest, 0.9)
+
+
+# Fraction of the route's other recorded times that are slower than seconds,
+# one of the recorded times: the climber's own send isn't counted against
+# them (cdf() puts half of it on either side). None if nobody else has a time.
+def faster_than(digest, seconds):
+    digest = tdigest.decode(digest)
+    n = tdigest.count(digest)
+    if n <= 1 or seconds is None:
+        return None
+    slower = n * (1 - tdigest.cdf(digest, seconds)) - 0.5
+    return min(max(slower / (n - 1), 0.0), 1.0)
+
+
+def format_duration(seconds):
+    return str(timedelta(seconds=round(seconds))) if seconds is not None else "—"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the ascent-time digests")
+    parser.add_argument("--rebuild", action="store_true", help="recompute everything from the completions")
+    args = parser.parse_args()
+
+    conn = db.connect()
+    install(conn)
+    if args.rebuild:
+        rebuild(conn)
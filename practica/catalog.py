@@ -0,0 +1,166 @@
+# In-memory crag -> sector -> route catalog for the cascading pickers.
+#
+# Every page of both apps offers crag, sector and route selectboxes. Rather
+# than a query per list, each app process loads the whole hierarchy once
+# into a Catalog and serves every list from it. The names are interned, so
+# the sector names repeated across crags and the route names repeated across
+# sectors are stored once. Each node only holds its children's names in the
+# database's order (what the selectboxes show), the child nodes, and an
+# array of the children's positions in code point order, so a child is
+# found by bisection without a dict per node.
+#
+# practica.catalog_version is bumped by statement triggers on every change
+# to practica.crag, sector or via, whichever process makes it. The apps read
+# that one row on each run and reload the catalog when it has moved. The
+# bump locks the row until commit, so statements that changed no rows (seen
+# through their transition tables) leave it alone.
+import argparse
+import bisect
+import sys
+from array import array
+
+from practica import db
+
+DDL = """
+CREATE TABLE IF NOT EXISTS practica.catalog_version (
+    id       boolean PRIMARY KEY DEFAULT true CHECK (id),
+    version  bigint NOT NULL DEFAULT 0
+);
+INSERT INTO practica.catalog_version (id) VALUES (true) ON CONFLICT DO NOTHING;
+
+CREATE OR REPLACE FUNCTION practica.bump_catalog_version() RETURNS trigger AS $$
+BEGIN
+    UPDATE practica.catalog_version SET version = version + 1;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Same, for statements with a transition table "changed"
+CREATE OR REPLACE FUNCTION practica.bump_catalog_version_changed() RETURNS trigger AS $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM changed) THEN
+        UPDATE practica.catalog_version SET version = version + 1;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+# Transition tables take one event per trigger
+TRIGGERS = """
+DROP TRIGGER IF EXISTS catalog_version ON practica.{table};
+DROP TRIGGER IF EXISTS catalog_version_insert ON practica.{table};
+CREATE TRIGGER catalog_version_insert AFTER INSERT ON practica.{table}
+    REFERENCING NEW TABLE AS changed
+    FOR EACH STATEMENT EXECUTE FUNCTION practica.bump_catalog_version_changed();
+DROP TRIGGER IF EXISTS catalog_version_update ON practica.{table};
+CREATE TRIGGER catalog_version_update AFTER UPDATE ON practica.{table}
+    REFERENCING NEW TABLE AS changed
+    FOR EACH STATEMENT EXECUTE FUNCTION practica.bump_catalog_version_changed();
+DROP TRIGGER IF EXISTS catalog_version_delete ON practica.{table};
+CREATE TRIGGER catalog_version_delete AFTER DELETE ON practica.{table}
+    REFERENCING OLD TABLE AS changed
+    FOR EACH STATEMENT EXECUTE FUNCTION practica.bump_catalog_version_changed();
+DROP TRIGGER IF EXISTS catalog_version_truncate ON practica.{table};
+CREATE TRIGGER catalog_version_truncate AFTER TRUNCATE ON practica.{table}
+    FOR EACH STATEMENT EXECUTE FUNCTION practica.bump_catalog_version();
+"""
+
+TABLES = ["crag", "sector", "via"]
+
+VERSION = "SELECT version FROM practica.catalog_version"
+
+TREE = """
+    SELECT c.nom, s.nom, v.nom
+    FROM practica.crag c
+    LEFT JOIN practica.sector s ON s.nom_crag = c.nom
+    LEFT JOIN practica.via v ON v.nom_crag_sector = s.nom_crag AND v.nom_sector = s.nom
+    ORDER BY 1, 2, 3
+"""
+
+
+class Node:
+    __slots__ = ("names", "children", "order")
+
+    def __init__(self, names, children=()):
+        self.names = names
+        self.children = children
+        # Routes are leaves, never looked up by name
+        self.order = array("I", sorted(range(len(names)), key=names.__getitem__) if children else ())
+
+    def child(self, name):
+        names = self.names
+        index = bisect.bisect_left(self.order, name, key=names.__getitem__)
+        if index < len(self.order) and names[self.order[index]] == name and self.children:
+            return self.children[self.order[index]]
+        return None
+
+
+class Catalog:
+    __slots__ = ("version", "root")
+
+    def __init__(self, version, root):
+        self.version = version
+        self.root = root
+
+    def crags(self):
+        return list(self.root.names)
+
+    def sectors(self, crag):
+        node = self.root.child(crag)
+        return list(node.names) if node else []
+
+    def routes(self, crag, sector):
+        node = self.root.child(crag)
+        node = node.child(sector) if node else None
+        return list(node.names) if node else []
+
+
+def current_version(cur):
+    cur.execute(VERSION)
+    return cur.fetchone()[0]
+
+
+# Builds the tree from TREE's sorted rows: crags, then their sectors, then
+# their routes (None where a crag has no sectors or a sector no routes)
+def load(cur):
+    version = current_version(cur)
+    cur.execute(TREE)
+    tree = {}
+    for crag, sector, route in cur.fetchall():
+        sectors = tree.setdefault(sys.intern(crag), {})
+        if sector is not None:
+            routes = sectors.setdefault(sys.intern(sector), [])
+            if route is not None:
+                routes.append(sys.intern(route))
+    root = Node(
+        tuple(tree),
+        tuple(
+            Node(tuple(sectors), tuple(Node(tuple(routes)) for routes in sectors.values()))
+            for sectors in tree.values()
+        ),
+    )
+    return Catalog(version, root)
+
+
+def install(conn):
+    with conn.cursor() as cur:
+        cur.execute(DDL)
+        for table in TABLES:
+            cur.execute(TRIGGERS.format(table=table))
+    conn.commit()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load the crag/sector/route catalog")
+    parser.add_argument("crag", nargs="?", help="list this crag's sectors; installs the version trigger if omitted")
+    parser.add_argument("sector", nargs="?", help="list this sector's routes")
+    args = parser.parse_args()
+
+    conn = db.connect()
+    install(conn)
+    if args.crag:
+        with conn.cursor() as cur:
+            catalog = load(cur)
+        names = catalog.routes(args.crag, args.sector) if args.sector else catalog.sectors(args.crag)
+        print("\n".join(names))
@@ -0,0 +1,367 @@
+# Change-data capture for the practica tables.
+#
+# Statement-level triggers write every inserted, updated and deleted row of
+# the base tables to practica.change_log as JSON: a deleted row with sign -1,
+# an inserted one with +1 and an update as both. Derived data (counters,
+# rollups, rating aggregates, ...) is then maintained by consumers that read
+# the log in batches and apply the deltas, instead of each feature hanging
+# its own triggers on the base tables.
+#
+# A consumer is a module with
+#
+#     NAME                   its checkpoint in practica.cdc_consumer
+#     TABLES                 the base tables it reads
+#     refill(cur, archived)  recompute everything from the base tables
+#     apply_changes(cur)     apply the batch staged in cdc_batch (see rows())
+#
+# Checkpoints are transaction snapshots rather than log ids: ids are handed
+# out before commit, so a lower id can become visible after a higher one has
+# been consumed. A consumer's next batch is exactly the rows written by the
+# transactions that committed between its snapshot and the current one.
+#
+# Rows carried into the archive (practica.archiving = 'on') aren't logged,
+# so archived rows stay counted. Rows deleted from the archive tables (e.g. by
+# practica/purge.py) are logged under their base table with sign -1 and an
+# "archivat" flag, see rows(). Attempts and completions are logged with
+# enough of each other to count completions without going back to the
+# tables: completions carry their attempt's columns, and attempts a flag
+# "encadenat". When an attempt is deleted with its completion (ON DELETE
+# CASCADE) only the attempt counts, see completions().
+#
+# Run the engine with
+#
+#     python -m practica.cdc --follow
+import argparse
+import select
+import time
+
+from practica import archive, db
+
+LOGGED_TABLES = ["crag", "sector", "via", "escalador", "intent", "encadenament", "comentari", "recomanacio"]
+
+DEFAULT_BATCH_SIZE = 5000
+DEFAULT_INTERVAL = 2
+
+CHANNEL = "practica_changes"
+
+DDL = """
+CREATE TABLE IF NOT EXISTS practica.change_log (
+    id         bigserial PRIMARY KEY,
+    txid       bigint NOT NULL DEFAULT txid_current(),
+    tabla      varchar(50) NOT NULL,
+    sign       smallint NOT NULL,
+    fila       jsonb NOT NULL,
+    logged_at  timestamptz NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS change_log_txid_idx ON practica.change_log (txid, id);
+
+CREATE TABLE IF NOT EXISTS practica.cdc_consumer (
+    nom         varchar(50) PRIMARY KEY,
+    snapshot    txid_snapshot NOT NULL,
+    updated_at  timestamptz NOT NULL DEFAULT now()
+);
+
+CREATE OR REPLACE FUNCTION practica.cdc_payload(tabla text, fila jsonb) RETURNS jsonb AS $$
+    SELECT CASE tabla
+        WHEN 'intent' THEN fila || jsonb_build_object('encadenat', EXISTS (
+            SELECT 1 FROM practica.encadenament e WHERE e.id_intent = (fila->>'id_intent')::int
+        ))
+        WHEN 'encadenament' THEN COALESCE((
+            SELECT to_jsonb(i) FROM practica.intent i WHERE i.id_intent = (fila->>'id_intent')::int
+        ), '{}') || fila
+        ELSE fila
+    END
+$$ LANGUAGE sql STABLE;
+
+CREATE OR REPLACE FUNCTION practica.cdc_log() RETURNS trigger AS $$
+BEGIN
+    IF current_setting('practica.archiving', true) = 'on' THEN
+        RETURN NULL;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        INSERT INTO practica.change_log (tabla, sign, fila)
+        SELECT TG_TABLE_NAME, -1, practica.cdc_payload(TG_TABLE_NAME, to_jsonb(o)) FROM old_rows o;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO practica.change_log (tabla, sign, fila)
+        SELECT TG_TABLE_NAME, 1, practica.cdc_payload(TG_TABLE_NAME, to_jsonb(n)) FROM new_rows n;
+    END IF;
+    PERFORM pg_notify('practica_changes', TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Attempts are logged before they are deleted, while their completion (if
+-- any) is still there to be flagged
+CREATE OR REPLACE FUNCTION practica.cdc_log_intent_deleted() RETURNS trigger AS $$
+BEGIN
+    IF current_setting('practica.archiving', true) = 'on' THEN
+        RETURN OLD;
+    END IF;
+    INSERT INTO practica.change_log (tabla, sign, fila)
+    VALUES ('intent', -1, practica.cdc_payload('intent', to_jsonb(OLD)));
+    PERFORM pg_notify('practica_changes', 'intent');
+    RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+# Deletes from the archive tables, logged under the base table (TG_ARGV[0])
+# with the same payload, read from the archive. The archive tables have no
+# cascade: purge() deletes completions before their attempts.
+ARCHIVE_DDL = """
+CREATE OR REPLACE FUNCTION practica.cdc_archive_payload(tabla text, fila jsonb) RETURNS jsonb AS $$
+    SELECT CASE tabla
+        WHEN 'intent' THEN fila || jsonb_build_object('encadenat', EXISTS (
+            SELECT 1 FROM practica.encadenament_archive e WHERE e.id_intent = (fila->>'id_intent')::int
+        ))
+        WHEN 'encadenament' THEN COALESCE((
+            SELECT to_jsonb(i) FROM practica.intent_archive i WHERE i.id_intent = (fila->>'id_intent')::int
+        ), '{}') || fila
+        ELSE fila
+    END || '{"archivat": true}'
+$$ LANGUAGE sql STABLE;
+
+CREATE OR REPLACE FUNCTION practica.cdc_log_archive_deleted() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO practica.change_log (tabla, sign, fila)
+    SELECT TG_ARGV[0], -1, practica.cdc_archive_payload(TG_ARGV[0], to_jsonb(o)) FROM old_rows o;
+    PERFORM pg_notify('practica_changes', TG_ARGV[0]);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+TRIGGERS = """
+DROP TRIGGER IF EXISTS cdc_insert ON practica.{table};
+CREATE TRIGGER cdc_insert AFTER INSERT ON practica.{table}
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION practica.cdc_log();
+DROP TRIGGER IF EXISTS cdc_update ON practica.{table};
+CREATE TRIGGER cdc_update AFTER UPDATE ON practica.{table}
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION practica.cdc_log();
+"""
+
+DELETE_TRIGGER = """
+DROP TRIGGER IF EXISTS cdc_delete ON practica.{table};
+CREATE TRIGGER cdc_delete AFTER DELETE ON practica.{table}
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION practica.cdc_log();
+"""
+
+ARCHIVE_DELETE_TRIGGER = """
+DROP TRIGGER IF EXISTS cdc_delete ON practica.{table}_archive;
+CREATE TRIGGER cdc_delete AFTER DELETE ON practica.{table}_archive
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION practica.cdc_log_archive_deleted('{table}');
+"""
+
+# Base tables with an archive table, see practica/archive.py
+ARCHIVED_TABLES = ["intent", "encadenament", "comentari", "recomanacio"]
+
+INTENT_DELETE_TRIGGER = """
+DROP TRIGGER IF EXISTS cdc_delete ON practica.intent;
+CREATE TRIGGER cdc_delete BEFORE DELETE ON practica.intent
+    FOR EACH ROW EXECUTE FUNCTION practica.cdc_log_intent_deleted();
+"""
+
+# Staging table for one batch of a consumer
+BATCH_TABLE = """
+CREATE TEMP TABLE IF NOT EXISTS cdc_batch (
+    txid   bigint,
+    id     bigint,
+    tabla  varchar(50),
+    sign   smallint,
+    fila   jsonb
+) ON COMMIT DELETE ROWS
+"""
+
+# Next rows of a consumer's window, in (txid, id) order after the last batch
+NEXT_BATCH = """
+    INSERT INTO cdc_batch
+    SELECT l.txid, l.id, l.tabla, l.sign, l.fila
+    FROM practica.change_log l, practica.cdc_consumer c
+    WHERE c.nom = %(name)s
+      AND l.tabla = ANY(%(tables)s)
+      AND l.txid >= txid_snapshot_xmin(c.snapshot)
+      AND l.txid < txid_snapshot_xmax(%(current)s::txid_snapshot)
+      AND txid_visible_in_snapshot(l.txid, %(current)s::txid_snapshot)
+      AND NOT txid_visible_in_snapshot(l.txid, c.snapshot)
+      AND (l.txid, l.id) > (%(txid)s, %(id)s)
+    ORDER BY l.txid, l.id
+    LIMIT %(limit)s
+"""
+
+
+# The changed rows of a table in the current batch with the given sign, as a
+# relation with the table's columns. archived_only keeps the rows deleted
+# from the archive table.
+def rows(table, sign, archived_only=False):
+    return f"""(
+        SELECT r.* FROM cdc_batch b, jsonb_populate_record(NULL::practica.{table}, b.fila) r
+        WHERE b.tabla = '{table}' AND b.sign = {sign}{_archived_only(archived_only)}
+    )"""
+
+
+def _archived_only(archived_only):
+    return " AND b.fila ? 'archivat'" if archived_only else ""
+
+
+# Completions added (sign 1) or removed (sign -1) in the current batch, with
+# their attempt's columns. Removals are the deleted completions whose attempt
+# was still there, plus the deleted attempts that had one; attempts moved by
+# an update carry their completion along.
+def completions(sign, archived_only=False):
+    return f"""(
+        SELECT r.* FROM cdc_batch b, jsonb_populate_record(NULL::practica.intent, b.fila) r
+        WHERE b.sign = {sign}
+          AND ((b.tabla = 'encadenament' AND r.nom_usuari_escalador IS NOT NULL)
+               OR (b.tabla = 'intent' AND (b.fila->>'encadenat')::boolean)){_archived_only(archived_only)}
+    )"""
+
+
+def install(conn):
+    with conn.cursor() as cur:
+        cur.execute(DDL)
+        for table in LOGGED_TABLES:
+            cur.execute(TRIGGERS.format(table=table))
+            if table != "intent":
+                cur.execute(DELETE_TRIGGER.format(table=table))
+        cur.execute(INTENT_DELETE_TRIGGER)
+        if archive.installed_in(cur):
+            cur.execute(ARCHIVE_DDL)
+            for table in ARCHIVED_TABLES:
+                cur.execute(ARCHIVE_DELETE_TRIGGER.format(table=table))
+    conn.commit()
+
+
+# Start a consumer from scratch: refill its derived data from the base tables
+# and checkpoint it at the same snapshot. Returns what refill returns. A
+# consumer that is already subscribed is left alone (None) unless rebuild.
+def subscribe(conn, consumer, rebuild=False):
+    archived = archive.is_installed(conn)
+    with conn.cursor() as cur:
+        cur.execute("SELECT 1 FROM practica.cdc_consumer WHERE nom = %s", (consumer.NAME,))
+        if cur.fetchone() is not None and not rebuild:
+            conn.commit()
+            return None
+        # Writers to the consumer's tables are blocked from here to the
+        # commit, so the refill and the snapshot see the same rows
+        for table in consumer.TABLES:
+            cur.execute(f"LOCK TABLE practica.{table} IN SHARE MODE")
+        cur.execute(
+            """
+            INSERT INTO practica.cdc_consumer (nom, snapshot) VALUES (%s, txid_current_snapshot())
+            ON CONFLICT (nom) DO UPDATE SET snapshot = EXCLUDED.snapshot, updated_at = now()
+            """,
+            (consumer.NAME,)
+        )
+        result = consumer.refill(cur, archived)
+    conn.commit()
+    return result
+
+
+# Apply everything committed since the consumer's checkpoint; returns the
+# number of changes applied
+def consume(conn, consumer, batch_size=DEFAULT_BATCH_SIZE):
+    applied = 0
+    try:
+        with conn.cursor() as cur:
+            cur.execute(BATCH_TABLE)
+            cur.execute("SELECT 1 FROM practica.cdc_consumer WHERE nom = %s FOR UPDATE", (consumer.NAME,))
+            if cur.fetchone() is None:
+                raise LookupError(f"{consumer.NAME} is not subscribed")
+            cur.execute("SELECT txid_current_snapshot()::text")
+            current = cur.fetchone()[0]
+            last = (0, 0)
+            while True:
+                cur.execute(NEXT_BATCH, {
+                    "name": consumer.NAME,
+                    "tables": list(consumer.TABLES),
+                    "current": current,
+                    "txid": last[0],
+                    "id": last[1],
+                    "limit": batch_size,
+                })
+                if cur.rowcount == 0:
+                    break
+                applied += cur.rowcount
+                cur.execute("SELECT txid, id FROM cdc_batch ORDER BY txid DESC, id DESC LIMIT 1")
+                last = cur.fetchone()
+                consumer.apply_changes(cur)
+                cur.execute("TRUNCATE cdc_batch")
+            cur.execute(
+                "UPDATE practica.cdc_consumer SET snapshot = %s::txid_snapshot, updated_at = now() WHERE nom = %s",
+                (current, consumer.NAME)
+            )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return applied
+
+
+# Drop the log rows every consumer has gone past
+def prune(conn):
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            DELETE FROM practica.change_log
+            WHERE txid < (SELECT MIN(txid_snapshot_xmin(snapshot)) FROM practica.cdc_consumer)
+            """
+        )
+        pruned = cur.rowcount
+    conn.commit()
+    return pruned
+
+
+def consumers():
+    from practica import activity, ascent_times, counters, cube, facets, integrity, journeys, leaderboards, levels, ratings, similar, trending
+
+    return [counters, ratings, activity, cube, ascent_times, facets, trending, leaderboards, similar, levels, journeys, integrity]
+
+
+def run(conn, batch_size=DEFAULT_BATCH_SIZE):
+    return {consumer.NAME: consume(conn, consumer, batch_size) for consumer in consumers()}
+
+
+# Keep consuming, waking up on the triggers' notifications or every interval seconds
+def follow(conn, batch_size=DEFAULT_BATCH_SIZE, interval=DEFAULT_INTERVAL):
+    listener = db.connect()
+    listener.autocommit = True
+    with listener.cursor() as cur:
+        cur.execute(f"LISTEN {CHANNEL}")
+    while True:
+        applied = run(conn, batch_size)
+        if any(applied.values()):
+            print(", ".join(f"{name}: {count}" for name, count in applied.items()))
+            prune(conn)
+        if select.select([listener], [], [], interval)[0]:
+            listener.poll()
+            listener.notifies.clear()
+            # Let a burst of writes settle into one batch
+            time.sleep(0.2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply the change log to the derived tables")
+    parser.add_argument("--follow", action="store_true", help="keep running, applying changes as they commit")
+    parser.add_argument("--rebuild", metavar="NAME", help="refill one consumer (or 'all') from the base tables")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--interval", type=float, default=DEFAULT_INTERVAL)
+    args = parser.parse_args()
+
+    conn = db.connect()
+    install(conn)
+    if args.rebuild:
+        for consumer in consumers():
+            if args.rebuild in ("all", consumer.NAME):
+                subscribe(conn, consumer, rebuild=True)
+                print(f"Rebuilt {consumer.NAME}")
+    if args.follow:
+        follow(conn, args.batch_size, args.interval)
+    else:
+        for name, count in run(conn, args.batch_size).items():
+            print(f"{name}: {count} changes")
+        print(f"Pruned {prune(conn)} log rows")
@@ -0,0 +1,200 @@
+# Grade consensus: which routes are soft or hard for their grade.
+#
+# Every redpoint journey (practica/journeys.py) of a climber with an
+# estimated level (practica/levels.py) is a run of attempts at a route of
+# via.grau_ordinal, ending in a send or not (yet). Climbers send a route
+# about their level in fewer attempts than one above it, so over all routes
+# the chance that an attempt sends is a function of the gap between the
+# climber's level and the grade: the send rate per attempt of each gap
+# between -MAX_GAP and MAX_GAP, kept monotonic.
+#
+# A route is then scored as if it were graded k ordinals off, for every k
+# between -MAX_SHIFT and MAX_SHIFT: the likelihood of its journeys under the
+# send rates of the shifted gaps, plus a prior that grades are right
+# (PRIOR_WEIGHT * k^2). The most likely k is the consensus adjustment,
+# negative for a soft route and positive for a hard one, and its posterior
+# probability the confidence. Routes climbed by fewer than MIN_CLIMBERS
+# rated climbers, or with a confidence under MIN_CONFIDENCE, aren't flagged
+# by verdict().
+#
+# Alongside it practica.route_consensus keeps what the adjustment is read
+# from: the send rates of climbers below, at (within a grade) and above the
+# route's grade, and its attempts to send relative to the average route of
+# the same grade. A full recompute is a few numpy bincounts over the
+# journeys, run as a batch job (python -m practica.consensus, e.g. nightly
+# after the levels --rebuild).
+import argparse
+import time
+
+import numpy as np
+from psycopg2 import extras
+
+from practica import db, grades
+
+MAX_GAP = 6
+MAX_SHIFT = 3
+PRIOR_WEIGHT = 0.5
+
+MIN_CLIMBERS = 3
+MIN_CONFIDENCE = 0.6
+
+DDL = """
+CREATE TABLE IF NOT EXISTS practica.route_consensus (
+    nom_via          varchar(255) NOT NULL,
+    nom_sector_via   varchar(255) NOT NULL,
+    nom_crag_via     varchar(255) NOT NULL,
+    grau_ordinal     smallint NOT NULL,
+    escaladors       integer NOT NULL,
+    encadenaments    integer NOT NULL,
+    taxa_sota        real,
+    taxa_nivell      real,
+    taxa_sobre       real,
+    esforc_relatiu   real,
+    ajust            smallint NOT NULL,
+    confianca        real NOT NULL,
+    PRIMARY KEY (nom_via, nom_sector_via, nom_crag_via)
+);
+CREATE INDEX IF NOT EXISTS route_consensus_ajust_idx ON practica.route_consensus (ajust) WHERE ajust <> 0;
+"""
+
+# Journeys of climbers with an estimated level on graded routes: route,
+# grade, climber level, sent, attempts up to the send (all if not sent)
+JOURNEYS = """
+    SELECT j.nom_via, j.nom_sector_via, j.nom_crag_via, v.grau_ordinal, l.grau_ordinal,
+           j.encadenament IS NOT NULL, COALESCE(j.intents_encadenar, j.intents)
+    FROM practica.route_journey j
+    JOIN practica.via v ON (v.nom, v.nom_sector, v.nom_crag_sector) = (j.nom_via, j.nom_sector_via, j.nom_crag_via)
+    JOIN practica.climber_level l ON l.nom_usuari = j.nom_usuari
+    WHERE v.grau_ordinal IS NOT NULL
+"""
+
+INSERT = """
+    INSERT INTO practica.route_consensus (
+        nom_via, nom_sector_via, nom_crag_via, grau_ordinal, escaladors, encadenaments,
+        taxa_sota, taxa_nivell, taxa_sobre, esforc_relatiu, ajust, confianca
+    ) VALUES %s
+"""
+
+# A route's consensus. Params: route, sector, crag.
+CONSENSUS = """
+    SELECT grau_ordinal, escaladors, encadenaments, taxa_sota, taxa_nivell, taxa_sobre,
+           esforc_relatiu, ajust, confianca
+    FROM practica.route_consensus
+    WHERE nom_via = %s AND nom_sector_via = %s AND nom_crag_via = %s
+"""
+
+
+def install(conn):
+    with conn.cursor() as cur:
+        cur.execute(DDL)
+    conn.commit()
+
+
+# "Soft"/"Hard" with the grade a route climbs like, or None if the climbers
+# agree with its grade or there aren't enough of them to tell
+def verdict(ordinal, adjustment, confidence, climbers):
+    if adjustment == 0 or climbers < MIN_CLIMBERS or confidence < MIN_CONFIDENCE:
+        return None
+    feels = min(max(ordinal + adjustment, grades.MIN_ORDINAL), grades.MAX_ORDINAL)
+    return f"{'Soft' if adjustment < 0 else 'Hard'}, climbs like {grades.label(feels)}"
+
+
+def _rate(sends, tries):
+    return np.divide(sends, tries, out=np.full(len(tries), np.nan), where=tries > 0)
+
+
+# Consensus rows from journey rows (route key, ordinal, climber ordinal,
+# sent, attempts): route key + (ordinal, climbers, sends, rate below, rate
+# at, rate above, relative effort, adjustment, confidence)
+def score(rows):
+    routes = {}
+    index, ordinals, levels, sent, attempts = [], [], [], [], []
+    for route, ordinal, level, was_sent, intents in rows:
+        index.append(routes.setdefault(route, len(routes)))
+        ordinals.append(ordinal)
+        levels.append(level)
+        sent.append(was_sent)
+        attempts.append(intents)
+    if not routes:
+        return []
+    count = len(routes)
+    index, ordinals = np.array(index), np.array(ordinals)
+    sent, attempts = np.array(sent, dtype=np.float64), np.array(attempts, dtype=np.float64)
+    gap = np.array(levels) - ordinals
+
+    # Send rate per attempt of each gap, from every route; a climber further
+    # above the grade never does worse
+    width = 2 * MAX_GAP + 1
+    slot = np.clip(gap, -MAX_GAP, MAX_GAP) + MAX_GAP
+    gap_sends, gap_attempts = np.bincount(slot, sent, width), np.bincount(slot, attempts, width)
+    overall = (sent.sum() + 1) / (attempts.sum() + 2)
+    per_attempt = (gap_sends + overall) / (gap_attempts + 1)
+    # Gaps nobody climbed at take the rate of the nearest one somebody did
+    seen = np.flatnonzero(gap_attempts)
+    nearest = seen[np.abs(np.arange(width)[:, None] - seen[None, :]).argmin(axis=1)]
+    per_attempt = np.maximum.accumulate(per_attempt[nearest])
+    log_send, log_miss = np.log(per_attempt), np.log1p(-per_attempt)
+
+    # Log-posterior of each shift: the journeys as a run of misses ending in
+    # a send (or not), at the gap the route would have if graded k harder
+    shifts = np.arange(-MAX_SHIFT, MAX_SHIFT + 1)
+    posterior = np.empty((count, len(shifts)))
+    for column, k in enumerate(shifts):
+        shifted = np.clip(gap - k, -MAX_GAP, MAX_GAP) + MAX_GAP
+        likelihood = sent * log_send[shifted] + (attempts - sent) * log_miss[shifted]
+        posterior[:, column] = np.bincount(index, likelihood, count) - PRIOR_WEIGHT * k * k
+    posterior = np.exp(posterior - posterior.max(axis=1, keepdims=True))
+    posterior /= posterior.sum(axis=1, keepdims=True)
+    best = posterior.argmax(axis=1)
+    confidence = posterior[np.arange(count), best]
+
+    climbers = np.bincount(index, minlength=count)
+    sends = np.bincount(index, sent, count)
+    rates = []
+    for band in (gap < -1, np.abs(gap) <= 1, gap > 1):
+        rates.append(_rate(np.bincount(index[band], sent[band], count), np.bincount(index[band], minlength=count)))
+
+    # Attempts to send against the average send of the same grade
+    route_ordinal = np.zeros(count, dtype=np.int64)
+    route_ordinal[index] = ordinals
+    send_attempts = np.bincount(index, attempts * sent, count)
+    grade_width = grades.MAX_ORDINAL + 1
+    grade_effort = _rate(
+        np.bincount(route_ordinal, send_attempts, grade_width), np.bincount(route_ordinal, sends, grade_width)
+    )
+    effort = _rate(send_attempts, sends) / grade_effort[route_ordinal]
+
+    def value(x):
+        return None if np.isnan(x) else round(float(x), 3)
+
+    return [
+        route + (
+            int(route_ordinal[i]), int(climbers[i]), int(sends[i]),
+            value(rates[0][i]), value(rates[1][i]), value(rates[2][i]), value(effort[i]),
+            int(shifts[best[i]]), round(float(confidence[i]), 3),
+        )
+        for route, i in routes.items()
+    ]
+
+
+# Recomputes every graded route with journeys. Returns the number of routes
+# flagged soft or hard.
+def run(conn):
+    with conn.cursor() as cur:
+        cur.execute(JOURNEYS)
+        rows = score((tuple(route), ordinal, level, sent, intents) for *route, ordinal, level, sent, intents in cur.fetchall())
+        cur.execute("TRUNCATE practica.route_consensus")
+        extras.execute_values(cur, INSERT, rows, page_size=10000)
+    conn.commit()
+    return sum(1 for row in rows if verdict(row[3], row[10], row[11], row[4]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recompute the grade consensus of every route")
+    args = parser.parse_args()
+
+    conn = db.connect()
+    install(conn)
+    started = time.monotonic()
+    flagged = run(conn)
+    print(f"{flagged} routes flagged soft or hard in {time.monotonic() - started:.1f}s")
@@ -0,0 +1,151 @@
+# Counters for the dashboards, maintained from the change log.
+#
+# practica.stats_counter holds the row counts of crag, via, escalador and
+# intent, and practica.climber_stats the number of attempts and completions
+# of every climber, so the dashboards and the admin Climbers page no longer
+# count rows on each render. The cdc engine applies each batch of changes as
+# one counter update per table and climber. Archived rows stay counted.
+#
+# reconcile() recomputes everything from the base tables and fixes any drift.
+import argparse
+import sys
+
+from practica import archive, cdc, db
+
+NAME = "counters"
+
+COUNTED_TABLES = ["crag", "via", "escalador", "intent"]
+
+TABLES = COUNTED_TABLES + ["encadenament"]
+
+DDL = """
+CREATE TABLE IF NOT EXISTS practica.stats_counter (
+    nom    varchar(50) PRIMARY KEY,
+    valor  bigint NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS practica.climber_stats (
+    nom_usuari     varchar(100) PRIMARY KEY,
+    intents        bigint NOT NULL DEFAULT 0,
+    encadenaments  bigint NOT NULL DEFAULT 0
+);
+"""
+
+# Triggers that maintained the counters before the change log
+LEGACY = """
+DROP TRIGGER IF EXISTS stats_count_insert ON practica.{table};
+DROP TRIGGER IF EXISTS stats_count_delete ON practica.{table};
+DROP TRIGGER IF EXISTS climber_stats_insert ON practica.{table};
+DROP TRIGGER IF EXISTS climber_stats_update ON practica.{table};
+DROP TRIGGER IF EXISTS climber_stats_delete ON practica.{table};
+DROP TRIGGER IF EXISTS climber_stats_intent_deleted ON practica.{table};
+"""
+
+LEGACY_FUNCTIONS = """
+DROP FUNCTION IF EXISTS practica.stats_count_rows();
+DROP FUNCTION IF EXISTS practica.climber_stats_intent();
+DROP FUNCTION IF EXISTS practica.climber_stats_encadenament();
+DROP FUNCTION IF EXISTS practica.climber_stats_intent_deleted();
+"""
+
+COUNT_ROWS = """
+    INSERT INTO practica.stats_counter AS s (nom, valor)
+    SELECT tabla, SUM(sign) FROM cdc_batch WHERE tabla = ANY(%s) GROUP BY tabla
+    ON CONFLICT (nom) DO UPDATE SET valor = s.valor + EXCLUDED.valor
+"""
+
+CLIMBER_DELTA = """
+    INSERT INTO practica.climber_stats AS s (nom_usuari, {column})
+    SELECT nom_usuari_escalador, {sign} * COUNT(*) FROM {rows} r GROUP BY nom_usuari_escalador
+    ON CONFLICT (nom_usuari) DO UPDATE SET {column} = s.{column} + EXCLUDED.{column}
+"""
+
+
+def apply_changes(cur):
+    cur.execute(COUNT_ROWS, (COUNTED_TABLES,))
+    for sign in (1, -1):
+        cur.execute(CLIMBER_DELTA.format(column="intents", sign=sign, rows=cdc.rows("intent", sign)))
+        cur.execute(CLIMBER_DELTA.format(column="encadenaments", sign=sign, rows=cdc.completions(sign)))
+
+
+# Exact counts, archived rows included
+def _exact_queries(archived):
+    totals = {table: f"SELECT COUNT(*) FROM practica.{table}" for table in COUNTED_TABLES}
+    intent_table = archive.source("intent", archived)
+    encadenament_table = archive.source("encadenament", archived)
+    totals["intent"] = f"SELECT COUNT(*) FROM {intent_table}"
+    per_climber = f"""
+        SELECT i.nom_usuari_escalador, COUNT(*), COUNT(e.id_intent)
+        FROM {intent_table} i
+        LEFT JOIN {encadenament_table} e ON e.id_intent = i.id_intent
+        GROUP BY i.nom_usuari_escalador
+    """
+    return totals, per_climber
+
+
+# Set every counter to its exact value; returns how far off each one was
+def refill(cur, archived):
+    totals, per_climber = _exact_queries(archived)
+    drift = {}
+    for name, count_sql in totals.items():
+        cur.execute(count_sql)
+        exact = cur.fetchone()[0]
+        cur.execute("SELECT valor FROM practica.stats_counter WHERE nom = %s", (name,))
+        row = cur.fetchone()
+        drift[name] = exact - (row[0] if row else 0)
+        cur.execute(
+            """
+            INSERT INTO practica.stats_counter (nom, valor) VALUES (%s, %s)
+            ON CONFLICT (nom) DO UPDATE SET valor = EXCLUDED.valor
+            """,
+            (name, exact)
+        )
+
+    cur.execute(
+        f"""
+        WITH exact (nom_usuari, intents, encadenaments) AS ({per_climber}),
+        fixed AS (
+            INSERT INTO practica.climber_stats AS s (nom_usuari, intents, encadenaments)
+            SELECT nom_usuari, intents, encadenaments FROM exact
+            ON CONFLICT (nom_usuari) DO UPDATE
+                SET intents = EXCLUDED.intents, encadenaments = EXCLUDED.encadenaments
+                WHERE (s.intents, s.encadenaments) IS DISTINCT FROM (EXCLUDED.intents, EXCLUDED.encadenaments)
+            RETURNING 1
+        ),
+        emptied AS (
+            UPDATE practica.climber_stats s SET intents = 0, encadenaments = 0
+            WHERE (s.intents <> 0 OR s.encadenaments <> 0)
+              AND NOT EXISTS (SELECT 1 FROM exact WHERE exact.nom_usuari = s.nom_usuari)
+            RETURNING 1
+        )
+        SELECT (SELECT COUNT(*) FROM fixed) + (SELECT COUNT(*) FROM emptied)
+        """
+    )
+    drift["climbers"] = cur.fetchone()[0]
+    return drift
+
+
+def install(conn):
+    cdc.install(conn)
+    with conn.cursor() as cur:
+        cur.execute(DDL)
+        for table in TABLES:
+            cur.execute(LEGACY.format(table=table))
+        cur.execute(LEGACY_FUNCTIONS)
+    conn.commit()
+    cdc.subscribe(conn, sys.modules[__name__])
+
+
+# Recompute every counter; returns how far off each one was
+def reconcile(conn):
+    return cdc.subscribe(conn, sys.modules[__name__], rebuild=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recompute the dashboard counters from the base tables")
+    parser.parse_args()
+
+    conn = db.connect()
+    install(conn)
+    for name, off_by in reconcile(conn).items():
+        print(f"{name}: {off_by}")
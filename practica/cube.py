@@ -0,0 +1,254 @@
+# Pre-aggregated activity cube for the admin Analytics page.
+#
+# practica.route_activity_day holds the attempts, completions, comments,
+# recommendations and rating sum/count of every route and day, kept up to
+# date from the change log like the monthly rollup (see activity.py).
+# Unique climbers don't add up across days or routes, so
+# practica.route_climber_hll keeps a HyperLogLog sketch of the climbers active
+# on each route and day (see hll.py), merged on read into approximate
+# distinct counts for any crag, sector, month or year. Both tables lead with
+# the crag, so drilling crag -> sector -> route only reads a prefix of their
+# primary keys; year -> month -> day roll-ups group the day rows.
+#
+# Sketches can't forget a climber, so the sketches of the routes and days
+# touched by a delete or an update are recomputed from the activity tables.
+import argparse
+import sys
+from datetime import date
+
+import psycopg2
+from psycopg2 import extras
+
+from practica import activity, archive, cdc, db, hll
+
+NAME = "cube"
+
+TABLES = activity.TABLES
+
+DAY = ("route_cube", "practica.route_activity_day", "dia", "day")
+
+PLACE = ["nom_crag_via", "nom_sector_via", "nom_via"]
+PLACE_COLUMNS = ", ".join(PLACE)
+
+DDL = """
+CREATE TABLE IF NOT EXISTS practica.route_activity_day (
+    nom_crag_via    varchar(255) NOT NULL,
+    nom_sector_via  varchar(255) NOT NULL,
+    nom_via         varchar(255) NOT NULL,
+    dia             date NOT NULL,
+    intents         bigint NOT NULL DEFAULT 0,
+    encadenaments   bigint NOT NULL DEFAULT 0,
+    recomanacions   bigint NOT NULL DEFAULT 0,
+    rating_sum      bigint NOT NULL DEFAULT 0,
+    rating_count    bigint NOT NULL DEFAULT 0,
+    comentaris      bigint NOT NULL DEFAULT 0,
+    PRIMARY KEY (nom_crag_via, nom_sector_via, nom_via, dia)
+);
+CREATE INDEX IF NOT EXISTS route_activity_day_dia_idx ON practica.route_activity_day (dia);
+
+DROP TABLE IF EXISTS practica.route_climber_day;
+CREATE TABLE IF NOT EXISTS practica.route_climber_hll (
+    nom_crag_via    varchar(255) NOT NULL,
+    nom_sector_via  varchar(255) NOT NULL,
+    nom_via         varchar(255) NOT NULL,
+    dia             date NOT NULL,
+    sketch          bytea NOT NULL,
+    PRIMARY KEY (nom_crag_via, nom_sector_via, nom_via, dia)
+);
+CREATE INDEX IF NOT EXISTS route_climber_hll_dia_idx ON practica.route_climber_hll (dia);
+
+-- Recomputing the sketch of one route and day
+CREATE INDEX IF NOT EXISTS intent_via_data_idx
+    ON practica.intent (nom_crag_via, nom_sector_via, nom_via, data_intent);
+CREATE INDEX IF NOT EXISTS recomanacio_via_data_idx
+    ON practica.recomanacio (nom_crag_via, nom_sector_via, nom_via, data_recomanacio);
+CREATE INDEX IF NOT EXISTS comentari_via_data_idx
+    ON practica.comentari (nom_crag_via, nom_sector_via, nom_via, data_comentari);
+"""
+
+# Date column of the activity tables that carry a climber. A climber is
+# active on a route and day if they attempted, rated or commented on it, so
+# the sketches count active climbers, not only those who climbed.
+CLIMBER_DATES = {
+    "intent": "data_intent",
+    "recomanacio": "data_recomanacio",
+    "comentari": "data_comentari",
+}
+
+# (route, day, climber) of the rows of an activity table, optionally only for
+# the routes and days in the arrays passed as parameters
+CLIMBER_ROWS = """
+    SELECT r.nom_crag_via, r.nom_sector_via, r.nom_via, date_trunc('day', r.{date})::date, r.nom_usuari_escalador
+    FROM {rows} r {keys}
+"""
+
+KEYS_JOIN = """
+    JOIN unnest(%s::text[], %s::text[], %s::text[], %s::date[]) AS k (nom_crag_via, nom_sector_via, nom_via, dia)
+      ON r.nom_crag_via = k.nom_crag_via AND r.nom_sector_via = k.nom_sector_via AND r.nom_via = k.nom_via
+     AND r.{date} >= k.dia AND r.{date} < k.dia + 1
+"""
+
+UPSERT_SKETCHES = f"""
+    INSERT INTO practica.route_climber_hll ({PLACE_COLUMNS}, dia, sketch) VALUES %s
+    ON CONFLICT ({PLACE_COLUMNS}, dia) DO UPDATE SET sketch = EXCLUDED.sketch
+"""
+
+
+def _key_arrays(keys):
+    return [list(column) for column in zip(*keys)] if keys else [[], [], [], []]
+
+
+# Climbers per (route, day) from the rows of the given relations
+def _climbers(cur, relations, keys=None):
+    climbers = {}
+    for table, rows in relations:
+        date_column = CLIMBER_DATES[table]
+        keys_join = KEYS_JOIN.format(date=date_column) if keys is not None else ""
+        cur.execute(
+            CLIMBER_ROWS.format(date=date_column, rows=rows, keys=keys_join),
+            _key_arrays(keys) if keys is not None else None
+        )
+        for crag, sector, route, day, climber in cur.fetchall():
+            climbers.setdefault((crag, sector, route, day), set()).add(climber)
+    return climbers
+
+
+def _store(cur, sketches):
+    if sketches:
+        extras.execute_values(
+            cur, UPSERT_SKETCHES,
+            [key + (psycopg2.Binary(hll.encode(registers)),) for key, registers in sketches.items()]
+        )
+
+
+def _existing(cur, keys):
+    cur.execute(
+        f"""
+        SELECT s.nom_crag_via, s.nom_sector_via, s.nom_via, s.dia, s.sketch
+        FROM practica.route_climber_hll s
+        JOIN unnest(%s::text[], %s::text[], %s::text[], %s::date[]) AS k (nom_crag_via, nom_sector_via, nom_via, dia)
+          USING ({PLACE_COLUMNS}, dia)
+        """,
+        _key_arrays(keys)
+    )
+    return {tuple(row[:4]): hll.decode(row[4]) for row in cur.fetchall()}
+
+
+def _apply_climbers(cur):
+    added = _climbers(cur, [(table, cdc.rows(table, 1)) for table in CLIMBER_DATES])
+    removed = set(_climbers(cur, [(table, cdc.rows(table, -1)) for table in CLIMBER_DATES]))
+
+    # New climbers are merged into the existing sketches
+    merged = {key: climbers for key, climbers in added.items() if key not in removed}
+    existing = _existing(cur, list(merged))
+    _store(cur, {key: hll.add(existing.get(key, hll.empty()), climbers) for key, climbers in merged.items()})
+
+    # Routes and days that lost rows are recomputed
+    if removed:
+        archived = archive.installed_in(cur)
+        keys = list(removed)
+        current = _climbers(cur, [(table, archive.source(table, archived)) for table in CLIMBER_DATES], keys)
+        _store(cur, {key: hll.of(climbers) for key, climbers in current.items()})
+        gone = [key for key in keys if key not in current]
+        if gone:
+            cur.execute(
+                f"""
+                DELETE FROM practica.route_climber_hll s
+                USING unnest(%s::text[], %s::text[], %s::text[], %s::date[]) AS k (nom_crag_via, nom_sector_via, nom_via, dia)
+                WHERE (s.nom_crag_via, s.nom_sector_via, s.nom_via, s.dia) = (k.nom_crag_via, k.nom_sector_via, k.nom_via, k.dia)
+                """,
+                _key_arrays(gone)
+            )
+
+
+def refill(cur, archived):
+    activity.refill_rollup(cur, DAY, archived)
+    cur.execute("TRUNCATE practica.route_climber_hll")
+    climbers = _climbers(cur, [(table, archive.source(table, archived)) for table in CLIMBER_DATES])
+    _store(cur, {key: hll.of(names) for key, names in climbers.items()})
+
+
+def apply_changes(cur):
+    activity.apply_rollup(cur, DAY)
+    _apply_climbers(cur)
+
+
+def install(conn):
+    cdc.install(conn)
+    with conn.cursor() as cur:
+        cur.execute(DDL)
+        activity.drop_legacy_triggers(cur, DAY)
+    conn.commit()
+    cdc.subscribe(conn, sys.modules[__name__])
+
+
+# Recompute the whole cube from the activity tables, archived rows included
+def rebuild(conn):
+    cdc.subscribe(conn, sys.modules[__name__], rebuild=True)
+
+
+# WHERE clause and params selecting a slice of the cube.
+# place is a prefix of (crag, sector, route), period one of (), (year,) or (year, month).
+def _slice(place, period):
+    conditions = [f"{column} = %s" for column in PLACE[:len(place)]]
+    params = list(place)
+    if period:
+        year, month = period[0], (period[1] if len(period) > 1 else None)
+        start = date(year, month or 1, 1)
+        if month is None:
+            end = date(year + 1, 1, 1)
+        else:
+            end = date(year + (month == 12), month % 12 + 1, 1)
+        conditions.append("dia >= %s AND dia < %s")
+        params += [start, end]
+    return " AND ".join(conditions) or "true", params
+
+
+# Grouping one level below a slice: the crags, sectors or routes in it
+# (by="place"), its years, months or days (by="time"), or whole routes
+# (by="route")
+def _group(place, period, by):
+    if by == "place":
+        return PLACE[min(len(place), len(PLACE) - 1)]
+    if by == "route":
+        return PLACE_COLUMNS
+    return f"date_trunc('{['year', 'month', 'day'][len(period)]}', dia)::date"
+
+
+# Measures of a slice grouped one level down.
+# Rows are (group, attempts, completions, comments, recommendations, average rating).
+def breakdown_query(place=(), period=(), by="place"):
+    where, params = _slice(place, period)
+    query = f"""
+        SELECT {_group(place, period, by)}, SUM(intents), SUM(encadenaments), SUM(comentaris), SUM(recomanacions),
+               ROUND(SUM(rating_sum)::numeric / NULLIF(SUM(rating_count), 0), 2)
+        FROM practica.route_activity_day
+        WHERE {where}
+        GROUP BY 1
+        ORDER BY 1
+    """
+    return query, tuple(params)
+
+
+# Climber sketches of a slice as rows of (group..., hex sketch), for
+# hll.estimate_groups(). by=None puts the whole slice in one group.
+def climber_sketches_query(place=(), period=(), by=None):
+    where, params = _slice(place, period)
+    group = _group(place, period, by) if by else "'all'"
+    query = f"""
+        SELECT {group}, encode(sketch, 'hex')
+        FROM practica.route_climber_hll
+        WHERE {where}
+    """
+    return query, tuple(params)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the activity cube")
+    parser.add_argument("--rebuild", action="store_true", help="recompute everything from the activity tables")
+    args = parser.parse_args()
+
+    conn = db.connect()
+    install(conn)
+    if args.rebuild:
+        rebuild(conn)
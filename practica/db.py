@@ -0,0 +1,24 @@
+# Connection settings shared by the batch jobs in this package.
+# They read the same environment variables as adminApp and userApp.
+import os
+
+import psycopg2
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def settings(**overrides):
+    params = {
+        "dbname": os.getenv("DB_NAME", "postgres"),
+        "user": os.getenv("DB_USER", "postgres"),
+        "password": os.getenv("DB_PASSWORD", ""),
+        "host": os.getenv("DB_HOST", "localhost"),
+        "port": os.getenv("DB_PORT", "5432"),
+    }
+    params.update(overrides)
+    return params
+
+
+def connect(**overrides):
+    return psycopg2.connect(**settings(**overrides))
@@ -0,0 +1,239 @@
+# Facet counts for the admin filters.
+#
+# practica.facet_count holds the number of attempts, completions, comments
+# and recommendations of every (climber, crag, ascent type) combination that
+# has any, so the filter dropdowns can list their values with live counts
+# under the current selection by summing one row per combination instead of
+# scanning the activity tables. That is at most climbers x crags x types
+# rows per dataset, and all of them while nothing is selected; a selected
+# climber, crag or type reads only its rows, through the index on it. Each
+# facet's counts apply the selections of the other facets only, so picking a
+# climber narrows the crag list to the crags they have climbed at without
+# hiding the other climbers.
+#
+# The counts are kept up to date from the change log. Moves into the archive
+# aren't logged, so triggers on the archive tables keep the archived share of
+# each count in the "archived" column, for the pages where archived data is
+# switched off. Deletes from the archive tables are logged, and take their
+# rows off both n and archived. Combinations whose count drops to zero are
+# removed.
+import argparse
+import sys
+
+from practica import archive, cdc, db
+
+NAME = "facets"
+
+TABLES = ["intent", "encadenament", "comentari", "recomanacio"]
+
+COLUMNS = ["nom_usuari_escalador", "nom_crag_via", "tipus_ascensio"]
+KEY = "dataset, " + ", ".join(COLUMNS)
+
+# Filterable columns of each dataset
+DATASETS = {
+    "attempts": COLUMNS,
+    "completions": COLUMNS,
+    "comments": COLUMNS[:2],
+    "recommendations": COLUMNS[:2],
+}
+
+DDL = f"""
+CREATE TABLE IF NOT EXISTS practica.facet_count (
+    dataset               varchar(20) NOT NULL,
+    nom_usuari_escalador  varchar(100) NOT NULL,
+    nom_crag_via          varchar(255) NOT NULL,
+    tipus_ascensio        varchar(100) NOT NULL DEFAULT '',
+    n                     bigint NOT NULL DEFAULT 0,
+    archived              bigint NOT NULL DEFAULT 0,
+    PRIMARY KEY ({KEY})
+);
+CREATE INDEX IF NOT EXISTS facet_count_crag_idx ON practica.facet_count (dataset, nom_crag_via);
+CREATE INDEX IF NOT EXISTS facet_count_climber_idx ON practica.facet_count (dataset, nom_usuari_escalador);
+CREATE INDEX IF NOT EXISTS facet_count_type_idx ON practica.facet_count (dataset, tipus_ascensio);
+"""
+
+# Archived share of the counts, from the rows moved into the archive tables.
+# Completions are archived with their attempt, in the same statement.
+ARCHIVE_DDL = f"""
+CREATE OR REPLACE FUNCTION practica.facet_archived() RETURNS trigger AS $$
+BEGIN
+    IF TG_TABLE_NAME = 'intent_archive' THEN
+        INSERT INTO practica.facet_count AS f ({KEY}, archived)
+        SELECT 'attempts', r.nom_usuari_escalador, r.nom_crag_via, COALESCE(r.tipus_ascensio, ''), COUNT(*)
+        FROM moved r GROUP BY 2, 3, 4
+        ON CONFLICT ({KEY}) DO UPDATE SET archived = f.archived + EXCLUDED.archived;
+
+        INSERT INTO practica.facet_count AS f ({KEY}, archived)
+        SELECT 'completions', r.nom_usuari_escalador, r.nom_crag_via, COALESCE(r.tipus_ascensio, ''), COUNT(*)
+        FROM moved r JOIN practica.encadenament_archive e ON e.id_intent = r.id_intent
+        GROUP BY 2, 3, 4
+        ON CONFLICT ({KEY}) DO UPDATE SET archived = f.archived + EXCLUDED.archived;
+    ELSE
+        INSERT INTO practica.facet_count AS f ({KEY}, archived)
+        SELECT TG_ARGV[0], r.nom_usuari_escalador, r.nom_crag_via, '', COUNT(*)
+        FROM moved r GROUP BY 2, 3, 4
+        ON CONFLICT ({KEY}) DO UPDATE SET archived = f.archived + EXCLUDED.archived;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS facet_archived ON practica.intent_archive;
+CREATE TRIGGER facet_archived
+    AFTER INSERT ON practica.intent_archive
+    REFERENCING NEW TABLE AS moved
+    FOR EACH STATEMENT EXECUTE FUNCTION practica.facet_archived('attempts');
+
+DROP TRIGGER IF EXISTS facet_archived ON practica.comentari_archive;
+CREATE TRIGGER facet_archived
+    AFTER INSERT ON practica.comentari_archive
+    REFERENCING NEW TABLE AS moved
+    FOR EACH STATEMENT EXECUTE FUNCTION practica.facet_archived('comments');
+
+DROP TRIGGER IF EXISTS facet_archived ON practica.recomanacio_archive;
+CREATE TRIGGER facet_archived
+    AFTER INSERT ON practica.recomanacio_archive
+    REFERENCING NEW TABLE AS moved
+    FOR EACH STATEMENT EXECUTE FUNCTION practica.facet_archived('recommendations');
+"""
+
+APPLY_DELTA = f"""
+    INSERT INTO practica.facet_count AS f ({KEY}, {{column}})
+    SELECT %s, r.nom_usuari_escalador, r.nom_crag_via, {{ascent_type}}, {{sign}} * COUNT(*)
+    FROM {{rows}} r GROUP BY 2, 3, 4
+    ON CONFLICT ({KEY}) DO UPDATE SET {{column}} = f.{{column}} + EXCLUDED.{{column}}
+"""
+
+# Combinations left without rows by the removals of the batch
+REMOVE_EMPTY = """
+    DELETE FROM practica.facet_count f
+    USING (SELECT DISTINCT r.nom_usuari_escalador, r.nom_crag_via, {ascent_type} AS tipus_ascensio FROM {rows} r) r
+    WHERE f.dataset = %s AND f.n <= 0
+      AND (f.nom_usuari_escalador, f.nom_crag_via, f.tipus_ascensio) = (r.nom_usuari_escalador, r.nom_crag_via, r.tipus_ascensio)
+"""
+
+REFILL = f"""
+    INSERT INTO practica.facet_count ({KEY}, n, archived)
+    SELECT %s, r.nom_usuari_escalador, r.nom_crag_via, {{ascent_type}}, COUNT(*), COUNT(*) FILTER (WHERE r.archived)
+    FROM ({{rows}}) r GROUP BY 2, 3, 4
+"""
+
+
+# Ascent type column of a dataset's rows ('' where there is none)
+def _ascent_type(dataset):
+    return "COALESCE(r.tipus_ascensio, '')" if "tipus_ascensio" in DATASETS[dataset] else "''"
+
+
+# Rows of each dataset added (sign 1) or removed (sign -1) in the current
+# batch, or only those removed from the archive tables
+def _changes(sign, archived_only=False):
+    return {
+        "attempts": cdc.rows("intent", sign, archived_only),
+        "completions": cdc.completions(sign, archived_only),
+        "comments": cdc.rows("comentari", sign, archived_only),
+        "recommendations": cdc.rows("recomanacio", sign, archived_only),
+    }
+
+
+# Rows of each dataset with an "archived" flag, archived rows included if
+# the archive is installed
+ROWS = {
+    "attempts": "SELECT r.*, {archived} AS archived FROM practica.intent{suffix} r",
+    "completions": (
+        "SELECT r.*, {archived} AS archived FROM practica.intent{suffix} r"
+        " JOIN practica.encadenament{suffix} e ON e.id_intent = r.id_intent"
+    ),
+    "comments": "SELECT r.*, {archived} AS archived FROM practica.comentari{suffix} r",
+    "recommendations": "SELECT r.*, {archived} AS archived FROM practica.recomanacio{suffix} r",
+}
+
+
+def _all_rows(dataset, archived):
+    rows = ROWS[dataset].format(archived="false", suffix="")
+    if archived:
+        rows += " UNION ALL " + ROWS[dataset].format(archived="true", suffix="_archive")
+    return rows
+
+
+def apply_changes(cur):
+    for sign in (1, -1):
+        for dataset, rows in _changes(sign).items():
+            cur.execute(APPLY_DELTA.format(column="n", ascent_type=_ascent_type(dataset), sign=sign, rows=rows), (dataset,))
+    for dataset, rows in _changes(-1, archived_only=True).items():
+        cur.execute(APPLY_DELTA.format(column="archived", ascent_type=_ascent_type(dataset), sign=-1, rows=rows), (dataset,))
+    for dataset, rows in _changes(-1).items():
+        cur.execute(REMOVE_EMPTY.format(ascent_type=_ascent_type(dataset), rows=rows), (dataset,))
+
+
+def refill(cur, archived):
+    cur.execute("TRUNCATE practica.facet_count")
+    for dataset in DATASETS:
+        cur.execute(REFILL.format(ascent_type=_ascent_type(dataset), rows=_all_rows(dataset, archived)), (dataset,))
+
+
+def install(conn):
+    cdc.install(conn)
+    with conn.cursor() as cur:
+        cur.execute(DDL)
+        if archive.installed_in(cur):
+            cur.execute(ARCHIVE_DDL)
+    conn.commit()
+    cdc.subscribe(conn, sys.modules[__name__])
+
+
+def rebuild(conn):
+    cdc.subscribe(conn, sys.modules[__name__], rebuild=True)
+
+
+# Conditions on the given table alias for a selection {column: [values]}; an
+# empty list leaves the column unfiltered
+def filter_clause(selection, alias, skip=None):
+    conditions, params = [], []
+    for column, values in selection.items():
+        if values and column != skip:
+            target = f"COALESCE({alias}.{column}, '')" if column == "tipus_ascensio" else f"{alias}.{column}"
+            conditions.append(f" AND {target} = ANY(%s)")
+            params.append(list(values))
+    return "".join(conditions), params
+
+
+def _measure(include_archived):
+    return "n" if include_archived else "n - archived"
+
+
+# Values of one facet with their counts under the other facets' selection.
+# Rows are (value, count), only values with a count.
+def counts_query(dataset, column, selection, include_archived=False):
+    conditions, params = filter_clause(selection, "f", skip=column)
+    measure = _measure(include_archived)
+    query = f"""
+        SELECT f.{column}, SUM({measure})
+        FROM practica.facet_count f
+        WHERE f.dataset = %s {conditions}
+        GROUP BY 1
+        HAVING SUM({measure}) > 0
+        ORDER BY 1
+    """
+    return query, tuple([dataset] + params)
+
+
+# Number of rows matching the whole selection
+def total_query(dataset, selection, include_archived=False):
+    conditions, params = filter_clause(selection, "f")
+    query = f"""
+        SELECT COALESCE(SUM({_measure(include_archived)}), 0)
+        FROM practica.facet_count f
+        WHERE f.dataset = %s {conditions}
+    """
+    return query, tuple([dataset] + params)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the admin filter facet counts")
+    parser.add_argument("--rebuild", action="store_true", help="recompute every count from the activity tables")
+    args = parser.parse_args()
+
+    conn = db.connect()
+    install(conn)
+    if args.rebuild:
+        rebuild(conn)
@@ -0,0 +1,234 @@
+# Climbing-grade codec.
+#
+# Parses French sport grades (6a+), UIAA (VII-) and YDS (5.11c), normalises
+# their spelling and maps them onto a common ordinal scale so that grades can
+# be sorted and compared as numbers. The ordinal is stored in
+# via.grau_ordinal, kept up to date by a trigger that looks the normalised
+# text up in practica.grau_escala, and indexed for range filters.
+import re
+
+# ordinal -> (French, UIAA, YDS)
+CHART = [
+    (1, "1", "I", "5.1"),
+    (2, "2", "II", "5.2"),
+    (3, "3", "III", "5.3"),
+    (4, "4a", "IV", "5.4"),
+    (5, "4b", "IV+", "5.5"),
+    (6, "4c", "V-", "5.6"),
+    (7, "5a", "V", "5.7"),
+    (8, "5b", "V+", "5.8"),
+    (9, "5c", "VI-", "5.9"),
+    (10, "6a", "VI", "5.10a"),
+    (11, "6a+", "VI+", "5.10b"),
+    (12, "6b", "VII-", "5.10c"),
+    (13, "6b+", "VII", "5.10d"),
+    (14, "6c", "VII+", "5.11a"),
+    (15, "6c+", "VIII-", "5.11b"),
+    (16, "7a", "VIII", "5.11d"),
+    (17, "7a+", "VIII+", "5.12a"),
+    (18, "7b", "IX-", "5.12b"),
+    (19, "7b+", "IX", "5.12c"),
+    (20, "7c", "IX+", "5.12d"),
+    (21, "7c+", "X-", "5.13a"),
+    (22, "8a", "X", "5.13b"),
+    (23, "8a+", "X+", "5.13c"),
+    (24, "8b", "XI-", "5.13d"),
+    (25, "8b+", "XI", "5.14a"),
+    (26, "8c", "XI+", "5.14b"),
+    (27, "8c+", "XII-", "5.14c"),
+    (28, "9a", "XII", "5.14d"),
+    (29, "9a+", "XII+", "5.15a"),
+    (30, "9b", "XIII-", "5.15b"),
+    (31, "9b+", "XIII", "5.15c"),
+    (32, "9c", "XIII+", "5.15d"),
+]
+
+SYSTEMS = ("french", "uiaa", "yds")
+
+MIN_ORDINAL = CHART[0][0]
+MAX_ORDINAL = CHART[-1][0]
+
+# Spellings without their own row in the chart
+ALIASES = {
+    "french": {"4": 4, "4+": 5, "5": 7, "5+": 8, "6": 10},
+    "uiaa": {},
+    "yds": {"5.11c": 16, "5.10": 10, "5.11": 14, "5.12": 17, "5.13": 21, "5.14": 25, "5.15": 29},
+}
+
+_ROMAN = re.compile(r"^(xiii|xii|xi|x|ix|viii|vii|vi|v|iv|iii|ii|i)([+-]?)$")
+_YDS_SIGN = re.compile(r"^(5\.1[0-5])([+-])$")
+
+
+# Typographic pluses and minuses and their ASCII spelling. normalize() and
+# the database's practica.grau_normalitzat() are both built from these.
+SIGNS = {"⁺": "+", "−": "-", "–": "-"}
+SPLIT = "/"
+
+
+def normalize(grade):
+    # Lower case without blanks, with typographic pluses/minuses made ASCII
+    if grade is None:
+        return None
+    text = str(grade).strip().lower()
+    text = text.translate(str.maketrans(SIGNS))
+    text = re.sub(r"\s+", "", text)
+    # "6b/6b+" style split grades count as the easier one
+    if SPLIT in text:
+        text = text.split(SPLIT)[0]
+    return text or None
+
+
+def _build_lookup():
+    lookup = {}
+    for ordinal, french, uiaa, yds in CHART:
+        lookup[french] = (ordinal, "french")
+        lookup[uiaa.lower()] = (ordinal, "uiaa")
+        lookup[yds] = (ordinal, "yds")
+    for system, aliases in ALIASES.items():
+        for label, ordinal in aliases.items():
+            lookup.setdefault(label, (ordinal, system))
+    return lookup
+
+
+LOOKUP = _build_lookup()
+_LABELS = {ordinal: {"french": french, "uiaa": uiaa, "yds": yds} for ordinal, french, uiaa, yds in CHART}
+
+
+# Ordinal of a grade written in any supported system, or None if unknown
+def parse(grade):
+    text = normalize(grade)
+    if text is None:
+        return None
+    if text in LOOKUP:
+        return LOOKUP[text][0]
+    # 5.10- / 5.10+ mean the bottom and the top of the letter range
+    match = _YDS_SIGN.match(text)
+    if match:
+        base, sign = match.groups()
+        return LOOKUP[base + ("a" if sign == "-" else "d")][0]
+    # Roman numerals written with a sign the chart doesn't list, e.g. "IV-"
+    match = _ROMAN.match(text)
+    if match and match.group(1) in LOOKUP:
+        return LOOKUP[match.group(1)][0]
+    return None
+
+
+# Every normalised spelling parse() understands, as {spelling: (ordinal,
+# system)}: the chart and its aliases, plus the signed YDS and roman numeral
+# forms parse() works out
+def spellings():
+    known = dict(LOOKUP)
+    for _, _, uiaa, yds in CHART:
+        for base in (yds[:4], uiaa.lower().rstrip("+-")):
+            for sign in "+-":
+                text = base + sign
+                if text not in known and parse(text) is not None:
+                    known[text] = (parse(text), system_of(text))
+    return known
+
+
+# System a grade is written in: "french", "uiaa", "yds" or None
+def system_of(grade):
+    text = normalize(grade)
+    if text in LOOKUP:
+        return LOOKUP[text][1]
+    if text and _YDS_SIGN.match(text):
+        return "yds"
+    if text and _ROMAN.match(text):
+        return "uiaa"
+    return None
+
+
+def label(ordinal, system="french"):
+    if ordinal is None:
+        return None
+    ordinal = int(round(ordinal))
+    ordinal = min(max(ordinal, MIN_ORDINAL), MAX_ORDINAL)
+    return _LABELS[ordinal][system]
+
+
+def convert(grade, system="french"):
+    return label(parse(grade), system)
+
+
+# Vectorised parse for a pandas Series: each distinct spelling is parsed once
+def to_ordinals(series):
+    codes = {value: parse(value) for value in series.dropna().unique()}
+    return series.map(codes).astype("Float64")
+
+
+def to_labels(series, system="french"):
+    codes = {value: label(value, system) for value in series.dropna().unique()}
+    return series.map(codes)
+
+
+DDL = f"""
+CREATE TABLE IF NOT EXISTS practica.grau_escala (
+    grau     varchar(20) PRIMARY KEY,
+    sistema  varchar(10) NOT NULL,
+    ordinal  smallint NOT NULL
+);
+
+ALTER TABLE practica.via ADD COLUMN IF NOT EXISTS grau_ordinal smallint;
+CREATE INDEX IF NOT EXISTS via_grau_ordinal_idx ON practica.via (grau_ordinal);
+
+-- Same as grades.normalize()
+CREATE OR REPLACE FUNCTION practica.grau_normalitzat(grau text) RETURNS text AS $$
+    SELECT NULLIF(split_part(
+        regexp_replace(translate(lower(btrim(grau)), '{"".join(SIGNS)}', '{"".join(SIGNS.values())}'), '\\s+', '', 'g'),
+        '{SPLIT}', 1
+    ), '')
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION practica.via_grau_ordinal() RETURNS trigger AS $$
+BEGIN
+    NEW.grau_ordinal := (
+        SELECT ordinal FROM practica.grau_escala
+        WHERE grau = practica.grau_normalitzat(NEW.grau_dificultat)
+    );
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS via_grau_ordinal ON practica.via;
+CREATE TRIGGER via_grau_ordinal
+    BEFORE INSERT OR UPDATE OF grau_dificultat ON practica.via
+    FOR EACH ROW EXECUTE FUNCTION practica.via_grau_ordinal();
+"""
+
+
+# Create the lookup table, column, index and trigger, then backfill existing routes
+def install(conn):
+    with conn.cursor() as cur:
+        cur.execute(DDL)
+        cur.executemany(
+            """
+            INSERT INTO practica.grau_escala (grau, sistema, ordinal) VALUES (%s, %s, %s)
+            ON CONFLICT (grau) DO UPDATE SET sistema = EXCLUDED.sistema, ordinal = EXCLUDED.ordinal
+            """,
+            [(grade, system, ordinal) for grade, (ordinal, system) in spellings().items()]
+        )
+    conn.commit()
+    backfill(conn)
+
+
+# Recompute grau_ordinal with the Python parser, e.g. for routes written
+# before the trigger was installed
+def backfill(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT DISTINCT grau_dificultat FROM practica.via WHERE grau_dificultat IS NOT NULL")
+        grades = [(parse(row[0]), row[0]) for row in cur.fetchall()]
+        cur.executemany(
+            """
+            UPDATE practica.via SET grau_ordinal = %s
+            WHERE grau_dificultat = %s AND grau_ordinal IS DISTINCT FROM %s
+            """,
+            [(ordinal, grade, ordinal) for ordinal, grade in grades]
+        )
+    conn.commit()
+
+
+if __name__ == "__main__":
+    from practica import db
+
+    install(db.connect())
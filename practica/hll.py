@@ -0,0 +1,101 @@
+# HyperLogLog sketches for approximate distinct counts.
+#
+# A sketch has 2**P registers; each climber name is hashed to 64 bits, the
+# first P bits choose a register and the register keeps the longest run of
+# leading zeros (+1) seen in the remaining bits. Sketches merge by taking
+# the register-wise maximum, so per (route, day) sketches roll up to any
+# sector, crag, month or year without going back to the rows.
+#
+# With P = 12 (4096 registers) the standard error of an estimate is
+# 1.04 / sqrt(4096) ~ 1.6%: about 2 in 3 estimates are within 1.6% of the true
+# count and 19 in 20 within 3.3%. Below ~10,000 distinct values the linear
+# counting correction is used instead, which is off by at most a few units
+# for the handful of climbers a route sees in a day.
+#
+# Sketches are stored as bytea: sparse (a 0 byte followed by 3-byte
+# (register, rank) pairs) while few registers are set, which is the case for
+# nearly every route and day, and dense (a 1 byte followed by one byte per
+# register) otherwise.
+import hashlib
+import math
+
+import numpy as np
+
+P = 12
+M = 1 << P
+
+STANDARD_ERROR = 1.04 / math.sqrt(M)
+
+_ALPHA = 0.7213 / (1 + 1.079 / M)
+_SPARSE, _DENSE = 0, 1
+_PAIR = np.dtype([("register", ">u2"), ("rank", "u1")])
+
+
+def empty():
+    return np.zeros(M, dtype=np.uint8)
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), "big")
+
+
+def add(registers, values):
+    for value in values:
+        h = _hash(value)
+        register = h >> (64 - P)
+        rest = h & ((1 << (64 - P)) - 1)
+        rank = (64 - P) - rest.bit_length() + 1
+        if rank > registers[register]:
+            registers[register] = rank
+    return registers
+
+
+def of(values):
+    return add(empty(), values)
+
+
+def merge(sketches):
+    registers = empty()
+    for sketch in sketches:
+        np.maximum(registers, sketch, out=registers)
+    return registers
+
+
+def estimate(registers):
+    zeros = int(np.count_nonzero(registers == 0))
+    raw = _ALPHA * M * M / float(np.sum(np.ldexp(1.0, -registers.astype(np.int32))))
+    if raw <= 2.5 * M and zeros:
+        return round(M * math.log(M / zeros))
+    return round(raw)
+
+
+def encode(registers):
+    nonzero = np.flatnonzero(registers)
+    if len(nonzero) * _PAIR.itemsize < M:
+        pairs = np.empty(len(nonzero), dtype=_PAIR)
+        pairs["register"] = nonzero
+        pairs["rank"] = registers[nonzero]
+        return bytes([_SPARSE]) + pairs.tobytes()
+    return bytes([_DENSE]) + registers.tobytes()
+
+
+def decode(data):
+    data = bytes(data)
+    if data[0] == _DENSE:
+        return np.frombuffer(data, dtype=np.uint8, offset=1).copy()
+    pairs = np.frombuffer(data, dtype=_PAIR, offset=1)
+    registers = empty()
+    registers[pairs["register"].astype(np.intp)] = pairs["rank"]
+    return registers
+
+
+# Distinct counts per group from rows of (group..., sketch), where sketch is
+# bytea or its hex text (e.g. from encode(sketch, 'hex'))
+def estimate_groups(rows):
+    groups = {}
+    for *group, sketch in rows:
+        data = bytes.fromhex(sketch) if isinstance(sketch, str) else sketch
+        key = tuple(group) if len(group) > 1 else group[0]
+        registers = groups.setdefault(key, empty())
+        np.maximum(registers, decode(data), out=registers)
+    return {key: estimate(registers) for key, registers in groups.items()}
@@ -0,0 +1,229 @@
+# Incremental referential-integrity scanner.
+#
+# Attempts, comments and recommendations reference a route by its text key
+# (nom_via, nom_sector_via, nom_crag_via) and completions reference an attempt,
+# all through unmanaged DO_NOTHING relations, so nothing stops them from
+# outliving their parent. scan() finds such orphans with anti-joins over id
+# ranges above a per-table watermark, so each run only looks at rows added
+# since the previous one, and records them in practica.integrity_orphan.
+#
+# Rows below the watermark turn into orphans when their parent goes away
+# (a route deleted or renamed, an attempt deleted) or when they are pointed
+# somewhere else (a completion added to an old attempt, an attempt moved to
+# another route). Those are picked up from the change log: the scanner is
+# also a CDC consumer (see practica/cdc.py) that rechecks the children of the
+# parents deleted or updated in each batch, and the rows inserted or updated
+# in it, whether run by the engine or by scan().
+import argparse
+import sys
+
+from practica import cdc, db
+
+NAME = "integrity"
+
+TABLES = ["via", "intent", "encadenament", "comentari", "recomanacio"]
+
+DDL = """
+CREATE TABLE IF NOT EXISTS practica.integrity_watermark (
+    table_name  varchar(50) PRIMARY KEY,
+    last_id     bigint NOT NULL DEFAULT 0,
+    scanned_at  timestamp
+);
+
+CREATE TABLE IF NOT EXISTS practica.integrity_orphan (
+    table_name   varchar(50) NOT NULL,
+    row_id       bigint NOT NULL,
+    reason       text NOT NULL,
+    detected_at  timestamp NOT NULL DEFAULT now(),
+    PRIMARY KEY (table_name, row_id)
+);
+"""
+
+ROUTE_EXISTS = """
+    EXISTS (
+        SELECT 1 FROM practica.via v
+        WHERE v.nom = t.nom_via AND v.nom_sector = t.nom_sector_via AND v.nom_crag_sector = t.nom_crag_via
+    )
+"""
+
+# table -> (id column, anti-join condition on alias t, reason)
+CHECKS = {
+    "intent": ("id_intent", f"NOT {ROUTE_EXISTS}", "'Route not found: ' || t.nom_via || ' (' || t.nom_sector_via || ', ' || t.nom_crag_via || ')'"),
+    "comentari": ("id_comentari", f"NOT {ROUTE_EXISTS}", "'Route not found: ' || t.nom_via || ' (' || t.nom_sector_via || ', ' || t.nom_crag_via || ')'"),
+    "recomanacio": ("id_recomanacio", f"NOT {ROUTE_EXISTS}", "'Route not found: ' || t.nom_via || ' (' || t.nom_sector_via || ', ' || t.nom_crag_via || ')'"),
+    "encadenament": (
+        "id_intent",
+        "NOT EXISTS (SELECT 1 FROM practica.intent i WHERE i.id_intent = t.id_intent)",
+        "'Attempt not found: ' || t.id_intent",
+    ),
+}
+
+# table -> ids of the rows to recheck in the current CDC batch: the children
+# of the routes (attempts) deleted or updated, and the rows changed
+ROUTE_CHILDREN_CHANGED = """
+    SELECT t.{id_col} FROM practica.{table} t
+    JOIN """ + cdc.rows("via", -1) + """ v
+      ON (t.nom_via, t.nom_sector_via, t.nom_crag_via) = (v.nom, v.nom_sector, v.nom_crag_sector)
+    UNION
+    SELECT n.{id_col} FROM {changed} n
+"""
+
+RECHECK = {
+    "intent": ROUTE_CHILDREN_CHANGED.format(id_col="id_intent", table="intent", changed=cdc.rows("intent", 1)),
+    "comentari": ROUTE_CHILDREN_CHANGED.format(id_col="id_comentari", table="comentari", changed=cdc.rows("comentari", 1)),
+    "recomanacio": ROUTE_CHILDREN_CHANGED.format(id_col="id_recomanacio", table="recomanacio", changed=cdc.rows("recomanacio", 1)),
+    "encadenament": f"""
+        SELECT o.id_intent FROM {cdc.rows("intent", -1)} o
+        UNION
+        SELECT n.id_intent FROM {cdc.rows("encadenament", 1)} n
+    """,
+}
+
+DEFAULT_CHUNK_SIZE = 50000
+
+
+def install(conn):
+    with conn.cursor() as cur:
+        cur.execute(DDL)
+        for table in CHECKS:
+            cur.execute(
+                "INSERT INTO practica.integrity_watermark (table_name) VALUES (%s) ON CONFLICT DO NOTHING",
+                (table,)
+            )
+    conn.commit()
+    cdc.install(conn)
+    cdc.subscribe(conn, sys.modules[__name__])
+
+
+def is_installed(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass('practica.integrity_watermark') IS NOT NULL")
+        installed = cur.fetchone()[0]
+    conn.commit()
+    return installed
+
+
+# Drop report rows whose source row was deleted or whose parent reappeared
+def resolve(conn):
+    resolved = 0
+    with conn.cursor() as cur:
+        for table, (id_col, orphan_condition, _) in CHECKS.items():
+            cur.execute(
+                f"""
+                DELETE FROM practica.integrity_orphan o
+                WHERE o.table_name = %s
+                  AND NOT EXISTS (
+                      SELECT 1 FROM practica.{table} t
+                      WHERE t.{id_col} = o.row_id AND {orphan_condition}
+                  )
+                """,
+                (table,)
+            )
+            resolved += cur.rowcount
+    conn.commit()
+    return resolved
+
+
+def _record(cur, table, where, params=()):
+    id_col, orphan_condition, reason = CHECKS[table]
+    cur.execute(
+        f"""
+        INSERT INTO practica.integrity_orphan (table_name, row_id, reason)
+        SELECT %s, t.{id_col}, {reason}
+        FROM practica.{table} t
+        WHERE {where} AND {orphan_condition}
+        ON CONFLICT DO NOTHING
+        """,
+        (table, *params)
+    )
+    return cur.rowcount
+
+
+def apply_changes(cur):
+    for table, (id_col, _, _) in CHECKS.items():
+        _record(cur, table, f"t.{id_col} IN ({RECHECK[table]})")
+
+
+def refill(cur, archived):
+    cur.execute("TRUNCATE practica.integrity_orphan")
+    for table, (id_col, _, _) in CHECKS.items():
+        _record(cur, table, "true")
+        cur.execute(
+            f"""
+            INSERT INTO practica.integrity_watermark (table_name, last_id, scanned_at)
+            SELECT %s, COALESCE(MAX({id_col}), 0), now() FROM practica.{table}
+            ON CONFLICT (table_name) DO UPDATE SET last_id = EXCLUDED.last_id, scanned_at = EXCLUDED.scanned_at
+            """,
+            (table,)
+        )
+
+
+def _counts(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT table_name, COUNT(*) FROM practica.integrity_orphan GROUP BY table_name")
+        counts = dict(cur.fetchall())
+    conn.commit()
+    return counts
+
+
+# Recheck what changed since the last run (see apply_changes), then scan the
+# rows added since, chunk by chunk along the primary key. full=True rescans
+# from the beginning, e.g. after the change log was pruned past a rebuild.
+def scan(conn, full=False, chunk_size=DEFAULT_CHUNK_SIZE):
+    before = _counts(conn)
+    cdc.consume(conn, sys.modules[__name__])
+    after = _counts(conn)
+    found = {table: after.get(table, 0) - before.get(table, 0) for table in CHECKS}
+    for table, (id_col, _, _) in CHECKS.items():
+        with conn.cursor() as cur:
+            cur.execute("SELECT last_id FROM practica.integrity_watermark WHERE table_name = %s", (table,))
+            row = cur.fetchone()
+            low = 0 if full or not row else row[0]
+            cur.execute(f"SELECT COALESCE(MAX({id_col}), 0) FROM practica.{table}")
+            high = cur.fetchone()[0]
+        conn.commit()
+
+        while low < high:
+            upper = min(low + chunk_size, high)
+            with conn.cursor() as cur:
+                found[table] += _record(cur, table, f"t.{id_col} > %s AND t.{id_col} <= %s", (low, upper))
+                cur.execute(
+                    """
+                    INSERT INTO practica.integrity_watermark (table_name, last_id, scanned_at)
+                    VALUES (%s, %s, now())
+                    ON CONFLICT (table_name) DO UPDATE SET last_id = EXCLUDED.last_id, scanned_at = EXCLUDED.scanned_at
+                    """,
+                    (table, upper)
+                )
+            conn.commit()
+            low = upper
+    return found
+
+
+def summary(conn):
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT w.table_name, w.last_id, w.scanned_at, COUNT(o.row_id)
+            FROM practica.integrity_watermark w
+            LEFT JOIN practica.integrity_orphan o ON o.table_name = w.table_name
+            GROUP BY w.table_name, w.last_id, w.scanned_at
+            ORDER BY w.table_name
+            """
+        )
+        rows = cur.fetchall()
+    conn.commit()
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find orphaned rows in the practica schema")
+    parser.add_argument("--full", action="store_true", help="rescan every row instead of only the new and changed ones")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    conn = db.connect()
+    install(conn)
+    print(f"Resolved: {resolve(conn)}")
+    for table, count in scan(conn, full=args.full, chunk_size=args.chunk_size).items():
+        print(f"{table}: {count} new orphans")
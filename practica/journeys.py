@@ -0,0 +1,176 @@
+# Redpoint journeys: how each climber got to send each route.
+#
+# practica.route_journey has one row per climber and route they tried: the
+# date of the first attempt and its ascent type, the first completion (date
+# and ascent type), how many attempts and distinct climbing days it took up
+# to and including it, and the attempts so far. Routes not sent yet have no
+# completion, so open projects show up too. The rows are computed with window
+# functions over intent and encadenament in one pass per (climber, route).
+#
+# The cdc engine recomputes the journeys whose attempts or completions
+# changed in the batch, from the tables. Grades aren't stored, so regrading
+# a route only changes the per-grade figures of journey_effort_query(), which
+# joins via when read.
+import argparse
+import sys
+
+from practica import archive, cdc, db
+
+NAME = "journeys"
+
+TABLES = ["intent", "encadenament"]
+
+KEY = "nom_usuari, nom_via, nom_sector_via, nom_crag_via"
+
+DDL = f"""
+CREATE TABLE IF NOT EXISTS practica.route_journey (
+    nom_usuari           varchar(100) NOT NULL,
+    nom_via              varchar(255) NOT NULL,
+    nom_sector_via       varchar(255) NOT NULL,
+    nom_crag_via         varchar(255) NOT NULL,
+    primer_intent        date NOT NULL,
+    tipus_primer_intent  varchar(100),
+    encadenament         date,
+    tipus_encadenament   varchar(100),
+    intents_encadenar    integer,
+    dies_encadenar       integer,
+    intents              integer NOT NULL,
+    PRIMARY KEY ({KEY})
+);
+CREATE INDEX IF NOT EXISTS route_journey_via_idx ON practica.route_journey (nom_crag_via, nom_sector_via, nom_via);
+"""
+
+# Journeys from the attempts, optionally only for the (climber, route) keys
+# in the arrays passed as parameters. The first completion, or the first
+# attempt if there is none, carries the running counts of its journey.
+JOURNEYS = """
+    INSERT INTO practica.route_journey
+    SELECT DISTINCT ON (a.nom_usuari_escalador, a.nom_via, a.nom_sector_via, a.nom_crag_via)
+           a.nom_usuari_escalador, a.nom_via, a.nom_sector_via, a.nom_crag_via,
+           a.primer_intent, a.tipus_primer_intent,
+           CASE WHEN a.encadenat THEN a.data_intent END,
+           CASE WHEN a.encadenat THEN a.tipus_ascensio END,
+           CASE WHEN a.encadenat THEN a.intent_n END,
+           CASE WHEN a.encadenat THEN a.dia_n END,
+           a.intents
+    FROM (
+        SELECT i.nom_usuari_escalador, i.nom_via, i.nom_sector_via, i.nom_crag_via, i.id_intent,
+               i.data_intent, i.tipus_ascensio, e.id_intent IS NOT NULL AS encadenat,
+               ROW_NUMBER() OVER attempts AS intent_n,
+               DENSE_RANK() OVER days AS dia_n,
+               FIRST_VALUE(i.data_intent) OVER attempts AS primer_intent,
+               FIRST_VALUE(i.tipus_ascensio) OVER attempts AS tipus_primer_intent,
+               COUNT(*) OVER journey AS intents
+        FROM {intent_table} i
+        LEFT JOIN {encadenament_table} e ON e.id_intent = i.id_intent
+        {keys}
+        WINDOW journey AS (PARTITION BY i.nom_usuari_escalador, i.nom_via, i.nom_sector_via, i.nom_crag_via),
+               attempts AS (journey ORDER BY i.data_intent, i.id_intent),
+               days AS (journey ORDER BY i.data_intent)
+    ) a
+    ORDER BY a.nom_usuari_escalador, a.nom_via, a.nom_sector_via, a.nom_crag_via,
+             a.encadenat DESC, a.data_intent, a.id_intent
+"""
+
+KEYS_JOIN = """
+    JOIN unnest(%s::text[], %s::text[], %s::text[], %s::text[]) AS k (nom_usuari, nom_via, nom_sector_via, nom_crag_via)
+      ON (i.nom_usuari_escalador, i.nom_via, i.nom_sector_via, i.nom_crag_via)
+       = (k.nom_usuari, k.nom_via, k.nom_sector_via, k.nom_crag_via)
+"""
+
+# Journeys with attempts or completions changed in the batch
+TOUCHED = f"""
+    SELECT r.nom_usuari_escalador, r.nom_via, r.nom_sector_via, r.nom_crag_via FROM {cdc.rows("intent", 1)} r
+    UNION
+    SELECT r.nom_usuari_escalador, r.nom_via, r.nom_sector_via, r.nom_crag_via FROM {cdc.rows("intent", -1)} r
+    UNION
+    SELECT r.nom_usuari_escalador, r.nom_via, r.nom_sector_via, r.nom_crag_via FROM {cdc.completions(1)} r
+    UNION
+    SELECT r.nom_usuari_escalador, r.nom_via, r.nom_sector_via, r.nom_crag_via FROM {cdc.completions(-1)} r
+"""
+
+REMOVE = f"""
+    DELETE FROM practica.route_journey j
+    USING unnest(%s::text[], %s::text[], %s::text[], %s::text[]) AS k ({KEY})
+    WHERE (j.nom_usuari, j.nom_via, j.nom_sector_via, j.nom_crag_via)
+        = (k.nom_usuari, k.nom_via, k.nom_sector_via, k.nom_crag_via)
+"""
+
+# A climber's journeys, latest first. Params: climber.
+CLIMBER_JOURNEYS = """
+    SELECT j.nom_via, j.nom_sector_via, j.nom_crag_via, v.grau_ordinal, j.primer_intent, j.tipus_primer_intent,
+           j.encadenament, j.tipus_encadenament, j.intents_encadenar, j.dies_encadenar, j.intents
+    FROM practica.route_journey j
+    LEFT JOIN practica.via v ON (v.nom, v.nom_sector, v.nom_crag_sector) = (j.nom_via, j.nom_sector_via, j.nom_crag_via)
+    WHERE j.nom_usuari = %s
+    ORDER BY COALESCE(j.encadenament, j.primer_intent) DESC
+"""
+
+
+def _key_arrays(keys):
+    return [list(column) for column in zip(*keys)] if keys else [[], [], [], []]
+
+
+def _tables(archived):
+    return {
+        "intent_table": archive.source("intent", archived),
+        "encadenament_table": archive.source("encadenament", archived),
+    }
+
+
+def apply_changes(cur):
+    cur.execute(TOUCHED)
+    keys = [tuple(row) for row in cur.fetchall()]
+    if keys:
+        cur.execute(REMOVE, _key_arrays(keys))
+        cur.execute(JOURNEYS.format(**_tables(archive.installed_in(cur)), keys=KEYS_JOIN), _key_arrays(keys))
+
+
+def refill(cur, archived):
+    cur.execute("TRUNCATE practica.route_journey")
+    cur.execute(JOURNEYS.format(**_tables(archived), keys=""))
+
+
+def install(conn):
+    cdc.install(conn)
+    with conn.cursor() as cur:
+        cur.execute(DDL)
+    conn.commit()
+    cdc.subscribe(conn, sys.modules[__name__])
+
+
+def rebuild(conn):
+    cdc.subscribe(conn, sys.modules[__name__], rebuild=True)
+
+
+# Average effort to send per grade, optionally only of some climbers, crags
+# or ascent types of the send. Rows are (grade ordinal, sends, avg attempts,
+# avg days, share of sends on the first attempt).
+def journey_effort_query(climbers=(), crags=(), ascent_types=()):
+    conditions, params = [], []
+    for column, values in (("nom_usuari", climbers), ("nom_crag_via", crags), ("tipus_encadenament", ascent_types)):
+        if values:
+            conditions.append(f" AND j.{column} = ANY(%s)")
+            params.append(list(values))
+    query = f"""
+        SELECT v.grau_ordinal, COUNT(*),
+               ROUND(AVG(j.intents_encadenar), 1), ROUND(AVG(j.dies_encadenar), 1),
+               ROUND(AVG((j.intents_encadenar = 1)::int), 2)
+        FROM practica.route_journey j
+        JOIN practica.via v ON (v.nom, v.nom_sector, v.nom_crag_sector) = (j.nom_via, j.nom_sector_via, j.nom_crag_via)
+        WHERE j.encadenament IS NOT NULL AND v.grau_ordinal IS NOT NULL {"".join(conditions)}
+        GROUP BY v.grau_ordinal
+        ORDER BY v.grau_ordinal
+    """
+    return query, tuple(params)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the redpoint journeys")
+    parser.add_argument("--rebuild", action="store_true", help="recompute every journey from the attempts")
+    args = parser.parse_args()
+
+    conn = db.connect()
+    install(conn)
+    if args.rebuild:
+        rebuild(conn)
@@ -0,0 +1,203 @@
+# Climber leaderboards per crag and per month.
+#
+# practica.leaderboard_entry holds, for every climber and scope, their
+# number of completions, of distinct routes completed and the hardest grade
+# completed (via.grau_ordinal). A scope is a crag and a month ('YYYY-MM'),
+# where '' stands for all crags or all time, so the same table serves the
+# crag x month, per crag, per month and overall boards. Each board is an
+# index range scan on (scope, measure), which returns the top K in a few
+# milliseconds whatever the number of climbers.
+#
+# Distinct routes and maxima can't be updated by deltas, so the cdc engine
+# keeps the completions per climber, route and month in
+# practica.climber_route_month, and recomputes the entries of the climbers,
+# crags and months touched by a batch from there. A change to a route (e.g.
+# its grade) recomputes every entry of the climbers who completed it.
+import argparse
+import sys
+
+from practica import archive, cdc, db
+
+NAME = "leaderboards"
+
+TABLES = ["intent", "encadenament", "via"]
+
+ALL = ""
+
+# Measure columns of the boards, with their titles
+BOARDS = {
+    "encadenaments": "Most Completions",
+    "vies": "Most Routes",
+    "grau_max": "Hardest Completion",
+}
+
+DDL = """
+CREATE TABLE IF NOT EXISTS practica.climber_route_month (
+    nom_usuari      varchar(100) NOT NULL,
+    nom_crag_via    varchar(255) NOT NULL,
+    mes             date NOT NULL,
+    nom_sector_via  varchar(255) NOT NULL,
+    nom_via         varchar(255) NOT NULL,
+    encadenaments   bigint NOT NULL DEFAULT 0,
+    PRIMARY KEY (nom_usuari, nom_crag_via, mes, nom_sector_via, nom_via)
+);
+CREATE INDEX IF NOT EXISTS climber_route_month_via_idx
+    ON practica.climber_route_month (nom_crag_via, nom_sector_via, nom_via);
+
+CREATE TABLE IF NOT EXISTS practica.leaderboard_entry (
+    nom_crag       varchar(255) NOT NULL,
+    periode        varchar(7) NOT NULL,
+    nom_usuari     varchar(100) NOT NULL,
+    encadenaments  bigint NOT NULL,
+    vies           bigint NOT NULL,
+    grau_max       smallint,
+    PRIMARY KEY (nom_crag, periode, nom_usuari)
+);
+CREATE INDEX IF NOT EXISTS leaderboard_encadenaments_idx
+    ON practica.leaderboard_entry (nom_crag, periode, encadenaments DESC, nom_usuari);
+CREATE INDEX IF NOT EXISTS leaderboard_vies_idx
+    ON practica.leaderboard_entry (nom_crag, periode, vies DESC, nom_usuari);
+CREATE INDEX IF NOT EXISTS leaderboard_grau_max_idx
+    ON practica.leaderboard_entry (nom_crag, periode, grau_max DESC NULLS LAST, nom_usuari);
+"""
+
+APPLY_DELTA = """
+    INSERT INTO practica.climber_route_month AS c
+        (nom_usuari, nom_crag_via, mes, nom_sector_via, nom_via, encadenaments)
+    SELECT r.nom_usuari_escalador, r.nom_crag_via, date_trunc('month', r.data_intent)::date,
+           r.nom_sector_via, r.nom_via, {sign} * COUNT(*)
+    FROM {rows} r
+    GROUP BY 1, 2, 3, 4, 5
+    ON CONFLICT (nom_usuari, nom_crag_via, mes, nom_sector_via, nom_via)
+        DO UPDATE SET encadenaments = c.encadenaments + EXCLUDED.encadenaments
+"""
+
+# Climbers, crags and months touched by the batch: their completions changed,
+# or a route they completed did
+TOUCHED = f"""
+    SELECT r.nom_usuari_escalador AS nom_usuari, r.nom_crag_via, date_trunc('month', r.data_intent)::date AS mes
+    FROM {cdc.completions(1)} r
+    UNION
+    SELECT r.nom_usuari_escalador, r.nom_crag_via, date_trunc('month', r.data_intent)::date
+    FROM {cdc.completions(-1)} r
+    UNION
+    SELECT c.nom_usuari, c.nom_crag_via, c.mes
+    FROM practica.climber_route_month c
+    JOIN (SELECT * FROM {cdc.rows("via", 1)} v UNION ALL SELECT * FROM {cdc.rows("via", -1)} v) v
+      ON (c.nom_crag_via, c.nom_sector_via, c.nom_via) = (v.nom_crag_sector, v.nom_sector, v.nom)
+"""
+
+# Every scope a touched (climber, crag, month) counts in
+TOUCHED_SCOPES = f"""
+    SELECT DISTINCT t.nom_usuari, s.nom_crag, s.periode
+    FROM ({TOUCHED}) t,
+    LATERAL (VALUES (t.nom_crag_via, to_char(t.mes, 'YYYY-MM')), (t.nom_crag_via, '{ALL}'),
+                    ('{ALL}', to_char(t.mes, 'YYYY-MM')), ('{ALL}', '{ALL}')) AS s (nom_crag, periode)
+"""
+
+ENTRY_MEASURES = """
+    SUM(c.encadenaments), COUNT(DISTINCT (c.nom_crag_via, c.nom_sector_via, c.nom_via)), MAX(v.grau_ordinal)
+"""
+
+ROUTE_JOIN = """
+    LEFT JOIN practica.via v
+      ON (v.nom_crag_sector, v.nom_sector, v.nom) = (c.nom_crag_via, c.nom_sector_via, c.nom_via)
+"""
+
+# Route months left without completions
+REMOVE_EMPTY = f"""
+    DELETE FROM practica.climber_route_month c
+    USING {cdc.completions(-1)} r
+    WHERE (c.nom_usuari, c.nom_crag_via, c.mes, c.nom_sector_via, c.nom_via)
+        = (r.nom_usuari_escalador, r.nom_crag_via, date_trunc('month', r.data_intent)::date, r.nom_sector_via, r.nom_via)
+      AND c.encadenaments = 0
+"""
+
+REMOVE_ENTRIES = f"""
+    DELETE FROM practica.leaderboard_entry e
+    USING ({TOUCHED_SCOPES}) s
+    WHERE (e.nom_crag, e.periode, e.nom_usuari) = (s.nom_crag, s.periode, s.nom_usuari)
+"""
+
+INSERT_ENTRIES = f"""
+    INSERT INTO practica.leaderboard_entry (nom_crag, periode, nom_usuari, encadenaments, vies, grau_max)
+    SELECT s.nom_crag, s.periode, s.nom_usuari, {ENTRY_MEASURES}
+    FROM ({TOUCHED_SCOPES}) s
+    JOIN practica.climber_route_month c
+      ON c.nom_usuari = s.nom_usuari
+     AND (s.nom_crag = '{ALL}' OR c.nom_crag_via = s.nom_crag)
+     AND (s.periode = '{ALL}' OR c.mes = to_date(s.periode, 'YYYY-MM'))
+    {ROUTE_JOIN}
+    GROUP BY s.nom_crag, s.periode, s.nom_usuari
+"""
+
+REFILL_ENTRIES = f"""
+    INSERT INTO practica.leaderboard_entry (nom_crag, periode, nom_usuari, encadenaments, vies, grau_max)
+    SELECT COALESCE(c.nom_crag_via, '{ALL}'), COALESCE(to_char(c.mes, 'YYYY-MM'), '{ALL}'), c.nom_usuari,
+           {ENTRY_MEASURES}
+    FROM practica.climber_route_month c
+    {ROUTE_JOIN}
+    GROUP BY c.nom_usuari, GROUPING SETS ((c.nom_crag_via, c.mes), (c.nom_crag_via), (c.mes), ())
+"""
+
+
+def apply_changes(cur):
+    for sign in (1, -1):
+        cur.execute(APPLY_DELTA.format(sign=sign, rows=cdc.completions(sign)))
+    cur.execute(REMOVE_EMPTY)
+    cur.execute(REMOVE_ENTRIES)
+    cur.execute(INSERT_ENTRIES)
+
+
+def refill(cur, archived):
+    cur.execute("TRUNCATE practica.climber_route_month, practica.leaderboard_entry")
+    completions = (
+        f"(SELECT i.* FROM {archive.source('intent', archived)} i"
+        f" JOIN {archive.source('encadenament', archived)} e ON e.id_intent = i.id_intent)"
+    )
+    cur.execute(APPLY_DELTA.format(sign=1, rows=completions))
+    cur.execute(REFILL_ENTRIES)
+
+
+def install(conn):
+    cdc.install(conn)
+    with conn.cursor() as cur:
+        cur.execute(DDL)
+    conn.commit()
+    cdc.subscribe(conn, sys.modules[__name__])
+
+
+def rebuild(conn):
+    cdc.subscribe(conn, sys.modules[__name__], rebuild=True)
+
+
+# Top climbers of a board. Params: crag, month ('YYYY-MM'), limit; ALL for
+# all crags or all time. Rows are (climber, completions, routes, hardest grade).
+def board_query(board):
+    nulls = " NULLS LAST" if board == "grau_max" else ""
+    return f"""
+        SELECT nom_usuari, encadenaments, vies, grau_max
+        FROM practica.leaderboard_entry
+        WHERE nom_crag = %s AND periode = %s
+        ORDER BY {board} DESC{nulls}, nom_usuari
+        LIMIT %s
+    """
+
+
+# Months with a board for a crag (ALL for all crags), latest first
+MONTHS = f"""
+    SELECT DISTINCT periode FROM practica.leaderboard_entry
+    WHERE nom_crag = %s AND periode <> '{ALL}'
+    ORDER BY periode DESC
+"""
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the climber leaderboards")
+    parser.add_argument("--rebuild", action="store_true", help="recompute every board from the completions")
+    args = parser.parse_args()
+
+    conn = db.connect()
+    install(conn)
+    if args.rebuild:
+        rebuild(conn)
@@ -0,0 +1,203 @@
+# Estimated climber levels from completion history.
+#
+# escalador.nivell is whatever the climber declared, in userApp's Catalan
+# vocabulary or adminApp's English one. This module derives the level from
+# what they actually send instead. practica.climber_grade_pyramid holds every
+# climber's completions per grade (via.grau_ordinal), all time and within the
+# last RECENT_DAYS, and practica.climber_level their estimated grade: the
+# hardest grade with at least PYRAMID_SENDS recent completions at it or above
+# (all-time ones if they haven't climbed enough lately), so a single lucky
+# send doesn't count as a level. The grade maps onto both vocabularies
+# through LEVELS.
+#
+# The estimate is computed for many climbers at once with numpy: a climber x
+# grade matrix of sends, summed from the hardest grade down. The cdc engine
+# recomputes the climbers whose completions changed in the batch, or who
+# sent a route whose grade changed, from the tables. The recent window
+# moves with time, so a periodic --rebuild retires old sends.
+import argparse
+import sys
+
+import numpy as np
+from psycopg2 import extras
+
+from practica import archive, cdc, db, grades
+
+NAME = "levels"
+
+TABLES = ["intent", "encadenament", "via"]
+
+RECENT_DAYS = 365
+PYRAMID_SENDS = 3
+
+# Hardest ordinal of each level, with its userApp and adminApp names
+LEVELS = [
+    (6, "Principiant", "Beginner"),
+    (9, "Iniciació", "Beginner"),
+    (13, "Intermedi", "Intermediate"),
+    (17, "Avançat", "Advanced"),
+    (22, "Expert", "Expert"),
+    (grades.MAX_ORDINAL, "Pro", "Expert"),
+]
+
+DDL = """
+CREATE TABLE IF NOT EXISTS practica.climber_grade_pyramid (
+    nom_usuari     varchar(100) NOT NULL,
+    grau_ordinal   smallint NOT NULL,
+    encadenaments  bigint NOT NULL,
+    recents        bigint NOT NULL,
+    PRIMARY KEY (nom_usuari, grau_ordinal)
+);
+
+CREATE TABLE IF NOT EXISTS practica.climber_level (
+    nom_usuari     varchar(100) PRIMARY KEY,
+    grau_ordinal   smallint NOT NULL,
+    nivell         varchar(50) NOT NULL,
+    encadenaments  bigint NOT NULL
+);
+CREATE INDEX IF NOT EXISTS climber_level_grau_idx ON practica.climber_level (grau_ordinal);
+"""
+
+# Completions per climber and grade, optionally only of the climbers in the
+# array passed as parameter
+PYRAMIDS = f"""
+    SELECT i.nom_usuari_escalador, v.grau_ordinal, COUNT(*),
+           COUNT(*) FILTER (WHERE i.data_intent >= CURRENT_DATE - {RECENT_DAYS})
+    FROM {{encadenament_table}} e
+    JOIN {{intent_table}} i ON i.id_intent = e.id_intent
+    JOIN practica.via v ON (v.nom, v.nom_sector, v.nom_crag_sector) = (i.nom_via, i.nom_sector_via, i.nom_crag_via)
+    WHERE v.grau_ordinal IS NOT NULL {{climbers}}
+    GROUP BY 1, 2
+"""
+
+# Climbers whose completions changed, or who completed a route that changed
+TOUCHED_CLIMBERS = f"""
+    SELECT r.nom_usuari_escalador FROM {cdc.completions(1)} r
+    UNION
+    SELECT r.nom_usuari_escalador FROM {cdc.completions(-1)} r
+    UNION
+    SELECT i.nom_usuari_escalador
+    FROM {{encadenament_table}} e
+    JOIN {{intent_table}} i ON i.id_intent = e.id_intent
+    JOIN (SELECT * FROM {cdc.rows("via", 1)} v UNION ALL SELECT * FROM {cdc.rows("via", -1)} v) v
+      ON (v.nom, v.nom_sector, v.nom_crag_sector) = (i.nom_via, i.nom_sector_via, i.nom_crag_via)
+"""
+
+INSERT_PYRAMIDS = """
+    INSERT INTO practica.climber_grade_pyramid (nom_usuari, grau_ordinal, encadenaments, recents) VALUES %s
+"""
+
+INSERT_LEVELS = """
+    INSERT INTO practica.climber_level (nom_usuari, grau_ordinal, nivell, encadenaments) VALUES %s
+"""
+
+# A climber's estimated level. Params: climber.
+LEVEL = "SELECT grau_ordinal, nivell, encadenaments FROM practica.climber_level WHERE nom_usuari = %s"
+
+# A climber's pyramid, hardest grade first. Params: climber.
+PYRAMID = """
+    SELECT grau_ordinal, encadenaments, recents FROM practica.climber_grade_pyramid
+    WHERE nom_usuari = %s
+    ORDER BY grau_ordinal DESC
+"""
+
+
+# Level name of an ordinal, in userApp's vocabulary or adminApp's (english)
+def label(ordinal, english=False):
+    for hardest, catalan, name in LEVELS:
+        if ordinal <= hardest:
+            return name if english else catalan
+    return LEVELS[-1][2] if english else LEVELS[-1][1]
+
+
+# Grades to offer a climber of the given level: a little below to a little above
+def around(ordinal, below=2, above=1):
+    return max(ordinal - below, grades.MIN_ORDINAL), min(ordinal + above, grades.MAX_ORDINAL)
+
+
+# Estimated ordinal of every climber from pyramid rows (climber, ordinal,
+# completions, recent completions). Returns {climber: (ordinal, completions)}.
+def estimate(rows):
+    if not rows:
+        return {}
+    names, climbers = np.unique([row[0] for row in rows], return_inverse=True)
+    ordinals = np.array([row[1] for row in rows]) - grades.MIN_ORDINAL
+    width = grades.MAX_ORDINAL - grades.MIN_ORDINAL + 1
+    totals = np.zeros((len(names), width), dtype=np.int64)
+    recents = np.zeros((len(names), width), dtype=np.int64)
+    np.add.at(totals, (climbers, ordinals), [row[2] for row in rows])
+    np.add.at(recents, (climbers, ordinals), [row[3] for row in rows])
+
+    # Sends at each grade or harder; the level is the hardest grade where
+    # that reaches PYRAMID_SENDS, or the hardest send if it never does
+    sends = np.where((recents.sum(axis=1) >= PYRAMID_SENDS)[:, None], recents, totals)
+    at_or_above = np.cumsum(sends[:, ::-1], axis=1)[:, ::-1]
+    reached = at_or_above >= PYRAMID_SENDS
+    hardest = width - 1 - np.argmax(totals[:, ::-1] > 0, axis=1)
+    level = np.where(reached.any(axis=1), width - 1 - np.argmax(reached[:, ::-1], axis=1), hardest)
+    level = level + grades.MIN_ORDINAL
+    completions = totals.sum(axis=1)
+    return {name: (int(level[i]), int(completions[i])) for i, name in enumerate(names)}
+
+
+def _tables(archived):
+    return {
+        "encadenament_table": archive.source("encadenament", archived),
+        "intent_table": archive.source("intent", archived),
+    }
+
+
+def _recompute(cur, archived, climbers=None):
+    cur.execute(
+        PYRAMIDS.format(
+            **_tables(archived),
+            climbers="AND i.nom_usuari_escalador = ANY(%s)" if climbers is not None else "",
+        ),
+        (climbers,) if climbers is not None else None
+    )
+    rows = cur.fetchall()
+    if rows:
+        extras.execute_values(cur, INSERT_PYRAMIDS, rows, page_size=10000)
+        extras.execute_values(
+            cur, INSERT_LEVELS,
+            [(name, ordinal, label(ordinal), completions) for name, (ordinal, completions) in estimate(rows).items()],
+            page_size=10000
+        )
+
+
+def apply_changes(cur):
+    archived = archive.installed_in(cur)
+    cur.execute(TOUCHED_CLIMBERS.format(**_tables(archived)))
+    climbers = [row[0] for row in cur.fetchall()]
+    if climbers:
+        cur.execute("DELETE FROM practica.climber_grade_pyramid WHERE nom_usuari = ANY(%s)", (climbers,))
+        cur.execute("DELETE FROM practica.climber_level WHERE nom_usuari = ANY(%s)", (climbers,))
+        _recompute(cur, archived, climbers)
+
+
+def refill(cur, archived):
+    cur.execute("TRUNCATE practica.climber_grade_pyramid, practica.climber_level")
+    _recompute(cur, archived)
+
+
+def install(conn):
+    cdc.install(conn)
+    with conn.cursor() as cur:
+        cur.execute(DDL)
+    conn.commit()
+    cdc.subscribe(conn, sys.modules[__name__])
+
+
+def rebuild(conn):
+    cdc.subscribe(conn, sys.modules[__name__], rebuild=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the estimated climber levels")
+    parser.add_argument("--rebuild", action="store_true", help="recompute every climber, e.g. daily for the recent window")
+    args = parser.parse_args()
+
+    conn = db.connect()
+    install(conn)
+    if args.rebuild:
+        rebuild(conn)
@@ -0,0 +1,174 @@
+# Climbing-partner suggestions: climbers who climb like you.
+#
+# Each climber active in the last ACTIVE_DAYS is described by four profiles
+# of their attempts in that time (completions count twice):
+#   - grades: a histogram over via.grau_ordinal, blurred by a grade either
+#     way so that 6b and 6b+ climbers overlap,
+#   - crags: how their attempts split between crags,
+#   - weekdays and months: when they climb.
+# Each profile is scaled to unit length and weighted by WEIGHTS, so the dot
+# product of two climbers' vectors is the weighted sum of the cosines of
+# their profiles: 1 for climbers who climb the same grades at the same crags
+# on the same days, 0 for climbers with nothing in common.
+#
+# Partners change slowly, so a batch job (python -m practica.partners, e.g.
+# nightly) computes every climber's TOP_K nearest neighbours and stores them
+# in practica.climber_partner, where the app reads them with a primary-key
+# probe. The job compares climbers CHUNK_SIZE at a time against everyone: a
+# dense product for the grade and calendar profiles, a sparse one for the
+# crags, which takes a few minutes for 100k climbers.
+import argparse
+import time
+
+import numpy as np
+from psycopg2 import extras
+from scipy import sparse
+
+from practica import db, grades
+
+TOP_K = 10
+ACTIVE_DAYS = 365
+CHUNK_SIZE = 256
+
+WEIGHTS = {
+    "grades": 0.4,
+    "crags": 0.3,
+    "weekdays": 0.15,
+    "months": 0.15,
+}
+
+# Share of a grade's weight that spills onto each neighbouring grade
+GRADE_BLUR = 0.5
+
+DDL = """
+CREATE TABLE IF NOT EXISTS practica.climber_partner (
+    nom_usuari  varchar(100) NOT NULL,
+    rang        smallint NOT NULL,
+    company     varchar(100) NOT NULL,
+    score       real NOT NULL,
+    PRIMARY KEY (nom_usuari, rang)
+);
+"""
+
+# Recent attempts with their grade, weekday (0 = Monday) and month (0-11),
+# weighted 2 if completed
+ATTEMPTS = f"""
+    SELECT i.nom_usuari_escalador, i.nom_crag_via, v.grau_ordinal,
+           EXTRACT(ISODOW FROM i.data_intent)::int - 1, EXTRACT(MONTH FROM i.data_intent)::int - 1,
+           CASE WHEN e.id_intent IS NULL THEN 1 ELSE 2 END
+    FROM practica.intent i
+    LEFT JOIN practica.encadenament e ON e.id_intent = i.id_intent
+    LEFT JOIN practica.via v ON (v.nom, v.nom_sector, v.nom_crag_sector) = (i.nom_via, i.nom_sector_via, i.nom_crag_via)
+    WHERE i.data_intent >= CURRENT_DATE - {ACTIVE_DAYS}
+"""
+
+INSERT = "INSERT INTO practica.climber_partner (nom_usuari, rang, company, score) VALUES %s"
+
+# A climber's suggested partners, best first, with their estimated level
+# (practica/levels.py). Params: climber, limit.
+PARTNERS = """
+    SELECT p.company, l.nivell, l.grau_ordinal, ROUND(p.score::numeric, 2)
+    FROM practica.climber_partner p
+    LEFT JOIN practica.climber_level l ON l.nom_usuari = p.company
+    WHERE p.nom_usuari = %s
+    ORDER BY p.rang
+    LIMIT %s
+"""
+
+
+def install(conn):
+    with conn.cursor() as cur:
+        cur.execute(DDL)
+    conn.commit()
+
+
+# Rows scaled to unit length (zero rows stay zero), times sqrt(weight)
+def _unit(matrix, weight):
+    if sparse.issparse(matrix):
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        scale = np.divide(np.sqrt(weight), norms, out=np.zeros_like(norms), where=norms > 0)
+        return sparse.diags(scale) @ matrix
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return np.divide(matrix * np.sqrt(weight), norms, out=np.zeros_like(matrix), where=norms > 0)
+
+
+# Profile vectors from attempt rows (climber, crag, ordinal or None, weekday,
+# month, weight). Returns the climber names, their dense grade and calendar
+# vectors and their sparse crag vectors.
+def profiles(rows):
+    climbers, crags = {}, {}
+    users, places, ordinals, weekdays, months, weights = [], [], [], [], [], []
+    for climber, crag, ordinal, weekday, month, weight in rows:
+        users.append(climbers.setdefault(climber, len(climbers)))
+        places.append(crags.setdefault(crag, len(crags)))
+        ordinals.append(-1 if ordinal is None else ordinal - grades.MIN_ORDINAL)
+        weekdays.append(weekday)
+        months.append(month)
+        weights.append(weight)
+    users, ordinals, weights = np.array(users), np.array(ordinals), np.array(weights, dtype=np.float32)
+    count = len(climbers)
+
+    width = grades.MAX_ORDINAL - grades.MIN_ORDINAL + 1
+    graded = ordinals >= 0
+    histogram = np.zeros((count, width + 2), dtype=np.float32)
+    np.add.at(histogram, (users[graded], ordinals[graded] + 1), weights[graded])
+    blurred = histogram[:, 1:-1] + GRADE_BLUR * (histogram[:, :-2] + histogram[:, 2:])
+
+    by_weekday = np.zeros((count, 7), dtype=np.float32)
+    np.add.at(by_weekday, (users, np.array(weekdays)), weights)
+    by_month = np.zeros((count, 12), dtype=np.float32)
+    np.add.at(by_month, (users, np.array(months)), weights)
+    by_crag = sparse.csr_matrix((weights, (users, np.array(places))), shape=(count, len(crags)))
+
+    dense = np.hstack([
+        _unit(blurred, WEIGHTS["grades"]),
+        _unit(by_weekday, WEIGHTS["weekdays"]),
+        _unit(by_month, WEIGHTS["months"]),
+    ]).astype(np.float32)
+    return list(climbers), dense, _unit(by_crag, WEIGHTS["crags"]).tocsr().astype(np.float32)
+
+
+# Every climber's top_k partners as (climber, rank, partner, score) rows
+def match(names, dense, by_crag, top_k=TOP_K, chunk_size=CHUNK_SIZE):
+    count = len(names)
+    k = min(top_k, count - 1)
+    if k < 1:
+        return []
+    crags_t = by_crag.T.tocsr()
+    rows = []
+    for start in range(0, count, chunk_size):
+        end = min(start + chunk_size, count)
+        scores = dense[start:end] @ dense.T
+        scores += (by_crag[start:end] @ crags_t).toarray()
+        scores[np.arange(end - start), np.arange(start, end)] = -np.inf
+        best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        for offset, candidates in enumerate(best):
+            candidates = candidates[np.argsort(-scores[offset, candidates], kind="stable")]
+            for rank, other in enumerate(candidates, start=1):
+                if scores[offset, other] > 0:
+                    rows.append((names[start + offset], rank, names[other], float(scores[offset, other])))
+    return rows
+
+
+# Recomputes every active climber's partners. Returns the number of climbers.
+def run(conn, top_k=TOP_K):
+    with conn.cursor() as cur:
+        cur.execute(ATTEMPTS)
+        attempts = cur.fetchall()
+        rows = match(*profiles(attempts), top_k=top_k) if attempts else []
+        cur.execute("TRUNCATE practica.climber_partner")
+        extras.execute_values(cur, INSERT, rows, page_size=10000)
+    conn.commit()
+    return len({row[0] for row in rows})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recompute the climbing-partner suggestions")
+    parser.add_argument("--top-k", type=int, default=TOP_K, help="partners kept per climber")
+    args = parser.parse_args()
+
+    conn = db.connect()
+    install(conn)
+    started = time.monotonic()
+    climbers = run(conn, args.top_k)
+    print(f"Partners for {climbers} climbers in {time.monotonic() - started:.1f}s")
@@ -0,0 +1,114 @@
+# Paginated record pickers for the admin Edit/Delete tabs.
+#
+# A climber can have thousands of attempts, comments or recommendations, so
+# the pickers never load them all: page_query() returns one page of a
+# climber's records, newest first, narrowed by route name, date range or
+# text, and the page after a given record. Pages are read by keyset
+# (date, id) rather than OFFSET, so every page is one short range scan of the
+# (climber, date, id) indexes below, however deep into the history it is.
+import argparse
+
+from practica import db
+
+PAGE_SIZE = 20
+
+# Per dataset: table, id and date columns, the extra column shown in the
+# labels, and the text search condition (None if the records have no text)
+DATASETS = {
+    "attempts": {
+        "table": "practica.intent",
+        "id": "id_intent",
+        "date": "data_intent",
+        "extra": "COALESCE(r.tipus_ascensio, 'No type')",
+        "text": None,
+    },
+    "comments": {
+        "table": "practica.comentari",
+        "id": "id_comentari",
+        "date": "data_comentari",
+        "extra": "LEFT(r.text_comentari, 50) || CASE WHEN length(r.text_comentari) > 50 THEN '...' ELSE '' END",
+        "text": "r.text_cerca @@ practica.search_query(%s)",
+    },
+    "recommendations": {
+        "table": "practica.recomanacio",
+        "id": "id_recomanacio",
+        "date": "data_recomanacio",
+        "extra": "'Rating: ' || r.puntuacio",
+        "text": "r.descripcio_recomanacio ILIKE '%%' || %s || '%%'",
+    },
+}
+
+DDL = """
+CREATE INDEX IF NOT EXISTS intent_escalador_data_idx
+    ON practica.intent (nom_usuari_escalador, data_intent DESC, id_intent DESC);
+CREATE INDEX IF NOT EXISTS comentari_escalador_data_idx
+    ON practica.comentari (nom_usuari_escalador, data_comentari DESC, id_comentari DESC);
+CREATE INDEX IF NOT EXISTS recomanacio_escalador_data_idx
+    ON practica.recomanacio (nom_usuari_escalador, data_recomanacio DESC, id_recomanacio DESC);
+"""
+
+
+def install(conn):
+    with conn.cursor() as cur:
+        cur.execute(DDL)
+    conn.commit()
+
+
+# One page of a climber's records, newest first. route and text are
+# substrings to look for, date_from/date_to bound the dates (inclusive) and
+# after is the (date, id) of the last record of the previous page. Rows are
+# (id, route, sector, crag, date, extra); one row more than limit is
+# returned when there is a next page.
+def page_query(dataset, climber, route="", date_from=None, date_to=None, text="", after=None, limit=PAGE_SIZE):
+    spec = DATASETS[dataset]
+    conditions, params = [], [climber]
+    if route:
+        conditions.append(" AND r.nom_via ILIKE '%%' || %s || '%%'")
+        params.append(route)
+    if date_from:
+        conditions.append(f" AND r.{spec['date']} >= %s")
+        params.append(date_from)
+    if date_to:
+        conditions.append(f" AND r.{spec['date']} <= %s")
+        params.append(date_to)
+    if text and spec["text"]:
+        conditions.append(f" AND {spec['text']}")
+        params.append(text)
+    if after:
+        conditions.append(f" AND (r.{spec['date']}, r.{spec['id']}) < (%s, %s)")
+        params.extend(after)
+    query = f"""
+        SELECT r.{spec['id']}, r.nom_via, r.nom_sector_via, r.nom_crag_via, r.{spec['date']}, {spec['extra']}
+        FROM {spec['table']} r
+        WHERE r.nom_usuari_escalador = %s {"".join(conditions)}
+        ORDER BY r.{spec['date']} DESC, r.{spec['id']} DESC
+        LIMIT %s
+    """
+    return query, tuple(params + [limit + 1])
+
+
+# The (date, id) to pass as after= for the page following a row
+def cursor(row):
+    return row[4], row[0]
+
+
+def label(row):
+    record_id, route, sector, crag, day, extra = row
+    return f"{route} ({sector}, {crag}) - {day} - {extra} [#{record_id}]"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="List a climber's records a page at a time")
+    parser.add_argument("dataset", nargs="?", choices=list(DATASETS), help="installs the picker indexes if omitted")
+    parser.add_argument("climber", nargs="?")
+    parser.add_argument("--route", default="")
+    parser.add_argument("--text", default="")
+    args = parser.parse_args()
+
+    conn = db.connect()
+    install(conn)
+    if args.dataset and args.climber:
+        with conn.cursor() as cur:
+            cur.execute(*page_query(args.dataset, args.climber, route=args.route, text=args.text))
+            for row in cur.fetchall()[:PAGE_SIZE]:
+                print(label(row))
@@ -0,0 +1,163 @@
+# Chunked cascading delete for crags, sectors, routes and climbers.
+#
+# The practica tables are linked with DO_NOTHING foreign keys, so a plain
+# DELETE on a parent either fails on its dependents or leaves orphans behind.
+# purge() removes the dependents first, in bounded batches that are committed
+# one by one (so locks are held only for a batch), sleeping between batches
+# to leave room for the apps' own traffic.
+import time
+
+from practica import archive
+
+# Predicates selecting the dependent rows of each kind of parent.
+# Activity tables (intent, comentari, recomanacio) share the same route key.
+ACTIVITY_SCOPE = {
+    "crag": "nom_crag_via = %s",
+    "sector": "nom_crag_via = %s AND nom_sector_via = %s",
+    "route": "nom_crag_via = %s AND nom_sector_via = %s AND nom_via = %s",
+    "climber": "nom_usuari_escalador = %s",
+}
+
+ROUTE_SCOPE = {
+    "crag": "nom_crag_sector = %s",
+    "sector": "nom_crag_sector = %s AND nom_sector = %s",
+}
+
+SECTOR_SCOPE = {
+    "crag": "nom_crag = %s",
+}
+
+# Final statement removing the parent row itself
+PARENT_DELETE = {
+    "crag": "DELETE FROM practica.crag WHERE nom = %s",
+    "sector": "DELETE FROM practica.sector WHERE nom_crag = %s AND nom = %s",
+    "route": "DELETE FROM practica.via WHERE nom_crag_sector = %s AND nom_sector = %s AND nom = %s",
+    "climber": "DELETE FROM practica.escalador WHERE nom_usuari = %s",
+}
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_PAUSE = 0.05
+
+
+# Activity steps for the hot tables (suffix "") or the archive tables ("_archive").
+# Completions go first since they hang off the attempts.
+def _activity_steps(kind, suffix, prefix):
+    activity = ACTIVITY_SCOPE[kind]
+    return [
+        (
+            f"{prefix}Completions",
+            f"""
+            SELECT COUNT(*) FROM practica.encadenament{suffix} e
+            JOIN practica.intent{suffix} i ON e.id_intent = i.id_intent
+            WHERE {activity.replace('nom_', 'i.nom_')}
+            """,
+            f"""
+            DELETE FROM practica.encadenament{suffix} WHERE id_intent IN (
+                SELECT e.id_intent FROM practica.encadenament{suffix} e
+                JOIN practica.intent{suffix} i ON e.id_intent = i.id_intent
+                WHERE {activity.replace('nom_', 'i.nom_')}
+                LIMIT %s
+            )
+            """,
+        ),
+        (
+            f"{prefix}Attempts",
+            f"SELECT COUNT(*) FROM practica.intent{suffix} WHERE {activity}",
+            f"""
+            DELETE FROM practica.intent{suffix} WHERE id_intent IN (
+                SELECT id_intent FROM practica.intent{suffix} WHERE {activity} LIMIT %s
+            )
+            """,
+        ),
+        (
+            f"{prefix}Comments",
+            f"SELECT COUNT(*) FROM practica.comentari{suffix} WHERE {activity}",
+            f"""
+            DELETE FROM practica.comentari{suffix} WHERE id_comentari IN (
+                SELECT id_comentari FROM practica.comentari{suffix} WHERE {activity} LIMIT %s
+            )
+            """,
+        ),
+        (
+            f"{prefix}Recommendations",
+            f"SELECT COUNT(*) FROM practica.recomanacio{suffix} WHERE {activity}",
+            f"""
+            DELETE FROM practica.recomanacio{suffix} WHERE id_recomanacio IN (
+                SELECT id_recomanacio FROM practica.recomanacio{suffix} WHERE {activity} LIMIT %s
+            )
+            """,
+        ),
+    ]
+
+
+# Dependent tables in deletion order: (label, count query, batched delete query)
+def _steps(kind, archived=False):
+    steps = _activity_steps(kind, "", "")
+    if archived:
+        steps += _activity_steps(kind, "_archive", "Archived ")
+    if kind in ROUTE_SCOPE:
+        steps.append((
+            "Routes",
+            f"SELECT COUNT(*) FROM practica.via WHERE {ROUTE_SCOPE[kind]}",
+            f"""
+            DELETE FROM practica.via WHERE id IN (
+                SELECT id FROM practica.via WHERE {ROUTE_SCOPE[kind]} LIMIT %s
+            )
+            """,
+        ))
+    if kind in SECTOR_SCOPE:
+        steps.append((
+            "Sectors",
+            f"SELECT COUNT(*) FROM practica.sector WHERE {SECTOR_SCOPE[kind]}",
+            f"""
+            DELETE FROM practica.sector WHERE id IN (
+                SELECT id FROM practica.sector WHERE {SECTOR_SCOPE[kind]} LIMIT %s
+            )
+            """,
+        ))
+    return steps
+
+
+# Dry run: how many rows purge() would remove, per dependent table
+def count_dependents(conn, kind, key):
+    counts = {}
+    archived = archive.is_installed(conn)
+    with conn.cursor() as cur:
+        for label, count_sql, _ in _steps(kind, archived):
+            cur.execute(count_sql, tuple(key))
+            counts[label] = cur.fetchone()[0]
+    conn.rollback()
+    return counts
+
+
+# Delete the parent identified by key and everything that depends on it.
+# key is (crag,), (crag, sector), (crag, sector, route) or (climber,).
+# progress, if given, is called as progress(label, deleted_so_far, total).
+def purge(conn, kind, key, batch_size=DEFAULT_BATCH_SIZE, pause=DEFAULT_PAUSE, progress=None):
+    key = tuple(key)
+    totals = count_dependents(conn, kind, key)
+    deleted = {}
+    archived = archive.is_installed(conn)
+    try:
+        for label, _, delete_sql in _steps(kind, archived):
+            done = 0
+            while True:
+                with conn.cursor() as cur:
+                    cur.execute(delete_sql, key + (batch_size,))
+                    removed = cur.rowcount
+                conn.commit()
+                done += removed
+                if progress:
+                    progress(label, done, totals[label])
+                if removed < batch_size:
+                    break
+                time.sleep(pause)
+            deleted[label] = done
+
+        with conn.cursor() as cur:
+            cur.execute(PARENT_DELETE[kind], key)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return deleted
@@ -0,0 +1,173 @@
+# Per-route rating aggregates with a Bayesian average.
+#
+# practica.route_rating keeps, for every rated route, the sum and count of its
+# ratings, a 1-5 histogram and a Bayesian average that pulls routes with few
+# votes towards the global mean:
+#
+#     bayes_avg = (PRIOR_WEIGHT * global_mean + rating_sum) / (PRIOR_WEIGHT + rating_count)
+#
+# so a single 5-star vote no longer beats fifty 4.8 averages. The cdc engine
+# applies the deltas of every insert, update and delete on recomanacio.
+# The global mean moves slowly, so the averages of routes that weren't touched
+# are only refreshed by refresh() / rebuild().
+import argparse
+import sys
+
+from practica import archive, cdc, db
+
+NAME = "ratings"
+
+TABLES = ["recomanacio"]
+
+PRIOR_WEIGHT = 5
+
+KEY = "nom_via, nom_sector_via, nom_crag_via"
+
+DDL = f"""
+CREATE TABLE IF NOT EXISTS practica.route_rating (
+    nom_via         varchar(255) NOT NULL,
+    nom_sector_via  varchar(255) NOT NULL,
+    nom_crag_via    varchar(255) NOT NULL,
+    rating_sum      bigint NOT NULL DEFAULT 0,
+    rating_count    bigint NOT NULL DEFAULT 0,
+    hist_1          bigint NOT NULL DEFAULT 0,
+    hist_2          bigint NOT NULL DEFAULT 0,
+    hist_3          bigint NOT NULL DEFAULT 0,
+    hist_4          bigint NOT NULL DEFAULT 0,
+    hist_5          bigint NOT NULL DEFAULT 0,
+    bayes_avg       numeric(5, 3),
+    PRIMARY KEY ({KEY})
+);
+CREATE INDEX IF NOT EXISTS route_rating_bayes_idx
+    ON practica.route_rating (bayes_avg DESC) WHERE rating_count > 0;
+CREATE INDEX IF NOT EXISTS route_rating_crag_bayes_idx
+    ON practica.route_rating (nom_crag_via, bayes_avg DESC) WHERE rating_count > 0;
+
+CREATE TABLE IF NOT EXISTS practica.rating_global (
+    id            boolean PRIMARY KEY DEFAULT true CHECK (id),
+    rating_sum    bigint NOT NULL DEFAULT 0,
+    rating_count  bigint NOT NULL DEFAULT 0
+);
+INSERT INTO practica.rating_global (id) VALUES (true) ON CONFLICT DO NOTHING;
+
+CREATE OR REPLACE FUNCTION practica.rating_bayes(rating_sum bigint, rating_count bigint) RETURNS numeric AS $$
+    SELECT ROUND(
+        ({PRIOR_WEIGHT} * COALESCE(g.rating_sum::numeric / NULLIF(g.rating_count, 0), 3) + rating_sum)
+        / ({PRIOR_WEIGHT} + rating_count),
+        3
+    )
+    FROM practica.rating_global g
+$$ LANGUAGE sql STABLE;
+"""
+
+# Adds sign * (the ratings in rows) to the aggregates
+APPLY_DELTA = f"""
+        INSERT INTO practica.route_rating AS r (
+            {KEY}, rating_sum, rating_count, hist_1, hist_2, hist_3, hist_4, hist_5
+        )
+        SELECT {KEY},
+               {{sign}} * SUM(puntuacio), {{sign}} * COUNT(*),
+               {{sign}} * COUNT(*) FILTER (WHERE puntuacio = 1),
+               {{sign}} * COUNT(*) FILTER (WHERE puntuacio = 2),
+               {{sign}} * COUNT(*) FILTER (WHERE puntuacio = 3),
+               {{sign}} * COUNT(*) FILTER (WHERE puntuacio = 4),
+               {{sign}} * COUNT(*) FILTER (WHERE puntuacio = 5)
+        FROM {{rows}}
+        WHERE puntuacio IS NOT NULL
+        GROUP BY {KEY}
+        ON CONFLICT ({KEY}) DO UPDATE SET
+            rating_sum = r.rating_sum + EXCLUDED.rating_sum,
+            rating_count = r.rating_count + EXCLUDED.rating_count,
+            hist_1 = r.hist_1 + EXCLUDED.hist_1,
+            hist_2 = r.hist_2 + EXCLUDED.hist_2,
+            hist_3 = r.hist_3 + EXCLUDED.hist_3,
+            hist_4 = r.hist_4 + EXCLUDED.hist_4,
+            hist_5 = r.hist_5 + EXCLUDED.hist_5;
+
+        UPDATE practica.rating_global SET
+            rating_sum = rating_sum + {{sign}} * (SELECT COALESCE(SUM(puntuacio), 0) FROM {{rows}}),
+            rating_count = rating_count + {{sign}} * (SELECT COUNT(puntuacio) FROM {{rows}});
+"""
+
+REFRESH_TOUCHED = f"""
+        UPDATE practica.route_rating r SET bayes_avg = practica.rating_bayes(r.rating_sum, r.rating_count)
+        WHERE ({KEY}) IN (SELECT {KEY} FROM {{rows}});
+"""
+
+# Triggers that maintained the aggregates before the change log
+LEGACY = """
+DROP TRIGGER IF EXISTS route_rating_insert ON practica.recomanacio;
+DROP TRIGGER IF EXISTS route_rating_update ON practica.recomanacio;
+DROP TRIGGER IF EXISTS route_rating_delete ON practica.recomanacio;
+DROP FUNCTION IF EXISTS practica.route_rating_apply();
+"""
+
+
+def apply_changes(cur):
+    for sign in (1, -1):
+        changes = f"{cdc.rows('recomanacio', sign)} AS changes"
+        cur.execute(APPLY_DELTA.format(sign=sign, rows=changes))
+        cur.execute(REFRESH_TOUCHED.format(rows=changes))
+
+
+# Top routes by Bayesian average, optionally within one crag
+TOP_ROUTES = f"""
+    SELECT {KEY}, bayes_avg, ROUND(rating_sum::numeric / rating_count, 2), rating_count
+    FROM practica.route_rating
+    WHERE rating_count > 0 {{crag_filter}}
+    ORDER BY bayes_avg DESC
+    LIMIT %s
+"""
+
+
+# by_crag takes a list of crags as the first parameter
+def top_routes_query(by_crag=False):
+    return TOP_ROUTES.format(crag_filter="AND nom_crag_via = ANY(%s)" if by_crag else "")
+
+
+def refill(cur, archived):
+    cur.execute("TRUNCATE practica.route_rating")
+    cur.execute("UPDATE practica.rating_global SET rating_sum = 0, rating_count = 0")
+    cur.execute(APPLY_DELTA.format(sign=1, rows=archive.source("recomanacio", archived)))
+    cur.execute("UPDATE practica.route_rating SET bayes_avg = practica.rating_bayes(rating_sum, rating_count)")
+
+
+def install(conn):
+    cdc.install(conn)
+    with conn.cursor() as cur:
+        cur.execute(DDL)
+        cur.execute(LEGACY)
+    conn.commit()
+    cdc.subscribe(conn, sys.modules[__name__])
+
+
+# Recompute every aggregate from the ratings, archived ones included
+def rebuild(conn):
+    cdc.subscribe(conn, sys.modules[__name__], rebuild=True)
+
+
+# Bring every Bayesian average in line with the current global mean
+def refresh(conn):
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE practica.route_rating
+            SET bayes_avg = practica.rating_bayes(rating_sum, rating_count)
+            WHERE bayes_avg IS DISTINCT FROM practica.rating_bayes(rating_sum, rating_count)
+            """
+        )
+        updated = cur.rowcount
+    conn.commit()
+    return updated
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the per-route rating aggregates")
+    parser.add_argument("--rebuild", action="store_true", help="recompute everything from the ratings")
+    args = parser.parse_args()
+
+    conn = db.connect()
+    install(conn)
+    if args.rebuild:
+        rebuild(conn)
+    print(f"Refreshed {refresh(conn)} Bayesian averages")
@@ -0,0 +1,107 @@
+# Read-replica routing with read-your-writes.
+#
+# Writes always go to the primary (DB_HOST). Reads go round-robin to the
+# streaming replicas listed in DB_REPLICA_HOSTS ("host[:port],..."), except
+# that a session which has written remembers the primary's WAL position after
+# its last commit and only reads from a replica that has replayed up to it;
+# when none has, it reads from the primary. adminApp/userApp keep that
+# position in st.session_state and the Django router in the user's session,
+# both through the functions below.
+import itertools
+import os
+
+from practica import db
+
+CURRENT_LSN = "SELECT pg_current_wal_lsn()::text"
+
+# A server that isn't in recovery is a primary and therefore always current
+CAUGHT_UP = "SELECT COALESCE(pg_last_wal_replay_lsn() >= %s::pg_lsn, NOT pg_is_in_recovery())"
+
+# Seconds to wait for a replica that may be down before reading elsewhere
+CONNECT_TIMEOUT = 2
+
+_turn = itertools.count()
+
+
+def replica_hosts():
+    hosts = []
+    for entry in os.getenv("DB_REPLICA_HOSTS", "").split(","):
+        entry = entry.strip()
+        if entry:
+            host, _, port = entry.partition(":")
+            hosts.append((host, port or os.getenv("DB_PORT", "5432")))
+    return hosts
+
+
+# A replica's connection, opened on first use and again whenever it has been
+# closed or broken, so a replica that is down at startup or goes away later
+# is only skipped until it is back. Replica connections never hold a
+# transaction open, so they can't hold back WAL replay with a long-lived
+# snapshot.
+class Replica:
+    __slots__ = ("host", "port", "conn")
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.conn = None
+
+    def connection(self):
+        if self.conn is None or self.conn.closed:
+            self.conn = db.connect(host=self.host, port=self.port, connect_timeout=CONNECT_TIMEOUT)
+            self.conn.set_session(readonly=True, autocommit=True)
+        return self.conn
+
+    def reset(self):
+        if self.conn is not None and not self.conn.closed:
+            self.conn.close()
+        self.conn = None
+
+
+# Connects lazily, so an unreachable replica doesn't fail the caller
+def connect_replicas():
+    return [Replica(host, port) for host, port in replica_hosts()]
+
+
+# WAL position to wait for after a commit made through cursor's connection
+def current_lsn(cursor):
+    cursor.execute(CURRENT_LSN)
+    return cursor.fetchone()[0]
+
+
+# Whether the server has replayed lsn; with no lsn, only that it answers
+def caught_up(cursor, lsn):
+    if lsn is None:
+        cursor.execute("SELECT true")
+    else:
+        cursor.execute(CAUGHT_UP, (lsn,))
+    return cursor.fetchone()[0]
+
+
+# Pick the next replica that has replayed min_lsn; None means "use the primary".
+# is_caught_up(candidate, min_lsn) does the check for whatever a candidate is
+# (a psycopg2 connection, a Django alias, ...). A replica that fails the check,
+# for instance because it is down, is skipped like one that is lagging.
+def choose(candidates, min_lsn, is_caught_up):
+    if not candidates:
+        return None
+    start = next(_turn)
+    for offset in range(len(candidates)):
+        candidate = candidates[(start + offset) % len(candidates)]
+        try:
+            if is_caught_up(candidate, min_lsn):
+                return candidate
+        except Exception:
+            continue
+    return None
+
+
+# Check for a Replica; a connection that fails it is dropped and reopened on
+# the next try
+def connection_caught_up(replica, min_lsn):
+    try:
+        with replica.connection().cursor() as cur:
+            return caught_up(cur, min_lsn)
+    except Exception:
+        replica.reset()
+        raise
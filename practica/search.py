@@ -0,0 +1,146 @@
+# Full-text search over comments and routes.
+#
+# comentari.text_cerca and via.text_cerca are tsvector columns with GIN
+# indexes: the comment text, and the route name (weight A) and description
+# (weight B). Climbers write in Catalan, Spanish or English, so the text is
+# stemmed with each of LANGUAGES that the server has (Catalan needs
+# PostgreSQL 16) and a search matches if it matches in any of them. Only the
+# matching rows are ranked, and snippets are only cut for the rows shown.
+#
+# The columns are generated, so PostgreSQL fills them on every insert and
+# update and once when they are added, without a trigger: an UPDATE backfill
+# would have run every comment through the change log.
+import argparse
+
+from practica import archive, db
+
+LANGUAGES = ["catalan", "spanish", "english"]
+
+DEFAULT_LIMIT = 50
+
+# Snippet markers, bold in Streamlit markdown
+HEADLINE_OPTIONS = "StartSel=**, StopSel=**, MaxWords=30, MinWords=10, MaxFragments=2, FragmentDelimiter=' … '"
+
+FUNCTIONS = """
+CREATE OR REPLACE FUNCTION practica.search_vector(doc text) RETURNS tsvector AS $$
+    SELECT {vectors}
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION practica.search_query(query text) RETURNS tsquery AS $$
+    SELECT {queries}
+$$ LANGUAGE sql IMMUTABLE;
+
+-- Snippet of doc highlighting the query, in the first language it matches in
+CREATE OR REPLACE FUNCTION practica.search_headline(doc text, query text) RETURNS text AS $$
+DECLARE
+    config regconfig;
+BEGIN
+    FOREACH config IN ARRAY ARRAY[{configs}]::regconfig[] LOOP
+        IF to_tsvector(config, doc) @@ websearch_to_tsquery(config, query) THEN
+            RETURN ts_headline(config, doc, websearch_to_tsquery(config, query), '{options}');
+        END IF;
+    END LOOP;
+    RETURN left(doc, 200);
+END;
+$$ LANGUAGE plpgsql STABLE;
+"""
+
+DDL = """
+ALTER TABLE practica.comentari ADD COLUMN IF NOT EXISTS text_cerca tsvector
+    GENERATED ALWAYS AS (practica.search_vector(text_comentari)) STORED;
+CREATE INDEX IF NOT EXISTS comentari_text_cerca_idx ON practica.comentari USING gin (text_cerca);
+
+ALTER TABLE practica.via ADD COLUMN IF NOT EXISTS text_cerca tsvector
+    GENERATED ALWAYS AS (
+        setweight(practica.search_vector(nom), 'A') || setweight(practica.search_vector(COALESCE(descripcio, '')), 'B')
+    ) STORED;
+CREATE INDEX IF NOT EXISTS via_text_cerca_idx ON practica.via USING gin (text_cerca);
+"""
+
+# Archived comments keep the vector they were moved with; those archived
+# before the column existed get theirs here (the archive tables aren't logged)
+ARCHIVE_DDL = """
+ALTER TABLE practica.comentari_archive ADD COLUMN IF NOT EXISTS text_cerca tsvector;
+UPDATE practica.comentari_archive SET text_cerca = practica.search_vector(text_comentari) WHERE text_cerca IS NULL;
+CREATE INDEX IF NOT EXISTS comentari_archive_text_cerca_idx ON practica.comentari_archive USING gin (text_cerca);
+"""
+
+# Best matching comments first, see comment_search_query()
+COMMENT_SEARCH = """
+    SELECT c.id_comentari, c.nom_usuari_escalador, c.nom_via, c.nom_sector_via, c.nom_crag_via,
+           c.data_comentari, practica.search_headline(c.text_comentari, %s), c.rank
+    FROM (
+        SELECT c.*, ts_rank_cd(c.text_cerca, practica.search_query(%s)) AS rank
+        FROM {table} c
+        WHERE c.text_cerca @@ practica.search_query(%s) {conditions}
+        ORDER BY rank DESC, c.data_comentari DESC
+        LIMIT %s
+    ) c
+    ORDER BY c.rank DESC, c.data_comentari DESC
+"""
+
+# Best matching routes first, name matches before description matches.
+# Params: query, limit.
+ROUTE_SEARCH = """
+    SELECT v.nom, v.nom_sector, v.nom_crag_sector, v.grau_dificultat,
+           practica.search_headline(COALESCE(v.descripcio, ''), %(query)s), v.rank
+    FROM (
+        SELECT v.*, ts_rank_cd(v.text_cerca, practica.search_query(%(query)s)) AS rank
+        FROM practica.via v
+        WHERE v.text_cerca @@ practica.search_query(%(query)s)
+        ORDER BY rank DESC, v.nom
+        LIMIT %(limit)s
+    ) v
+    ORDER BY v.rank DESC, v.nom
+"""
+
+
+# The text search configurations of LANGUAGES that the server has, or
+# "simple" (no stemming) if none
+def available_languages(cur):
+    cur.execute("SELECT cfgname FROM pg_ts_config WHERE cfgname = ANY(%s)", (LANGUAGES,))
+    found = {row[0] for row in cur.fetchall()}
+    return [language for language in LANGUAGES if language in found] or ["simple"]
+
+
+def install(conn):
+    with conn.cursor() as cur:
+        languages = available_languages(cur)
+        cur.execute(FUNCTIONS.format(
+            vectors=" || ".join(f"to_tsvector('{language}', COALESCE(doc, ''))" for language in languages),
+            queries=" || ".join(f"websearch_to_tsquery('{language}', query)" for language in languages),
+            configs=", ".join(f"'{language}'" for language in languages),
+            options=HEADLINE_OPTIONS.replace("'", "''"),
+        ))
+        cur.execute(DDL)
+        archived = archive.installed_in(cur)
+        if archived:
+            cur.execute(ARCHIVE_DDL)
+    conn.commit()
+    # Recreate the *_all views with the new column
+    if archived:
+        archive.install(conn)
+
+
+# Comment search, optionally over the archive too and with extra conditions
+# on c (e.g. from facets.filter_clause) and their params
+def comment_search_query(text, include_archived=False, conditions="", params=(), limit=DEFAULT_LIMIT):
+    query = COMMENT_SEARCH.format(table=archive.source("comentari", include_archived), conditions=conditions)
+    return query, (text, text, text) + tuple(params) + (limit,)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Search comments and routes")
+    parser.add_argument("query", nargs="?", help="search text; installs the search columns if omitted")
+    args = parser.parse_args()
+
+    conn = db.connect()
+    install(conn)
+    if args.query:
+        with conn.cursor() as cur:
+            cur.execute(ROUTE_SEARCH, {"query": args.query, "limit": 10})
+            for route, sector, crag, grade, headline, rank in cur.fetchall():
+                print(f"{rank:.3f}  {route} ({sector}, {crag}) {grade or ''}  {headline}")
+            cur.execute(*comment_search_query(args.query, limit=10))
+            for _, climber, route, sector, crag, day, headline, rank in cur.fetchall():
+                print(f"{rank:.3f}  {climber} on {route} ({crag}), {day:%Y-%m-%d}: {headline}")
@@ -0,0 +1,285 @@
+# "Similar routes nearby": content-based nearest neighbours within a crag.
+#
+# Each route is a feature vector: its grade (via.grau_ordinal, one grade a
+# unit), height (ten metres a unit), style (estil) and sector one-hot, and
+# the share of its ratings at each of 1-5 stars. practica.similar_route keeps
+# every route's NEIGHBOURS closest routes of the same crag, so the route page
+# reads them with a single probe of the primary key.
+#
+# Neighbours never cross crags, so a crag is its own exact index: a crag has
+# at most a few thousand routes, and distances are computed CHUNK_ELEMENTS
+# at a time with only the k nearest kept (argpartition). The cdc engine
+# rereads the features of the crags touched by the batch from the tables,
+# which also keeps the result right when the tables are ahead of the log,
+# but only recomputes the lists of the routes that changed and of the routes
+# whose lists they were in or now come into. A route change also changes
+# the crag's routes without a grade or height, which take the crag's mean.
+import argparse
+import sys
+
+import numpy as np
+from psycopg2 import extras
+
+from practica import archive, cdc, db
+
+NAME = "similar"
+
+TABLES = ["via", "recomanacio"]
+
+NEIGHBOURS = 5
+
+# Distance of one unit of each feature
+GRADE_STEP = 1.0
+HEIGHT_STEP = 10.0
+STYLE_WEIGHT = 2.0
+SECTOR_WEIGHT = 0.5
+RATING_WEIGHT = 2.0
+
+# Floats per chunk of route differences (8 bytes each)
+CHUNK_ELEMENTS = 4_000_000
+
+KEY = "nom_via, nom_sector_via, nom_crag_via"
+
+DDL = f"""
+CREATE TABLE IF NOT EXISTS practica.similar_route (
+    nom_via             varchar(255) NOT NULL,
+    nom_sector_via      varchar(255) NOT NULL,
+    nom_crag_via        varchar(255) NOT NULL,
+    rang                smallint NOT NULL,
+    similar_via         varchar(255) NOT NULL,
+    similar_sector_via  varchar(255) NOT NULL,
+    distancia           real NOT NULL,
+    PRIMARY KEY ({KEY}, rang)
+);
+"""
+
+# Features of the routes, of some crags if filtered by {route_crags} and
+# {rating_crags}
+FEATURES = """
+    SELECT v.nom, v.nom_sector, v.nom_crag_sector, v.grau_ordinal, v.estil, v.alcada_aproximada_metres,
+           COALESCE(r.n, 0), r.hist_1, r.hist_2, r.hist_3, r.hist_4, r.hist_5
+    FROM practica.via v
+    LEFT JOIN (
+        SELECT r.nom_via, r.nom_sector_via, r.nom_crag_via, COUNT(*) AS n,
+               COUNT(*) FILTER (WHERE r.puntuacio = 1) AS hist_1,
+               COUNT(*) FILTER (WHERE r.puntuacio = 2) AS hist_2,
+               COUNT(*) FILTER (WHERE r.puntuacio = 3) AS hist_3,
+               COUNT(*) FILTER (WHERE r.puntuacio = 4) AS hist_4,
+               COUNT(*) FILTER (WHERE r.puntuacio = 5) AS hist_5
+        FROM {recomanacio_table} r
+        WHERE true {rating_crags}
+        GROUP BY 1, 2, 3
+    ) r ON (r.nom_via, r.nom_sector_via, r.nom_crag_via) = (v.nom, v.nom_sector, v.nom_crag_sector)
+    WHERE true {route_crags}
+    ORDER BY v.nom_crag_sector, v.nom_sector, v.nom
+"""
+
+# Routes that changed, or whose ratings did, in the batch, and whether the
+# route itself did
+CHANGED_ROUTES = f"""
+    SELECT r.nom, r.nom_sector, r.nom_crag_sector, true FROM {cdc.rows("via", 1)} r
+    UNION
+    SELECT r.nom, r.nom_sector, r.nom_crag_sector, true FROM {cdc.rows("via", -1)} r
+    UNION
+    SELECT {KEY}, false FROM {cdc.rows("recomanacio", 1)} r
+    UNION
+    SELECT {KEY}, false FROM {cdc.rows("recomanacio", -1)} r
+"""
+
+# Stored neighbours of the routes of some crags, closest first
+STORED = """
+    SELECT nom_via, nom_sector_via, nom_crag_via, similar_via, similar_sector_via, distancia
+    FROM practica.similar_route
+    WHERE nom_crag_via = ANY(%s)
+    ORDER BY nom_crag_via, nom_sector_via, nom_via, rang
+"""
+
+DELETE_ROUTES = f"""
+    DELETE FROM practica.similar_route s
+    USING unnest(%s::text[], %s::text[], %s::text[]) AS k (nom_via, nom_sector_via, nom_crag_via)
+    WHERE (s.nom_via, s.nom_sector_via, s.nom_crag_via) = (k.nom_via, k.nom_sector_via, k.nom_crag_via)
+"""
+
+INSERT = f"""
+    INSERT INTO practica.similar_route ({KEY}, rang, similar_via, similar_sector_via, distancia) VALUES %s
+"""
+
+# A route's similar routes, closest first. Params: route, sector, crag.
+SIMILAR = """
+    SELECT s.similar_via, s.similar_sector_via, v.grau_dificultat, v.estil, v.alcada_aproximada_metres
+    FROM practica.similar_route s
+    JOIN practica.via v ON (v.nom, v.nom_sector, v.nom_crag_sector) = (s.similar_via, s.similar_sector_via, s.nom_crag_via)
+    WHERE s.nom_via = %s AND s.nom_sector_via = %s AND s.nom_crag_via = %s
+    ORDER BY s.rang
+"""
+
+
+# Missing values take the crag's mean, or 0 if the crag has none
+def _filled(values):
+    values = np.array(values, dtype=float)
+    missing = np.isnan(values)
+    values[missing] = np.nanmean(values) if not missing.all() else 0.0
+    return values
+
+
+def _one_hot(values, weight):
+    labels = sorted(set(values), key=str)
+    columns = np.zeros((len(values), len(labels)))
+    columns[np.arange(len(values)), [labels.index(value) for value in values]] = weight
+    return columns
+
+
+def vectors(routes):
+    grades = _filled([np.nan if r[3] is None else r[3] for r in routes]) / GRADE_STEP
+    heights = _filled([np.nan if r[5] is None else float(r[5]) for r in routes]) / HEIGHT_STEP
+    counts = np.array([r[6] for r in routes], dtype=float)
+    histograms = np.array([[h or 0 for h in r[7:12]] for r in routes], dtype=float)
+    shares = np.divide(histograms, counts[:, None], out=np.zeros_like(histograms), where=counts[:, None] > 0)
+    return np.hstack([
+        grades[:, None],
+        heights[:, None],
+        _one_hot([r[4] for r in routes], STYLE_WEIGHT),
+        _one_hot([r[1] for r in routes], SECTOR_WEIGHT),
+        RATING_WEIGHT * shares,
+    ])
+
+
+# Distances from each of the given routes (indices into points) to every
+# route, a chunk of rows at a time: (chunk indices, distances), with a
+# route's distance to itself infinite
+def _distances(points, indices):
+    step = max(1, CHUNK_ELEMENTS // points.size)
+    for start in range(0, len(indices), step):
+        chunk = np.asarray(indices[start:start + step])
+        block = np.sqrt(((points[chunk, None, :] - points[None, :, :]) ** 2).sum(axis=2))
+        block[np.arange(len(chunk)), chunk] = np.inf
+        yield chunk, block
+
+
+# Rows for INSERT with the NEIGHBOURS closest routes of some of a crag's
+# routes (indices, all by default); ties go to the route first in order
+def _neighbours(routes, points, indices=None):
+    if len(routes) < 2:
+        return []
+    k = min(NEIGHBOURS, len(routes) - 1)
+    rows = []
+    for chunk, block in _distances(points, range(len(routes)) if indices is None else indices):
+        kth = np.partition(block, k - 1, axis=1)[:, k - 1]
+        for i, distances, limit in zip(chunk, block, kth):
+            candidates = np.flatnonzero(distances <= limit)
+            nearest = candidates[np.lexsort((candidates, distances[candidates]))][:k]
+            route = routes[i]
+            for rank, j in enumerate(nearest, start=1):
+                rows.append((route[0], route[1], route[2], rank, routes[j][0], routes[j][1], float(distances[j])))
+    return rows
+
+
+# Indices of a crag's routes whose neighbours have to be recomputed: the
+# changed ones (keys (route, sector)), the ones without a full list, the ones
+# that had a changed or removed route in theirs, and the ones a changed
+# route now comes closer to than their furthest neighbour
+def _affected(routes, points, stored, changed):
+    index = {(route[0], route[1]): i for i, route in enumerate(routes)}
+    k = min(NEIGHBOURS, len(routes) - 1)
+    moved = sorted(index[key] for key in changed if key in index)
+    affected = set(moved)
+    furthest = np.full(len(routes), np.inf)
+    for key, i in index.items():
+        neighbours = stored.get(key, [])
+        if len(neighbours) != k or any(other in changed or other not in index for other, _ in neighbours):
+            affected.add(i)
+        elif k:
+            furthest[i] = neighbours[-1][1]
+    if moved and k:
+        # The stored distances are single precision
+        limit = furthest * (1 + 1e-6) + 1e-9
+        for _, block in _distances(points, moved):
+            affected.update(np.flatnonzero((block <= limit).any(axis=0)).tolist())
+    return sorted(affected)
+
+
+def _features(cur, archived, crags=None):
+    filtered = crags is not None
+    cur.execute(
+        FEATURES.format(
+            recomanacio_table=archive.source("recomanacio", archived),
+            rating_crags="AND r.nom_crag_via = ANY(%(crags)s)" if filtered else "",
+            route_crags="AND v.nom_crag_sector = ANY(%(crags)s)" if filtered else "",
+        ),
+        {"crags": crags} if filtered else None
+    )
+    by_crag = {}
+    for row in cur.fetchall():
+        by_crag.setdefault(row[2], []).append(row)
+    return by_crag
+
+
+def _insert(cur, rows):
+    if rows:
+        extras.execute_values(cur, INSERT, rows, page_size=10000)
+
+
+def apply_changes(cur):
+    cur.execute(CHANGED_ROUTES)
+    changed, route_changed = {}, set()
+    for route, sector, crag, via in cur.fetchall():
+        if crag is not None:
+            changed.setdefault(crag, set()).add((route, sector))
+            if via:
+                route_changed.add(crag)
+    if not changed:
+        return
+    crags = list(changed)
+    by_crag = _features(cur, archive.installed_in(cur), crags)
+    cur.execute(STORED, (crags,))
+    stored = {}
+    for route, sector, crag, other, other_sector, distance in cur.fetchall():
+        stored.setdefault(crag, {}).setdefault((route, sector), []).append(((other, other_sector), distance))
+
+    gone, rows = [], []
+    for crag in crags:
+        routes = by_crag.get(crag, [])
+        present = {(route[0], route[1]) for route in routes}
+        keys = changed[crag]
+        if crag in route_changed:
+            # Their grade or height is the crag's mean
+            keys = keys | {(route[0], route[1]) for route in routes if route[3] is None or route[5] is None}
+        gone.extend((route, sector, crag) for route, sector in stored.get(crag, {}) if (route, sector) not in present)
+        if not routes:
+            continue
+        points = vectors(routes)
+        affected = _affected(routes, points, stored.get(crag, {}), keys)
+        gone.extend(routes[i][:3] for i in affected)
+        rows.extend(_neighbours(routes, points, affected))
+    if gone:
+        cur.execute(DELETE_ROUTES, [list(column) for column in zip(*gone)])
+    _insert(cur, rows)
+
+
+def refill(cur, archived):
+    cur.execute("TRUNCATE practica.similar_route")
+    for routes in _features(cur, archived).values():
+        _insert(cur, _neighbours(routes, vectors(routes)))
+
+
+def install(conn):
+    cdc.install(conn)
+    with conn.cursor() as cur:
+        cur.execute(DDL)
+    conn.commit()
+    cdc.subscribe(conn, sys.modules[__name__])
+
+
+def rebuild(conn):
+    cdc.subscribe(conn, sys.modules[__name__], rebuild=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the similar-route neighbours")
+    parser.add_argument("--rebuild", action="store_true", help="recompute every crag from the routes and ratings")
+    args = parser.parse_args()
+
+    conn = db.connect()
+    install(conn)
+    if args.rebuild:
+        rebuild(conn)
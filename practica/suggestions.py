@@ -0,0 +1,201 @@
+# "Routes you might like": item-item collaborative filtering.
+#
+# Every (climber, route) pair with a recommendation or an attempt becomes an
+# entry of a sparse climber x route matrix: the rating relative to a neutral
+# 3 (so a 1-star rating pushes away from similar routes), plus a smaller
+# implicit term that grows with the number of attempts. Two routes are
+# similar when the same climbers engage with them the same way (the cosine
+# of their columns), and only each route's NEIGHBOURS most similar routes
+# are kept. A climber's score for a route is the sum of its similarities to
+# the routes they engaged with, weighted by how they did.
+#
+# The whole computation is a handful of sparse products, which takes a few
+# minutes for a million ratings, so it runs as a batch job
+# (python -m practica.suggestions, e.g. nightly) that stores each climber's
+# top TOP_K routes they haven't sent or rated in practica.route_suggestion.
+# Routes sent or rated since the last run are filtered out when the
+# suggestions are read.
+import argparse
+import time
+
+import numpy as np
+from psycopg2 import extras
+from scipy import sparse
+
+from practica import archive, db
+
+TOP_K = 20
+NEIGHBOURS = 50
+
+NEUTRAL_RATING = 3
+IMPLICIT_WEIGHT = 0.5
+
+DDL = """
+CREATE TABLE IF NOT EXISTS practica.route_suggestion (
+    nom_usuari      varchar(100) NOT NULL,
+    nom_via         varchar(255) NOT NULL,
+    nom_sector_via  varchar(255) NOT NULL,
+    nom_crag_via    varchar(255) NOT NULL,
+    score           real NOT NULL,
+    PRIMARY KEY (nom_usuari, nom_via, nom_sector_via, nom_crag_via)
+);
+CREATE INDEX IF NOT EXISTS route_suggestion_score_idx ON practica.route_suggestion (nom_usuari, score DESC);
+"""
+
+# One row per (climber, route) with any activity: average rating (NULL if
+# not rated), attempts and whether the route was sent
+INTERACTIONS = """
+    WITH ratings AS (
+        SELECT nom_usuari_escalador, nom_via, nom_sector_via, nom_crag_via, AVG(puntuacio)::float AS rating
+        FROM {recomanacio_table}
+        GROUP BY 1, 2, 3, 4
+    ), attempts AS (
+        SELECT i.nom_usuari_escalador, i.nom_via, i.nom_sector_via, i.nom_crag_via,
+               COUNT(*) AS intents, bool_or(e.id_intent IS NOT NULL) AS sent
+        FROM {intent_table} i
+        LEFT JOIN {encadenament_table} e ON e.id_intent = i.id_intent
+        GROUP BY 1, 2, 3, 4
+    )
+    SELECT nom_usuari_escalador, nom_via, nom_sector_via, nom_crag_via,
+           r.rating, COALESCE(a.intents, 0), COALESCE(a.sent, false)
+    FROM ratings r
+    FULL JOIN attempts a USING (nom_usuari_escalador, nom_via, nom_sector_via, nom_crag_via)
+"""
+
+INSERT = """
+    INSERT INTO practica.route_suggestion (nom_usuari, nom_via, nom_sector_via, nom_crag_via, score) VALUES %s
+"""
+
+# A climber's suggestions, best first, without the routes they have sent or
+# rated since the last run; see suggestions_query()
+SUGGESTIONS = """
+    SELECT s.nom_via, s.nom_sector_via, s.nom_crag_via, v.grau_dificultat, s.score
+    FROM practica.route_suggestion s
+    JOIN practica.via v ON (v.nom, v.nom_sector, v.nom_crag_sector) = (s.nom_via, s.nom_sector_via, s.nom_crag_via)
+    WHERE s.nom_usuari = %s
+      AND NOT EXISTS (
+          SELECT 1 FROM practica.intent i JOIN practica.encadenament e ON e.id_intent = i.id_intent
+          WHERE i.nom_usuari_escalador = %s
+            AND (i.nom_via, i.nom_sector_via, i.nom_crag_via) = (s.nom_via, s.nom_sector_via, s.nom_crag_via)
+      )
+      AND NOT EXISTS (
+          SELECT 1 FROM practica.recomanacio r
+          WHERE r.nom_usuari_escalador = %s
+            AND (r.nom_via, r.nom_sector_via, r.nom_crag_via) = (s.nom_via, s.nom_sector_via, s.nom_crag_via)
+      ) {grades}
+    ORDER BY s.score DESC
+    LIMIT %s
+"""
+
+
+def install(conn):
+    with conn.cursor() as cur:
+        cur.execute(DDL)
+    conn.commit()
+
+
+# Suggestions query and params for a climber, optionally only of the grades
+# (ordinals) between grades[0] and grades[1], e.g. levels.around()
+def suggestions_query(climber, grades=None, limit=10):
+    if grades is None:
+        return SUGGESTIONS.format(grades=""), (climber, climber, climber, limit)
+    return SUGGESTIONS.format(grades="AND v.grau_ordinal BETWEEN %s AND %s"), (climber, climber, climber) + tuple(grades) + (limit,)
+
+
+# Keeps the n largest entries of each row of a CSR matrix
+def _top_per_row(matrix, n):
+    indptr, indices, data = matrix.indptr, matrix.indices, matrix.data
+    keep = np.zeros(len(data), dtype=bool)
+    for row in range(matrix.shape[0]):
+        start, end = indptr[row], indptr[row + 1]
+        if end - start <= n:
+            keep[start:end] = True
+        else:
+            keep[start + np.argpartition(-data[start:end], n)[:n]] = True
+    pruned = sparse.csr_matrix((np.where(keep, data, 0), indices, indptr), shape=matrix.shape)
+    pruned.eliminate_zeros()
+    return pruned
+
+
+# Item-item scores from interaction rows (climber, route key, rating or
+# None, attempts, sent). Returns {climber: [(route key, score)]}, best first,
+# with only positive scores on routes the climber hasn't sent or rated.
+def train(rows, top_k=TOP_K, neighbours=NEIGHBOURS):
+    climbers, routes = {}, {}
+    users, items, values, known = [], [], [], []
+    for climber, route, rating, intents, was_sent in rows:
+        users.append(climbers.setdefault(climber, len(climbers)))
+        items.append(routes.setdefault(route, len(routes)))
+        values.append(
+            (rating - NEUTRAL_RATING if rating is not None else 0.0) + IMPLICIT_WEIGHT * np.log1p(intents)
+        )
+        known.append(was_sent or rating is not None)
+    if not values:
+        return {}
+    shape = (len(climbers), len(routes))
+    users, items, known = np.array(users), np.array(items), np.array(known, dtype=bool)
+    engagement = sparse.csr_matrix((np.array(values, dtype=np.float32), (users, items)), shape=shape)
+    engagement.eliminate_zeros()
+
+    # Cosine similarity between route columns, each route's neighbours only
+    norms = np.sqrt(np.asarray(engagement.multiply(engagement).sum(axis=0)).ravel())
+    normalized = engagement @ sparse.diags(np.divide(1, norms, out=np.zeros_like(norms), where=norms > 0))
+    similarity = (normalized.T @ normalized).tocsr()
+    similarity.setdiag(0)
+    similarity.eliminate_zeros()
+    similarity = _top_per_row(similarity, neighbours)
+
+    # Route j's score sums its similarity to the climber's routes i, so j's
+    # neighbour lists are the columns here
+    scores = (engagement @ similarity.T).tocsr()
+    # Routes the climber sent or rated are known to them, liked or not
+    done = sparse.csr_matrix((np.ones(known.sum(), dtype=np.float32), (users[known], items[known])), shape=shape)
+    scores = scores - scores.multiply(done)
+    scores.data[scores.data < 0] = 0
+    scores.eliminate_zeros()
+    scores = _top_per_row(scores, top_k)
+
+    climber_names, route_keys = list(climbers), list(routes)
+    suggestions = {}
+    for user in range(shape[0]):
+        start, end = scores.indptr[user], scores.indptr[user + 1]
+        order = np.argsort(-scores.data[start:end])
+        suggestions[climber_names[user]] = [
+            (route_keys[scores.indices[start + i]], float(scores.data[start + i])) for i in order
+        ]
+    return suggestions
+
+
+# Retrains from every rating and attempt (archived ones too) and replaces
+# the stored suggestions. Returns the number of climbers with suggestions.
+def run(conn, top_k=TOP_K, neighbours=NEIGHBOURS):
+    with conn.cursor() as cur:
+        archived = archive.installed_in(cur)
+        cur.execute(INTERACTIONS.format(
+            recomanacio_table=archive.source("recomanacio", archived),
+            intent_table=archive.source("intent", archived),
+            encadenament_table=archive.source("encadenament", archived),
+        ))
+        rows = [(climber, tuple(route), rating, intents, sent) for climber, *route, rating, intents, sent in cur.fetchall()]
+        suggestions = train(rows, top_k, neighbours)
+        cur.execute("TRUNCATE practica.route_suggestion")
+        extras.execute_values(
+            cur, INSERT,
+            [(climber,) + route + (score,) for climber, routes in suggestions.items() for route, score in routes],
+            page_size=10000,
+        )
+    conn.commit()
+    return sum(1 for routes in suggestions.values() if routes)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recompute the route suggestions of every climber")
+    parser.add_argument("--top-k", type=int, default=TOP_K, help="suggestions kept per climber")
+    parser.add_argument("--neighbours", type=int, default=NEIGHBOURS, help="similar routes kept per route")
+    args = parser.parse_args()
+
+    conn = db.connect()
+    install(conn)
+    started = time.monotonic()
+    climbers = run(conn, args.top_k, args.neighbours)
+    print(f"Suggestions for {climbers} climbers in {time.monotonic() - started:.1f}s")
@@ -0,0 +1,116 @@
+# t-digest quantile sketches for ascent times.
+#
+# A digest summarises a distribution as a sorted list of centroids (mean,
+# weight). Centroids near the median may hold many values, centroids in the
+# tails only a few, so extreme quantiles stay accurate: with COMPRESSION = 100
+# a digest has about 50 centroids and quantile errors are typically well
+# under 1% of rank, less in the tails. Digests merge by pooling their
+# centroids and compressing again, so per-route digests roll up into
+# per-grade ones without going back to the rows.
+#
+# Digests are stored as bytea: min, max and then (mean, weight) pairs, all
+# float64.
+import math
+from collections import namedtuple
+
+import numpy as np
+
+COMPRESSION = 100
+
+Digest = namedtuple("Digest", ["means", "weights", "low", "high"])
+
+
+def _scale(q):
+    return COMPRESSION / (2 * math.pi) * math.asin(2 * min(max(q, 0.0), 1.0) - 1)
+
+
+def _compress(means, weights, low, high):
+    order = np.argsort(means, kind="stable")
+    means, weights = means[order], weights[order]
+    total = float(weights.sum())
+    out_means, out_weights = [], []
+    mean, weight = float(means[0]), float(weights[0])
+    done = 0.0
+    k_lower = _scale(0.0)
+    for next_mean, next_weight in zip(means[1:].tolist(), weights[1:].tolist()):
+        if _scale((done + weight + next_weight) / total) - k_lower <= 1:
+            mean += (next_mean - mean) * next_weight / (weight + next_weight)
+            weight += next_weight
+        else:
+            out_means.append(mean)
+            out_weights.append(weight)
+            done += weight
+            k_lower = _scale(done / total)
+            mean, weight = next_mean, next_weight
+    out_means.append(mean)
+    out_weights.append(weight)
+    return Digest(np.array(out_means), np.array(out_weights), low, high)
+
+
+# Digest of a list of values, or None if there are none
+def of(values):
+    values = np.asarray([value for value in values if value is not None], dtype=float)
+    if not len(values):
+        return None
+    return _compress(values, np.ones(len(values)), float(values.min()), float(values.max()))
+
+
+def merge(digests):
+    digests = [digest for digest in digests if digest is not None]
+    if not digests:
+        return None
+    return _compress(
+        np.concatenate([digest.means for digest in digests]),
+        np.concatenate([digest.weights for digest in digests]),
+        min(digest.low for digest in digests),
+        max(digest.high for digest in digests),
+    )
+
+
+def add(digest, values):
+    return merge([digest, of(values)])
+
+
+def count(digest):
+    return int(round(digest.weights.sum())) if digest is not None else 0
+
+
+# Interpolation knots: cumulative weight at each centroid's centre, with the
+# minimum at 0 and the maximum at the total
+def _knots(digest):
+    total = float(digest.weights.sum())
+    centres = np.cumsum(digest.weights) - digest.weights / 2
+    ranks = np.concatenate([[0.0], centres, [total]])
+    values = np.concatenate([[digest.low], digest.means, [digest.high]])
+    return ranks, values, total
+
+
+# Value below which a fraction q of the values lie
+def quantile(digest, q):
+    if digest is None:
+        return None
+    ranks, values, total = _knots(digest)
+    return float(np.interp(q * total, ranks, values))
+
+
+# Fraction of the values below x
+def cdf(digest, x):
+    if digest is None:
+        return None
+    ranks, values, total = _knots(digest)
+    return float(np.interp(x, values, ranks) / total)
+
+
+def encode(digest):
+    pairs = np.column_stack([digest.means, digest.weights]).ravel()
+    return np.concatenate([[digest.low, digest.high], pairs]).astype("<f8").tobytes()
+
+
+# From bytea or its hex text (e.g. from encode(digest, 'hex'))
+def decode(data):
+    if data is None:
+        return None
+    data = bytes.fromhex(data) if isinstance(data, str) else bytes(data)
+    values = np.frombuffer(data, dtype="<f8")
+    pairs = values[2:].reshape(-1, 2)
+    return Digest(pairs[:, 0].copy(), pairs[:, 1].copy(), float(values[0]), float(values[1]))
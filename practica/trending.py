@@ -0,0 +1,207 @@
+# Trending routes with exponentially decayed activity scores.
+#
+# Every attempt, completion, comment and recommendation adds its weight to
+# its route's score, decayed by half every HALF_LIFE_DAYS since it happened.
+# Decaying every score as time passes would rewrite the whole table, so
+# scores are kept relative to a fixed EPOCH instead ("forward decay"): an
+# event at day t adds weight * 2^((t - EPOCH) / HALF_LIFE_DAYS), and the score
+# today is the stored sum divided by 2^((today - EPOCH) / HALF_LIFE_DAYS).
+# That divisor is the same for every route, so the stored sums rank the
+# routes exactly like the decayed scores: the top N is a short scan of the
+# index on practica.route_trend, and the decay is only applied to the rows
+# read. The sums grow without bound, so they are stored as logarithms.
+#
+# The cdc engine adds the events of each batch and takes away the deleted
+# ones. Events are dated by their own date column, so a late insert lands at
+# its place in time. Taking most of a score away leaves little more than the
+# rounding error of the largest score it held (e.g. a purged route's recent
+# events, see practica/purge.py), kept in log_peak, so routes that fall more
+# than PRECISION_LOSS below it are recomputed from the tables.
+import argparse
+import math
+import sys
+
+from practica import archive, cdc, db
+
+NAME = "trending"
+
+TABLES = ["intent", "encadenament", "recomanacio", "comentari"]
+
+HALF_LIFE_DAYS = 7
+EPOCH = "2024-01-01"
+
+# Weights of the events
+WEIGHTS = {
+    "intent": 1.0,
+    "encadenament": 2.0,
+    "comentari": 1.0,
+    "recomanacio": 1.5,
+}
+
+KEY = "nom_via, nom_sector_via, nom_crag_via"
+
+# A double carries about ln(2^53) = 36.7 of log score
+PRECISION_LOSS = 25
+
+# Growth of the forward-decayed weights, per day
+RATE = math.log(2) / HALF_LIFE_DAYS
+
+DDL = f"""
+CREATE TABLE IF NOT EXISTS practica.route_trend (
+    nom_via         varchar(255) NOT NULL,
+    nom_sector_via  varchar(255) NOT NULL,
+    nom_crag_via    varchar(255) NOT NULL,
+    log_score       double precision NOT NULL,
+    PRIMARY KEY ({KEY})
+);
+ALTER TABLE practica.route_trend ADD COLUMN IF NOT EXISTS log_peak double precision;
+CREATE INDEX IF NOT EXISTS route_trend_score_idx ON practica.route_trend (log_score DESC);
+
+-- ln(exp(a) + exp(b)) and ln(exp(a) - exp(b)) without leaving log space.
+-- A difference that cancels out is -infinity, which removes the route.
+CREATE OR REPLACE FUNCTION practica.log_add(a double precision, b double precision) RETURNS double precision AS $$
+    SELECT GREATEST(a, b) + ln(1 + exp(GREATEST(-abs(a - b), -700)))
+$$ LANGUAGE sql IMMUTABLE STRICT;
+
+CREATE OR REPLACE FUNCTION practica.log_sub(a double precision, b double precision) RETURNS double precision AS $$
+    SELECT CASE WHEN b >= a - 1e-8 THEN '-Infinity'::double precision
+                ELSE a + ln(1 - exp(GREATEST(b - a, -700))) END
+$$ LANGUAGE sql IMMUTABLE STRICT;
+"""
+
+# Log of the forward-decayed weight of an event
+_LOG_WEIGHT = "ln({weight}) + {rate} * EXTRACT(EPOCH FROM ({date})::timestamp - timestamp '{epoch}') / 86400"
+
+
+def _events(sources):
+    return " UNION ALL ".join(
+        f"SELECT r.nom_via, r.nom_sector_via, r.nom_crag_via, "
+        f"{_LOG_WEIGHT.format(weight=WEIGHTS[kind], rate=RATE, date=date, epoch=EPOCH)} AS x FROM {rows} r"
+        for kind, rows, date in sources
+    )
+
+
+# Rows of a table, only of the routes in the arrays passed as parameters if
+# keys is set
+def _of_routes(table, keys):
+    if not keys:
+        return table
+    return (
+        f"(SELECT * FROM {table} WHERE ({KEY}) IN"
+        f" (SELECT * FROM unnest(%(routes)s::text[], %(sectors)s::text[], %(crags)s::text[])))"
+    )
+
+
+# Events of the rows changed with the given sign, or of the tables
+def _sources(sign=None, archived=False, keys=False):
+    if sign is None:
+        intents = _of_routes(archive.source("intent", archived), keys)
+        completions = (
+            f"(SELECT i.* FROM {intents} i JOIN {archive.source('encadenament', archived)} e"
+            f" ON e.id_intent = i.id_intent)"
+        )
+        recomanacions = _of_routes(archive.source("recomanacio", archived), keys)
+        comentaris = _of_routes(archive.source("comentari", archived), keys)
+    else:
+        intents = cdc.rows("intent", sign)
+        completions = cdc.completions(sign)
+        recomanacions = cdc.rows("recomanacio", sign)
+        comentaris = cdc.rows("comentari", sign)
+    return [
+        ("intent", intents, "r.data_intent"),
+        ("encadenament", completions, "r.data_intent"),
+        ("recomanacio", recomanacions, "r.data_recomanacio"),
+        ("comentari", comentaris, "r.data_comentari"),
+    ]
+
+
+# Log of the summed weights per route: the log-sum-exp of the events,
+# shifted by the route's largest one so exp() stays in range
+def _scores(sources):
+    return f"""
+        SELECT {KEY}, top + ln(SUM(exp(GREATEST(x - top, -700)))) AS log_score
+        FROM (
+            SELECT e.*, MAX(x) OVER (PARTITION BY {KEY}) AS top
+            FROM ({_events(sources)}) e
+        ) e
+        GROUP BY {KEY}, top
+    """
+
+
+ADD_SCORES = f"""
+    INSERT INTO practica.route_trend AS t ({KEY}, log_score, log_peak)
+    SELECT s.*, s.log_score FROM ({{scores}}) s
+    ON CONFLICT ({KEY}) DO UPDATE SET
+        log_score = practica.log_add(t.log_score, EXCLUDED.log_score),
+        log_peak = GREATEST(t.log_peak, practica.log_add(t.log_score, EXCLUDED.log_score))
+"""
+
+# Returns the routes left with too few significant digits
+SUBTRACT_SCORES = """
+    WITH subtracted AS (
+        UPDATE practica.route_trend t SET log_score = practica.log_sub(t.log_score, d.log_score)
+        FROM ({scores}) d
+        WHERE (t.nom_via, t.nom_sector_via, t.nom_crag_via) = (d.nom_via, d.nom_sector_via, d.nom_crag_via)
+        RETURNING t.nom_via, t.nom_sector_via, t.nom_crag_via, t.log_score, t.log_peak
+    )
+    SELECT nom_via, nom_sector_via, nom_crag_via FROM subtracted
+    WHERE log_score > '-Infinity' AND (log_peak IS NULL OR log_score < log_peak - {loss})
+"""
+
+REMOVE_ROUTES = f"""
+    DELETE FROM practica.route_trend
+    WHERE ({KEY}) IN (SELECT * FROM unnest(%(routes)s::text[], %(sectors)s::text[], %(crags)s::text[]))
+"""
+
+# The decayed score as of now
+SCORE_NOW = f"exp(GREATEST(log_score - {RATE} * EXTRACT(EPOCH FROM now() - timestamp '{EPOCH}') / 86400, -700))"
+
+# Routes ranked by their score as of now. Params: limit.
+TOP_ROUTES = f"""
+    SELECT {KEY}, ROUND({SCORE_NOW}::numeric, 2)
+    FROM practica.route_trend
+    ORDER BY log_score DESC
+    LIMIT %s
+"""
+
+
+def apply_changes(cur):
+    cur.execute(ADD_SCORES.format(scores=_scores(_sources(1))))
+    cur.execute(SUBTRACT_SCORES.format(scores=_scores(_sources(-1)), loss=PRECISION_LOSS))
+    imprecise = cur.fetchall()
+    cur.execute("DELETE FROM practica.route_trend WHERE log_score = '-Infinity'")
+    if imprecise:
+        routes, sectors, crags = (list(column) for column in zip(*imprecise))
+        keys = {"routes": routes, "sectors": sectors, "crags": crags}
+        cur.execute(REMOVE_ROUTES, keys)
+        cur.execute(
+            ADD_SCORES.format(scores=_scores(_sources(archived=archive.installed_in(cur), keys=True))), keys
+        )
+
+
+def refill(cur, archived):
+    cur.execute("TRUNCATE practica.route_trend")
+    cur.execute(ADD_SCORES.format(scores=_scores(_sources(archived=archived))))
+
+
+def install(conn):
+    cdc.install(conn)
+    with conn.cursor() as cur:
+        cur.execute(DDL)
+    conn.commit()
+    cdc.subscribe(conn, sys.modules[__name__])
+
+
+def rebuild(conn):
+    cdc.subscribe(conn, sys.modules[__name__], rebuild=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the trending route scores")
+    parser.add_argument("--rebuild", action="store_true", help="recompute every score from the activity tables")
+    args = parser.parse_args()
+
+    conn = db.connect()
+    install(conn)
+    if args.rebuild:
+        rebuild(conn)
@@ -0,0 +1,146 @@
+# Fuzzy type-ahead over route, sector and crag names.
+#
+# Names are matched by trigrams, like pg_trgm: each word is lowercased,
+# stripped of accents and padded ("  sol " -> "  s", " so", "sol", "ol "),
+# and a route's score is the share of the query's trigrams found in
+# "route sector crag". A typo only spoils the two or three trigrams around
+# it, so "fisura del sol" still finds "Fissura del Sol".
+#
+# With pg_trgm on the server the matching runs in PostgreSQL on a GIN
+# trigram index (TRIGRAM_SEARCH). Without it, RouteIndex keeps the same
+# trigrams in memory as an inverted index of numpy arrays: a query adds up
+# the postings of its trigrams in one numpy bincount over the routes, which
+# stays under 50 ms for hundreds of thousands of routes.
+import argparse
+import unicodedata
+
+import numpy as np
+
+from practica import db
+
+DEFAULT_LIMIT = 10
+
+# Share of the query's trigrams a route has to have, in RouteIndex and (as
+# pg_trgm.word_similarity_threshold) in TRIGRAM_SEARCH
+THRESHOLD = 0.3
+
+DOCUMENT = "v.nom || ' ' || v.nom_sector || ' ' || v.nom_crag_sector"
+
+DDL = f"""
+CREATE INDEX IF NOT EXISTS via_nom_trgm_idx
+    ON practica.via USING gin (lower(practica.unaccent_text({DOCUMENT.replace('v.', '')})) gin_trgm_ops);
+"""
+
+# Accent folding that can be used in an index, for the trigram index
+UNACCENT = """
+CREATE OR REPLACE FUNCTION practica.unaccent_text(t text) RETURNS text AS $$
+    SELECT translate(t,
+        'àáâäãèéêëìíîïòóôöõùúûüçñÀÁÂÄÃÈÉÊËÌÍÎÏÒÓÔÖÕÙÚÛÜÇÑ·',
+        'aaaaaeeeeiiiiooooouuuucnAAAAAEEEEIIIIOOOOOUUUUCN.')
+$$ LANGUAGE sql IMMUTABLE STRICT;
+"""
+
+# Params: query, query, limit. <% filters on the server's threshold, so the
+# query sets it to THRESHOLD for its transaction first.
+TRIGRAM_SEARCH = f"""
+    SET LOCAL pg_trgm.word_similarity_threshold = {THRESHOLD};
+    SELECT v.nom, v.nom_sector, v.nom_crag_sector, v.grau_dificultat,
+           word_similarity(lower(practica.unaccent_text(%s)), lower(practica.unaccent_text({DOCUMENT}))) AS score
+    FROM practica.via v
+    WHERE lower(practica.unaccent_text(%s)) <%% lower(practica.unaccent_text({DOCUMENT}))
+    ORDER BY score DESC, v.nom
+    LIMIT %s
+"""
+
+ROUTES = "SELECT nom, nom_sector, nom_crag_sector, grau_dificultat FROM practica.via"
+
+
+def normalize(text):
+    text = unicodedata.normalize("NFKD", text.lower())
+    return "".join(char if char.isalnum() else " " for char in text if not unicodedata.combining(char))
+
+
+def trigrams(text):
+    grams = set()
+    for word in normalize(text).split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class RouteIndex:
+    __slots__ = ("routes", "postings", "sizes")
+
+    # routes: rows of (route, sector, crag, grade)
+    def __init__(self, routes):
+        self.routes = list(routes)
+        postings = {}
+        sizes = np.zeros(len(self.routes), dtype=np.int32)
+        for position, (route, sector, crag, _) in enumerate(self.routes):
+            grams = trigrams(f"{route} {sector} {crag}")
+            sizes[position] = len(grams)
+            for gram in grams:
+                postings.setdefault(gram, []).append(position)
+        self.postings = {gram: np.array(positions, dtype=np.int32) for gram, positions in postings.items()}
+        self.sizes = sizes
+
+    def __len__(self):
+        return len(self.routes)
+
+    # Best matches as (score, (route, sector, crag, grade)), best first
+    def search(self, text, limit=DEFAULT_LIMIT, threshold=THRESHOLD):
+        grams = trigrams(text)
+        if not grams or not self.routes:
+            return []
+        postings = [self.postings[gram] for gram in grams if gram in self.postings]
+        if not postings:
+            return []
+        shared = np.bincount(np.concatenate(postings), minlength=len(self.routes))
+        scores = shared / len(grams)
+        candidates = np.flatnonzero(scores >= threshold)
+        if not len(candidates):
+            return []
+        # Best coverage first, then the tighter match (fewer extra trigrams)
+        order = np.lexsort((self.sizes[candidates], -scores[candidates]))[:limit]
+        return [(float(scores[candidates[i]]), self.routes[candidates[i]]) for i in order]
+
+
+def has_trigram(cur):
+    cur.execute("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')")
+    return cur.fetchone()[0]
+
+
+def load(cur):
+    cur.execute(ROUTES)
+    return RouteIndex(cur.fetchall())
+
+
+# Creates the trigram index where pg_trgm can be installed; otherwise the
+# apps fall back to RouteIndex
+def install(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm')")
+        if cur.fetchone()[0]:
+            cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            cur.execute(UNACCENT)
+            cur.execute(DDL)
+    conn.commit()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find routes by approximate name")
+    parser.add_argument("query", nargs="?", help="text to look up; installs the trigram index if omitted")
+    parser.add_argument("--limit", type=int, default=DEFAULT_LIMIT)
+    args = parser.parse_args()
+
+    conn = db.connect()
+    install(conn)
+    if args.query:
+        with conn.cursor() as cur:
+            if has_trigram(cur):
+                cur.execute(TRIGRAM_SEARCH, (args.query, args.query, args.limit))
+                matches = [(score, row) for *row, score in cur.fetchall()]
+            else:
+                matches = load(cur).search(args.query, args.limit)
+        for score, (route, sector, crag, grade) in matches:
+            print(f"{score:.2f}  {route} ({sector}, {crag}) {grade or ''}")
@@ -1,11 +1,10 @@
 import streamlit as st
 import pandas as pd
-import psycopg2
 import plotly.express as px
 import plotly.graph_objects as go
 from datetime import datetime, timedelta
-import os
 from dotenv import load_dotenv
+from practica import activity, archive, ascent_times, catalog, consensus, cube, db, grades, hll, journeys, leaderboards, levels, partners, routing, search, similar, suggestions, trending, typeahead
 
 # ─── CONFIG & DB ───────────────────────────────────────────────────────────────
 
@@ -17,30 +16,88 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+# Primary: every write goes here
 @st.cache_resource
 def init_connection():
-    return psycopg2.connect(
-        dbname=os.getenv("DB_NAME", "postgres"),
-        user=os.getenv("DB_USER", "postgres"),
-        password=os.getenv("DB_PASSWORD", ""),
-        host=os.getenv("DB_HOST", "localhost"),
-        port=os.getenv("DB_PORT", "5432")
-    )
+    return db.connect()
+
+# Streaming replicas from DB_REPLICA_HOSTS serve the reads
+@st.cache_resource
+def init_replica_connections():
+    return routing.connect_replicas()
 
+def read_connection(min_lsn=None):
+    replica = routing.choose(init_replica_connections(), min_lsn, routing.connection_caught_up)
+    return replica.conn if replica else init_connection()
+
+# The WAL position of this session's last write is part of the cache key,
+# so a climber always sees the attempt they just logged
 @st.cache_data(ttl=600)
-def run_query(query, params=None, fetch=True):
-    conn = init_connection()
+def cached_query(query, params=None, fetch=True, min_lsn=None):
+    conn = read_connection(min_lsn) if fetch else init_connection()
     with conn.cursor() as cur:
         cur.execute(query, params)
         if fetch:
             return cur.fetchall()
         conn.commit()
 
-def run_query_no_cache(query, params=None):
+def run_query(query, params=None, fetch=True):
+    return cached_query(query, params, fetch, st.session_state.get("write_lsn"))
+
+run_query.clear = cached_query.clear
+
+def run_query_no_cache(query, params=None, fetch=False):
     conn = init_connection()
     with conn.cursor() as cur:
         cur.execute(query, params)
+        rows = cur.fetchall() if fetch else None
         conn.commit()
+        st.session_state.write_lsn = routing.current_lsn(cur)
+    return rows
+
+@st.cache_data(ttl=600)
+def archive_installed():
+    return archive.is_installed(init_connection())
+
+# The crag -> sector -> route catalog of practica/catalog.py, shared by every
+# session and loaded again only when practica.catalog_version moves
+@st.cache_resource(max_entries=1)
+def load_catalog(version, _min_lsn=None):
+    with read_connection(_min_lsn).cursor() as cur:
+        return catalog.load(cur)
+
+def catalog_tree():
+    min_lsn = st.session_state.get("write_lsn")
+    with read_connection(min_lsn).cursor() as cur:
+        version = catalog.current_version(cur)
+    return load_catalog(version, min_lsn)
+
+# Type-ahead matches come from pg_trgm if the server has it, else from an
+# in-memory trigram index of the routes
+@st.cache_data(ttl=600)
+def trigram_installed():
+    with init_connection().cursor() as cur:
+        return typeahead.has_trigram(cur)
+
+@st.cache_resource(ttl=600)
+def route_index():
+    with read_connection().cursor() as cur:
+        return typeahead.load(cur)
+
+def find_routes(text):
+    if trigram_installed():
+        rows = run_query(typeahead.TRIGRAM_SEARCH, (text, text, typeahead.DEFAULT_LIMIT))
+        return [tuple(row[:4]) for row in rows]
+    return [route for _, route in route_index().search(text)]
+
+# Picking a type-ahead match presets the crag, sector and route pickers
+def open_route_match():
+    match = st.session_state.route_match
+    if match != "–":
+        route, sector, crag, _ = match
+        st.session_state.searcher_crag = crag
+        st.session_state.searcher_sector = sector
+        st.session_state.searcher_route = route
 
 # ─── SESSION STATE FOR AUTH ────────────────────────────────────────────────────
 
@@ -119,7 +176,7 @@ if st.sidebar.button("Logout"):
 st.sidebar.title(f"Hello, {st.session_state.username}!")
 page = st.sidebar.radio(
     "Select a page",
-    ["Dashboard", "Route Searcher", "Profile"]
+    ["Dashboard", "Route Searcher", "Search", "Leaderboards", "Partners", "Profile"]
 )
 
 # ─── DASHBOARD ─────────────────────────────────────────────────────────────────
@@ -128,10 +185,11 @@ if page == "Dashboard":
     st.header("Dashboard")
 
     col1, col2, col3, col4 = st.columns(4)
-    crags_count    = run_query("SELECT COUNT(*) FROM practica.crag")[0][0]
-    routes_count   = run_query("SELECT COUNT(*) FROM practica.via")[0][0]
-    climbers_count = run_query("SELECT COUNT(*) FROM practica.escalador")[0][0]
-    attempts_count = run_query("SELECT COUNT(*) FROM practica.intent")[0][0]
+    totals         = dict(run_query("SELECT nom, valor FROM practica.stats_counter"))
+    crags_count    = totals.get("crag", 0)
+    routes_count   = totals.get("via", 0)
+    climbers_count = totals.get("escalador", 0)
+    attempts_count = totals.get("intent", 0)
 
     col1.metric("Total Crags", crags_count)
     col2.metric("Total Routes", routes_count)
@@ -141,40 +199,9 @@ if page == "Dashboard":
     st.markdown("---")
     st.subheader("Previous Month’s Route Activity")
 
-    month_stats = run_query(
-        """
-        SELECT
-            i.nom_via         AS via,
-            i.nom_sector_via  AS sector,
-            i.nom_crag_via    AS crag,
-            TO_CHAR(i.data_intent, 'YYYY-MM') AS mes_any,
-            COUNT(DISTINCT i.id_intent)      AS total_intents,
-            COUNT(DISTINCT r.id_recomanacio) AS total_recomanacions,
-            ROUND(AVG(r.puntuacio)::numeric, 2) AS puntuacio_mitjana,
-            COUNT(DISTINCT c.id_comentari)    AS total_comentaris
-        FROM practica.intent i
-        LEFT JOIN practica.recomanacio r
-        ON i.nom_via        = r.nom_via
-        AND i.nom_sector_via = r.nom_sector_via
-        AND i.nom_crag_via   = r.nom_crag_via
-        AND date_trunc('month', i.data_intent)
-            = date_trunc('month', r.data_recomanacio)
-        LEFT JOIN practica.comentari c
-        ON i.nom_via        = c.nom_via
-        AND i.nom_sector_via = c.nom_sector_via
-        AND i.nom_crag_via   = c.nom_crag_via
-        AND date_trunc('month', i.data_intent)
-            = date_trunc('month', c.data_comentari)
-        WHERE date_trunc('month', i.data_intent)
-            = (date_trunc('month', CURRENT_DATE) - INTERVAL '1 month')
-        GROUP BY
-            i.nom_via,
-            i.nom_sector_via,
-            i.nom_crag_via,
-            TO_CHAR(i.data_intent, 'YYYY-MM')
-        ORDER BY total_intents DESC
-        """
-    )
+    # Read from the route x month rollup, first day of the previous month
+    previous_month = (pd.Timestamp.today().normalize().replace(day=1) - pd.DateOffset(months=1)).date()
+    month_stats = run_query(activity.MONTH_SLICE, (previous_month,))
 
     if month_stats:
         df_month = pd.DataFrame(
@@ -184,9 +211,48 @@ if page == "Dashboard":
                 "Intents", "Recommendations", "Avg. Rating", "Comments"
             ]
         )
+        # Approximate distinct climbers per route, from the activity cube's sketches
+        climbers = hll.estimate_groups(run_query(
+            *cube.climber_sketches_query(period=(previous_month.year, previous_month.month), by="route")
+        ))
+        df_month["Climbers"] = [
+            climbers.get((crag, sector, route), 0)
+            for route, sector, crag in zip(df_month["Route"], df_month["Sector"], df_month["Crag"])
+        ]
         st.dataframe(df_month, use_container_width=True)
     else:
         st.info("No activity in the previous month.")
+
+    st.markdown("---")
+    st.subheader("🔥 Trending This Week")
+
+    # Routes ranked by recent activity, decayed by half every week
+    trending_routes = run_query(trending.TOP_ROUTES, (10,))
+    if trending_routes:
+        st.dataframe(
+            pd.DataFrame(trending_routes, columns=["Route", "Sector", "Crag", "Trend Score"]),
+            use_container_width=True
+        )
+    else:
+        st.info("No recent activity.")
+
+    st.markdown("---")
+    st.subheader("🧭 Routes You Might Like")
+
+    # Suggested by climbers with similar ratings and attempts, routes already sent left out,
+    # optionally only around the level estimated from the climber's sends
+    level = run_query(levels.LEVEL, (st.session_state.username,))
+    around_level = None
+    if level and st.checkbox(f"Only around my level ({grades.label(level[0][0])})", value=True):
+        around_level = levels.around(level[0][0])
+    suggested_routes = run_query(*suggestions.suggestions_query(st.session_state.username, around_level))
+    if suggested_routes:
+        st.dataframe(
+            pd.DataFrame(suggested_routes, columns=["Route", "Sector", "Crag", "Grade", "Score"]).round({"Score": 2}),
+            use_container_width=True
+        )
+    else:
+        st.info("No suggestions yet: rate and log a few routes first.")
     
 
 # ─── CRAGS PAGE ────────────────────────────────────────────────────────────────
@@ -194,37 +260,46 @@ if page == "Dashboard":
 elif page == "Route Searcher":
     st.header("🔍 Route Searcher")
 
+    # 0) Find a route by (part of) its name, its sector's or its crag's
+    quick_find = st.text_input("Quick find", placeholder="Route, sector or crag name, typos allowed")
+    if quick_find.strip():
+        matches = find_routes(quick_find)
+        if matches:
+            st.selectbox(
+                "Matches", ["–"] + matches, key="route_match", on_change=open_route_match,
+                format_func=lambda m: m if m == "–" else f"{m[0]} ({m[1]}, {m[2]}) {m[3] or ''}"
+            )
+        else:
+            st.info("No routes match.")
+
     # 1) Select a Crag
-    crag_list = run_query("SELECT nom FROM practica.crag ORDER BY nom")
-    if not crag_list:
+    tree = catalog_tree()
+    crag_names = tree.crags()
+    if not crag_names:
         st.info("No crags available.")
     else:
-        crag_names = [r[0] for r in crag_list]
-        selected_crag = st.selectbox("Choose a Crag", ["–"] + crag_names)
+        selected_crag = st.selectbox("Choose a Crag", ["–"] + crag_names, key="searcher_crag")
         
         if selected_crag and selected_crag != "–":
             # 2) Select a Sector in that Crag
-            sector_list = run_query(
-                "SELECT nom FROM practica.sector WHERE nom_crag = %s ORDER BY nom",
-                (selected_crag,)
-            )
-            if not sector_list:
+            sector_names = tree.sectors(selected_crag)
+            if not sector_names:
                 st.info(f"No sectors for crag '{selected_crag}'.")
             else:
-                sector_names = [r[0] for r in sector_list]
-                selected_sector = st.selectbox("Choose a Sector", ["–"] + sector_names)
+                # The last crag's sector, when the crag was changed by hand
+                if st.session_state.get("searcher_sector") not in sector_names:
+                    st.session_state.searcher_sector = "–"
+                selected_sector = st.selectbox("Choose a Sector", ["–"] + sector_names, key="searcher_sector")
                 
                 if selected_sector and selected_sector != "–":
                     # 3) Select a Route in that Sector
-                    route_list = run_query(
-                        "SELECT nom FROM practica.via WHERE nom_crag_sector = %s AND nom_sector = %s ORDER BY nom",
-                        (selected_crag, selected_sector)
-                    )
-                    if not route_list:
+                    route_names = tree.routes(selected_crag, selected_sector)
+                    if not route_names:
                         st.info(f"No routes in sector '{selected_sector}'.")
                     else:
-                        route_names = [r[0] for r in route_list]
-                        selected_route = st.selectbox("Choose a Route", ["–"] + route_names)
+                        if st.session_state.get("searcher_route") not in route_names:
+                            st.session_state.searcher_route = "–"
+                        selected_route = st.selectbox("Choose a Route", ["–"] + route_names, key="searcher_route")
                         
                         if selected_route and selected_route != "–":
                             # 4) Show route details
@@ -247,16 +322,74 @@ elif page == "Route Searcher":
                             st.markdown(f"**Equipped on:** {eq_date or '—'}")
 
                             # 4.1) Show Average Rating
-                            avg_rating = run_query(
+                            rating = run_query(
+                                """
+                                SELECT ROUND(rating_sum::numeric / NULLIF(rating_count, 0), 2), rating_count
+                                FROM practica.route_rating
+                                WHERE nom_via=%s AND nom_sector_via=%s AND nom_crag_via=%s
+                                """,
+                                (selected_route, selected_sector, selected_crag)
+                            )
+                            avg_rating, num_ratings = rating[0] if rating else (None, 0)
+
+                            st.metric("⭐ Avg. Rating", f"{avg_rating or 0.0} / 5", help=f"{num_ratings} ratings")
+
+                            # 4.1.0) Whether climbers find the grade soft or hard
+                            agreement = run_query(consensus.CONSENSUS, (selected_route, selected_sector, selected_crag))
+                            if agreement:
+                                ordinal, climbers, sends, below, at, above, effort, adjustment, confidence = agreement[0]
+                                if climbers < consensus.MIN_CLIMBERS or confidence < consensus.MIN_CONFIDENCE:
+                                    feel = "Not enough data"
+                                else:
+                                    feel = consensus.verdict(ordinal, adjustment, confidence, climbers) or "Fair grade"
+                                st.metric(
+                                    "⚖️ Grade Consensus", feel,
+                                    help=f"{climbers} climbers, {sends} sends, {confidence:.0%} confidence"
+                                )
+
+                            # 4.1.1) Send times, from the route's ascent-time digest
+                            times = run_query(
                                 """
-                                SELECT ROUND(AVG(puntuacio)::numeric, 2)
-                                FROM practica.recomanacio
+                                SELECT n, encode(digest, 'hex')
+                                FROM practica.route_ascent_time
                                 WHERE nom_via=%s AND nom_sector_via=%s AND nom_crag_via=%s
                                 """,
                                 (selected_route, selected_sector, selected_crag)
-                            )[0][0] or 0.0
+                            )
+                            if times:
+                                num_times, digest = times[0]
+                                median, p90 = ascent_times.summary(digest)
+                                # The digests also cover archived completions
+                                best = run_query(
+                                    f"""
+                                    SELECT EXTRACT(EPOCH FROM MIN(e.temps_ascensio))
+                                    FROM {archive.source("encadenament", archive_installed())} e
+                                    JOIN {archive.source("intent", archive_installed())} i ON i.id_intent = e.id_intent
+                                    WHERE i.nom_usuari_escalador=%s
+                                      AND i.nom_via=%s AND i.nom_sector_via=%s AND i.nom_crag_via=%s
+                                    """,
+                                    (st.session_state.username, selected_route, selected_sector, selected_crag)
+                                )[0][0]
+
+                                col_t1, col_t2, col_t3 = st.columns(3)
+                                col_t1.metric("⏱️ Median Send Time", ascent_times.format_duration(median), help=f"{num_times} timed completions")
+                                col_t2.metric("90% Send Within", ascent_times.format_duration(p90))
+                                if best is not None:
+                                    faster = ascent_times.faster_than(digest, float(best))
+                                    col_t3.metric(
+                                        "Your Best Time", ascent_times.format_duration(best),
+                                        f"faster than {faster:.0%} of other sends" if faster is not None else None,
+                                        delta_color="off"
+                                    )
 
-                            st.metric("⭐ Avg. Rating", f"{avg_rating} / 5")
+                            # 4.1.2) Closest routes of the same crag by grade, style, height and ratings
+                            similar_routes = run_query(similar.SIMILAR, (selected_route, selected_sector, selected_crag))
+                            if similar_routes:
+                                st.markdown("**Similar routes nearby**")
+                                st.dataframe(
+                                    pd.DataFrame(similar_routes, columns=["Route", "Sector", "Grade", "Style", "Height (m)"]),
+                                    use_container_width=True
+                                )
 
                             st.markdown("---")
 
@@ -367,13 +500,13 @@ elif page == "Route Searcher":
                                         VALUES (%s, %s, %s, %s, %s, %s)
                                         RETURNING id_intent
                                     """
-                                    intent_id = run_query(insert_intent_sql, (
+                                    intent_id = run_query_no_cache(insert_intent_sql, (
                                         att_type, att_date,
                                         st.session_state.username,
                                         selected_route,
                                         selected_sector,
                                         selected_crag
-                                    ))[0][0]
+                                    ), fetch=True)[0][0]
 
                                     # 2) if completed, insert into encadenament
                                     if completed_chk:
@@ -447,6 +580,80 @@ elif page == "Route Searcher":
                                     st.error(f"Failed to submit recommendation: {e}")
 
 
+# ─── SEARCH ────────────────────────────────────────────────────────────────────
+
+elif page == "Search":
+    st.header("🔎 Search")
+
+    # Full-text search over route names, descriptions and comments, in
+    # Catalan, Spanish or English (see practica/search.py)
+    search_text = st.text_input("Search routes and comments", placeholder="e.g. placa tècnica, slab, desplomat")
+
+    if search_text.strip():
+        tab_routes, tab_comments = st.tabs(["Routes", "Comments"])
+
+        with tab_routes:
+            routes = run_query(search.ROUTE_SEARCH, {"query": search_text, "limit": search.DEFAULT_LIMIT})
+            if routes:
+                for route, sector, crag, grade, snippet, rank in routes:
+                    st.markdown(f"**{route}** ({sector}, {crag}) · {grade or '—'}  \n{snippet}")
+            else:
+                st.info("No routes match your search.")
+
+        with tab_comments:
+            comments = run_query(*search.comment_search_query(search_text))
+            if comments:
+                for _, climber, route, sector, crag, date, snippet, rank in comments:
+                    st.markdown(f"**{climber}** on *{route}* ({sector}, {crag}) · {date:%Y-%m-%d}  \n{snippet}")
+            else:
+                st.info("No comments match your search.")
+
+# ─── LEADERBOARDS ──────────────────────────────────────────────────────────────
+
+elif page == "Leaderboards":
+    st.header("🏆 Leaderboards")
+
+    # Boards per crag and month, read from practica.leaderboard_entry
+    col1, col2 = st.columns(2)
+    crag = col1.selectbox(
+        "Crag", ["All crags"] + catalog_tree().crags()
+    )
+    crag_scope = leaderboards.ALL if crag == "All crags" else crag
+    month = col2.selectbox(
+        "Month", ["All time"] + [row[0] for row in run_query(leaderboards.MONTHS, (crag_scope,))]
+    )
+    month_scope = leaderboards.ALL if month == "All time" else month
+
+    for col, (board, title) in zip(st.columns(len(leaderboards.BOARDS)), leaderboards.BOARDS.items()):
+        with col:
+            st.subheader(title)
+            entries = run_query(leaderboards.board_query(board), (crag_scope, month_scope, 10))
+            if entries:
+                df_board = pd.DataFrame(entries, columns=["Climber", "Completions", "Routes", "Hardest"])
+                df_board["Hardest"] = grades.to_labels(df_board["Hardest"])
+                df_board.index = range(1, len(df_board) + 1)
+                if st.session_state.username in set(df_board["Climber"]):
+                    st.caption("You're on this board!")
+                st.dataframe(df_board, use_container_width=True)
+            else:
+                st.info("No completions yet.")
+
+# ─── PARTNERS ──────────────────────────────────────────────────────────────────
+
+elif page == "Partners":
+    st.header("🤝 Climbing Partners")
+    st.caption("Climbers who climbed the same grades, at the same crags, on the same days as you over the last year.")
+
+    # Nearest climbers by profile, precomputed by practica/partners.py
+    matches = run_query(partners.PARTNERS, (st.session_state.username, partners.TOP_K))
+    if matches:
+        df_partners = pd.DataFrame(matches, columns=["Climber", "Level", "Working Grade", "Match"])
+        df_partners["Working Grade"] = grades.to_labels(df_partners["Working Grade"])
+        df_partners.index = range(1, len(df_partners) + 1)
+        st.dataframe(df_partners, use_container_width=True)
+    else:
+        st.info("No partner suggestions yet: log some attempts and check back tomorrow.")
+
 # ─── PROFILE ───────────────────────────────────────────────────────────────────
 
 elif page == "Profile":
@@ -473,6 +680,49 @@ elif page == "Profile":
     else:
         st.error("Could not load your profile info.")
 
+    # — 1.1) Level estimated from the completions, and the grade pyramid behind it
+    level = run_query(levels.LEVEL, (username,))
+    if level:
+        ordinal, estimated, num_completions = level[0]
+        col1, col2 = st.columns(2)
+        col1.metric("📈 Estimated Level", estimated, help=f"From {num_completions} completions")
+        col2.metric("Working Grade", grades.label(ordinal))
+        pyramid = run_query(levels.PYRAMID, (username,))
+        df_pyramid = pd.DataFrame(pyramid, columns=["Ordinal", "All Time", "Last Year"])
+        df_pyramid["Grade"] = grades.to_labels(df_pyramid["Ordinal"])
+        fig = px.bar(
+            df_pyramid, x=["All Time", "Last Year"], y="Grade", orientation="h", barmode="overlay",
+            title="Your Grade Pyramid", labels={"value": "Completions", "variable": ""}
+        )
+        fig.update_yaxes(autorange="reversed")
+        st.plotly_chart(fig, use_container_width=True)
+
+    # — 1.2) Redpoint journeys: how long each route took to send
+    journey_rows = run_query(journeys.CLIMBER_JOURNEYS, (username,))
+    if journey_rows:
+        st.subheader("🧗 Redpoint Journeys")
+        df_journeys = pd.DataFrame(journey_rows, columns=[
+            "Route", "Sector", "Crag", "Grade", "First Attempt", "First Type",
+            "Sent", "Send Type", "Attempts to Send", "Days to Send", "Attempts"
+        ])
+        df_journeys["Grade"] = grades.to_labels(df_journeys["Grade"])
+        st.dataframe(df_journeys, use_container_width=True)
+
+        effort = run_query(*journeys.journey_effort_query(climbers=[username]))
+        if effort:
+            df_effort = pd.DataFrame(effort, columns=["Ordinal", "Sends", "Avg Attempts", "Avg Days", "First Try"])
+            df_effort["Grade"] = grades.to_labels(df_effort["Ordinal"])
+            fig = px.bar(
+                df_effort, x="Grade", y=["Avg Attempts", "Avg Days"], barmode="group",
+                title="Your Effort per Grade", labels={"value": "Average to Send", "variable": ""},
+                hover_data=["Sends", "First Try"]
+            )
+            fig.update_xaxes(type="category")
+            st.plotly_chart(fig, use_container_width=True)
+
+    # Archived activity is read-only and only loaded on request
+    show_archived = archive_installed() and st.checkbox("Include archived activity")
+
     st.markdown("---")
 
     # — 2) Tabs for Attempts / Completions / Comments / Recommendations
@@ -520,6 +770,19 @@ elif page == "Profile":
         else:
             st.info("You haven't logged any attempts yet.")
 
+        if show_archived:
+            archived = run_query(
+                """
+                SELECT id_intent, tipus_ascensio, data_intent, nom_via, nom_sector_via, nom_crag_via
+                FROM practica.intent_archive
+                WHERE nom_usuari_escalador = %s
+                ORDER BY data_intent DESC
+                """,
+                (username,)
+            )
+            with st.expander(f"Archived attempts ({len(archived)})"):
+                st.dataframe(pd.DataFrame(archived, columns=["ID","Type","Date","Route","Sector","Crag"]), use_container_width=True)
+
     # --- Completions Tab ---
     with tab_comp:
         st.subheader("✅ Your Completions")
@@ -547,6 +810,20 @@ elif page == "Profile":
         else:
             st.info("No completions recorded yet.")
 
+        if show_archived:
+            archived = run_query(
+                """
+                SELECT e.id_intent, i.data_intent, e.temps_ascensio, i.nom_via
+                FROM practica.encadenament_archive e
+                JOIN practica.intent_archive i ON e.id_intent = i.id_intent
+                WHERE i.nom_usuari_escalador = %s
+                ORDER BY i.data_intent DESC
+                """,
+                (username,)
+            )
+            with st.expander(f"Archived completions ({len(archived)})"):
+                st.dataframe(pd.DataFrame(archived, columns=["Intent ID","Date","Time Spent","Route"]), use_container_width=True)
+
     # --- Comments Tab ---
     with tab_com:
         st.subheader("💬 Your Comments")
@@ -585,6 +862,19 @@ elif page == "Profile":
         else:
             st.info("You haven't made any comments yet.")
 
+        if show_archived:
+            archived = run_query(
+                """
+                SELECT id_comentari, text_comentari, data_comentari, nom_via
+                FROM practica.comentari_archive
+                WHERE nom_usuari_escalador = %s
+                ORDER BY data_comentari DESC
+                """,
+                (username,)
+            )
+            with st.expander(f"Archived comments ({len(archived)})"):
+                st.dataframe(pd.DataFrame(archived, columns=["ID","Comment","Date","Route"]), use_container_width=True)
+
     # --- Recommendations Tab ---
     with tab_rec:
         st.subheader("🌟 Your Recommendations")
@@ -624,4 +914,17 @@ elif page == "Profile":
         else:
             st.info("You haven't made any recommendations yet.")
 
+        if show_archived:
+            archived = run_query(
+                """
+                SELECT id_recomanacio, puntuacio, descripcio_recomanacio, data_recomanacio, nom_via
+                FROM practica.recomanacio_archive
+                WHERE nom_usuari_escalador = %s
+                ORDER BY data_recomanacio DESC
+                """,
+                (username,)
+            )
+            with st.expander(f"Archived recommendations ({len(archived)})"):
+                st.dataframe(pd.DataFrame(archived, columns=["ID","Rating","Note","Date","Route"]), use_container_width=True)
+
     